@@ -0,0 +1,28 @@
+import logging
+import os
+import tempfile
+
+
+def setup_django():
+    """
+        Configures Django with the test settings and a migrated SQLite database in a temporary file,
+        so the benchmarks can write from several threads.
+    """
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test.utils import setup_test_environment
+
+    from tests import settings as test_settings  # noqa: F401 configures django
+
+    database_dir = tempfile.mkdtemp(prefix='django_paydirekt_benchmarks')
+    settings.DATABASES['default']['NAME'] = os.path.join(database_dir, 'db.sqlite3')
+    settings.DATABASES['default']['OPTIONS'] = {'timeout': 30}
+    django.setup()
+    setup_test_environment()
+    call_command('migrate', verbosity=0)
+
+    # injected errors and rejected notifications are expected
+    logging.getLogger('django_paydirekt').setLevel(logging.CRITICAL)
+    logging.getLogger('django.request').setLevel(logging.CRITICAL)
+    return database_dir
@@ -0,0 +1,173 @@
+import argparse
+import json
+import platform
+import ssl
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from benchmarks import setup_django
+
+OPERATIONS = ('init', 'refresh_from_paydirekt', 'create_capture', 'create_refund', 'transactions', 'notify')
+
+
+def percentile(durations, percent):
+    if not durations:
+        return None
+    durations = sorted(durations)
+    index = max(0, int(round(percent / 100.0 * len(durations))) - 1)
+    return durations[index]
+
+
+def run_operation(operation, count, concurrency):
+    """
+        Calls operation(i) count times from concurrency threads.
+        The operation returns a false value or raises on errors.
+    """
+    def timed_call(i):
+        start = time.perf_counter()
+        try:
+            succeeded = bool(operation(i))
+        except Exception:
+            succeeded = False
+        return succeeded, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_call, range(count)))
+    duration = time.perf_counter() - start
+
+    durations = [call_duration for succeeded, call_duration in results if succeeded]
+    return {
+        'calls': count,
+        'errors': count - len(durations),
+        'duration': duration,
+        'throughput': len(durations) / duration if duration else 0,
+        'p50': percentile(durations, 50),
+        'p99': percentile(durations, 99),
+    }
+
+
+def run_benchmarks(stub_server, operations, count, concurrency):
+    from django.test import Client
+
+    from django_paydirekt import settings as django_paydirekt_settings
+    from django_paydirekt.models import PaydirektCheckout
+    from django_paydirekt.views import NotifyPaydirektView
+    from django_paydirekt.wrappers import PaydirektWrapper
+
+    paydirekt_wrapper = PaydirektWrapper(auth={
+        'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+        'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+    })
+    paydirekt_wrapper.api_url = stub_server.url
+    # the notify view refreshes through its own wrapper
+    NotifyPaydirektView.paydirekt_wrapper.api_url = stub_server.url
+
+    checkouts = []
+
+    def init(i):
+        paydirekt_checkout = paydirekt_wrapper.init(total_amount=100.0, reference_number=str(i), payment_type='ORDER',
+                                                    shopping_cart_type='ANONYMOUS_DONATION')
+        if paydirekt_checkout:
+            checkouts.append(paydirekt_checkout)
+        return paydirekt_checkout
+
+    def get_checkout(i):
+        return checkouts[i % len(checkouts)]
+
+    def refresh_from_paydirekt(i):
+        return get_checkout(i).refresh_from_paydirekt(paydirekt_wrapper)
+
+    def create_capture(i):
+        return get_checkout(i).create_capture(amount=1.0, paydirekt_wrapper=paydirekt_wrapper)
+
+    def create_refund(i):
+        return get_checkout(i).create_refund(amount=1.0, paydirekt_wrapper=paydirekt_wrapper)
+
+    def transactions(i):
+        to_datetime = datetime(2019, 1, 1) + timedelta(hours=i)
+        return paydirekt_wrapper.transactions(from_datetime=to_datetime - timedelta(hours=1), to_datetime=to_datetime)
+
+    def notify(i):
+        paydirekt_checkout = get_checkout(i)
+        post_data = {'checkoutId': paydirekt_checkout.checkout_id, 'merchantOrderReferenceNumber': paydirekt_checkout.checkout_id,
+                     'checkoutStatus': 'APPROVED'}
+        response = Client().post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        return response.status_code == 200
+
+    functions = {
+        'init': init,
+        'refresh_from_paydirekt': refresh_from_paydirekt,
+        'create_capture': create_capture,
+        'create_refund': create_refund,
+        'transactions': transactions,
+        'notify': notify,
+    }
+    results = {}
+    # every other operation works on the created checkouts
+    results['init'] = run_operation(init, count, concurrency)
+    if not checkouts:
+        raise RuntimeError('No checkout could be created, check the stub server.')
+    # captures and refunds need the links of approved checkouts
+    PaydirektCheckout.objects.refresh_many(checkouts, paydirekt_wrapper)
+    for operation in operations:
+        if operation != 'init':
+            results[operation] = run_operation(functions[operation], count, concurrency)
+    return dict((operation, results[operation]) for operation in operations)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the paydirekt API calls against a local stub server.')
+    parser.add_argument('--operation', action='append', dest='operations', choices=OPERATIONS,
+                        help='Operation to benchmark, may be repeated. Default: all.')
+    parser.add_argument('--requests', type=int, default=200, help='Calls per operation. Default: 200.')
+    parser.add_argument('--concurrency', type=int, default=10, help='Concurrent calls. Default: 10.')
+    parser.add_argument('--latency', type=float, default=0, help='Stub server latency in milliseconds. Default: 0.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of stub server 503 responses. Default: 0.')
+    parser.add_argument('--tls', action='store_true', help='Serve the stub API over HTTPS.')
+    parser.add_argument('--json', dest='json_file', help='Write the results as JSON to this file, - for stdout.')
+    args = parser.parse_args()
+
+    setup_django()
+
+    import django
+    from django_paydirekt import __version__, transport
+    from tests.stub_server import StubServer
+
+    stub_server = StubServer(tls=args.tls, latency=args.latency / 1000.0, error_rate=args.error_rate, seed=0).start()
+    if args.tls:
+        transport._ssl_context = ssl.create_default_context(cafile=stub_server.certfile)
+    try:
+        results = run_benchmarks(stub_server, args.operations or OPERATIONS, args.requests, args.concurrency)
+    finally:
+        stub_server.stop()
+
+    report = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'parameters': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'tls': args.tls,
+        },
+        'results': results,
+    }
+    if args.json_file == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    for operation, result in results.items():
+        print('{0:<24} {1:>8.1f} calls/s  p50 {2:>7.2f} ms  p99 {3:>7.2f} ms  {4} errors'.format(
+            operation, result['throughput'], (result['p50'] or 0) * 1000, (result['p99'] or 0) * 1000, result['errors']))
+
+
+if __name__ == '__main__':
+    main()
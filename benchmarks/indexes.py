@@ -0,0 +1,122 @@
+import argparse
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from benchmarks import setup_django
+
+STATUSES = ('OPEN', 'PENDING', 'APPROVED', 'CLOSED', 'EXPIRED', 'CANCELED')
+STATUS_WEIGHTS = (1, 1, 1, 60, 30, 7)
+TRANSACTION_STATUSES = ('SUCCESSFUL', 'PENDING', 'FAILED')
+TRANSACTION_STATUS_WEIGHTS = (95, 4, 1)
+
+
+def seed(rows, batch_size=10000):
+    """
+        Inserts rows checkouts created over the last two years, mostly closed or expired,
+        with a capture for every second and a refund for every tenth checkout.
+    """
+    from django.db import connection, transaction
+    from django.utils import timezone
+
+    from django_paydirekt.models import PaydirektCapture, PaydirektCheckout, PaydirektRefund
+
+    randomizer = random.Random(0)
+    now = timezone.now()
+
+    def checkout_rows(start, stop):
+        for i in range(start, stop):
+            created_at = now - timedelta(seconds=randomizer.randrange(2 * 365 * 24 * 60 * 60))
+            link = 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/checkout-{0}'.format(i)
+            yield (i + 1, 'checkout-{0}'.format(i), 'ORDER', '100.00', randomizer.choices(STATUSES, STATUS_WEIGHTS)[0], True,
+                   link, link, link, link, link, created_at, created_at)
+
+    def transaction_rows(prefix, start, stop, every):
+        for i in range(start, stop):
+            if i % every:
+                continue
+            link = 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/checkout-{0}/{1}'.format(i, prefix)
+            yield (i + 1, '{0}-{1}'.format(prefix, i), '10.00', link, randomizer.choices(TRANSACTION_STATUSES, TRANSACTION_STATUS_WEIGHTS)[0], now, now)
+
+    checkout_sql = 'INSERT INTO {0} (id, checkout_id, payment_type, total_amount, status, status_verified, link, approve_link, ' \
+                   'close_link, captures_link, refunds_link, created_at, last_modified) ' \
+                   'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)'.format(PaydirektCheckout._meta.db_table)
+    capture_sql = 'INSERT INTO {0} (checkout_id, transaction_id, amount, link, status, final, status_verified, capture_type, ' \
+                  'created_at, last_modified) VALUES (%s, %s, %s, %s, %s, 0, 1, \'\', %s, %s)'.format(PaydirektCapture._meta.db_table)
+    refund_sql = 'INSERT INTO {0} (checkout_id, transaction_id, amount, link, status, refund_type, created_at, last_modified) ' \
+                 'VALUES (%s, %s, %s, %s, %s, \'\', %s, %s)'.format(PaydirektRefund._meta.db_table)
+    for start in range(0, rows, batch_size):
+        stop = min(start + batch_size, rows)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(checkout_sql, list(checkout_rows(start, stop)))
+            cursor.executemany(capture_sql, list(transaction_rows('captures', start, stop, 2)))
+            cursor.executemany(refund_sql, list(transaction_rows('refunds', start, stop, 10)))
+
+
+def get_queries(rows):
+    from django.utils import timezone
+
+    from django_paydirekt.models import OPEN_CHECKOUT_STATUSES, PaydirektCapture, PaydirektCheckout, PaydirektRefund
+
+    cutoff = timezone.now() - timedelta(days=30)
+    checkout_pk = rows // 2 + 1
+    return (
+        ('admin list', PaydirektCheckout.objects.order_by('-created_at')[:100]),
+        ('admin status filter', PaydirektCheckout.objects.filter(status='APPROVED').order_by('-created_at')[:100]),
+        ('reconcile', PaydirektCheckout.objects.filter(status__in=OPEN_CHECKOUT_STATUSES, created_at__lt=cutoff)
+                                               .order_by('status', 'created_at', 'pk')),
+        ('failed captures', PaydirektCapture.objects.filter(status='FAILED')),
+        ('captures of checkout by status', PaydirektCapture.objects.filter(checkout_id=checkout_pk, status='SUCCESSFUL')),
+        ('pending refunds', PaydirektRefund.objects.filter(status='PENDING')),
+    )
+
+
+def benchmark_queries(rows, repeat):
+    from django.db import connection
+
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE')
+    results = {}
+    for name, queryset in get_queries(rows):
+        queryset = queryset.values_list('pk', flat=True)
+        durations = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            list(queryset)
+            durations.append(time.perf_counter() - start)
+        results[name] = {'duration': statistics.median(durations), 'plan': queryset.explain()}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query plans and durations of the common checkout, capture and refund queries '
+                                                 'with and without the indexes of migration 0005.')
+    parser.add_argument('--rows', type=int, default=2000000, help='Number of seeded checkouts. Default: 2000000.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per query, the median is reported. Default: 5.')
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.core.management import call_command
+
+    call_command('migrate', 'django_paydirekt', '0004', verbosity=0)
+    start = time.perf_counter()
+    seed(args.rows)
+    print('seeded {0} checkouts in {1:.1f}s'.format(args.rows, time.perf_counter() - start))
+    without_indexes = benchmark_queries(args.rows, args.repeat)
+
+    start = time.perf_counter()
+    call_command('migrate', 'django_paydirekt', '0005', verbosity=0)
+    print('created the indexes in {0:.1f}s'.format(time.perf_counter() - start))
+    with_indexes = benchmark_queries(args.rows, args.repeat)
+
+    for name in without_indexes:
+        print('\n{0}: {1:.2f} ms -> {2:.2f} ms'.format(
+            name, without_indexes[name]['duration'] * 1000, with_indexes[name]['duration'] * 1000))
+        print('  without indexes: {0}'.format(without_indexes[name]['plan'].replace('\n', '\n    ')))
+        print('  with indexes:    {0}'.format(with_indexes[name]['plan'].replace('\n', '\n    ')))
+
+
+if __name__ == '__main__':
+    main()
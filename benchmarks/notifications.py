@@ -0,0 +1,49 @@
+import argparse
+import json
+import time
+
+from testfixtures import Replacer
+
+from benchmarks import setup_django
+
+
+def benchmark_unknown_ids(requests, unknown_ids, unknown_id_cache_alias):
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    client = Client()
+    post_data = [json.dumps({'checkoutId': 'unknown-{0}'.format(i % unknown_ids),
+                             'merchantOrderReferenceNumber': 'unknown-{0}'.format(i % unknown_ids),
+                             'checkoutStatus': 'APPROVED'}) for i in range(requests)]
+    with Replacer() as replacer:
+        replacer.replace('django_paydirekt.settings.PAYDIREKT_UNKNOWN_ID_CACHE_ALIAS', unknown_id_cache_alias)
+        with CaptureQueriesContext(connection) as queries:
+            start = time.monotonic()
+            for data in post_data:
+                response = client.post('/paydirekt/notify/', data=data, content_type='application/hal+json')
+                assert response.status_code == 400
+            duration = time.monotonic() - start
+    return {
+        'requests': requests,
+        'rejections_per_second': requests / duration,
+        'queries_per_request': len(queries) / float(requests),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rejections per second of NotifyPaydirektView for unknown checkout ids.')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--unknown-ids', type=int, default=100, help='Number of distinct unknown checkout ids.')
+    args = parser.parse_args()
+
+    setup_django()
+
+    for name, unknown_id_cache_alias in (('without unknown id cache', None), ('with unknown id cache', 'default')):
+        result = benchmark_unknown_ids(args.requests, args.unknown_ids, unknown_id_cache_alias)
+        print('{0}: {1:.0f} rejections/s, {2:.2f} queries/request'.format(
+            name, result['rejections_per_second'], result['queries_per_request']))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@ from .models import PaydirektCheckout
 
 
 class PaydirektCheckoutAdmin(admin.ModelAdmin):
-    list_display = ('checkout_id', 'status')
+    list_display = ('checkout_id', 'status', 'captured_amount', 'refunded_amount')
     list_filter = ('status',)
     ordering = ('-created_at',)
     fields = ('checkout_id', 'status')
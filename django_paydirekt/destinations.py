@@ -0,0 +1,69 @@
+from functools import lru_cache
+
+from django_paydirekt import settings as django_paydirekt_settings
+
+
+class PaydirektDestinationRules(object):
+    """
+        Express checkout destination rules, compiled once into a zip prefix trie per country.
+        A rule is a dict with the keys country_codes, zip_codes, packstation and shipping_options,
+        zip codes ending with * match every zip starting with the part before the *.
+        The first matching rule wins.
+    """
+    cache_size = django_paydirekt_settings.PAYDIREKT_DESTINATION_CACHE_SIZE
+
+    def __init__(self, rules, cache_size=None):
+        super(PaydirektDestinationRules, self).__init__()
+        if cache_size is not None:
+            self.cache_size = cache_size
+        self.rules = list(rules)
+        self._countries = {}
+        for index, rule in enumerate(self.rules):
+            for country_code in rule.get('country_codes', []):
+                exact_zip_codes, prefix_trie = self._countries.setdefault(country_code, ({}, {}))
+                for zip_code in rule.get('zip_codes', ['*']):
+                    if '*' in zip_code:
+                        node = prefix_trie
+                        for char in zip_code.split('*')[0]:
+                            node = node.setdefault(char, {})
+                        node.setdefault(None, []).append(index)
+                    else:
+                        exact_zip_codes.setdefault(zip_code, []).append(index)
+        self.check = lru_cache(maxsize=self.cache_size)(self._check)
+
+    @classmethod
+    def from_settings(cls):
+        rules = django_paydirekt_settings.PAYDIREKT_DESTINATION_RULES
+        if rules is None:
+            rules = [{
+                'country_codes': django_paydirekt_settings.PAYDIREKT_VALID_COUNTRY_CODES,
+                'zip_codes': django_paydirekt_settings.PAYDIREKT_VALID_ZIP_CODES,
+                'packstation': django_paydirekt_settings.PAYDIREKT_VALID_PACKSTATION,
+                'shipping_options': django_paydirekt_settings.PAYDIREKT_SHIPPING_OPTIONS,
+            }]
+        return cls(rules)
+
+    def _check(self, country_code, zip_code, packstation):
+        """
+            Returns valid billing destination, valid shipping destination and the shipping options.
+        """
+        for index in self._get_rule_indexes(country_code, zip_code):
+            rule = self.rules[index]
+            if packstation and not rule.get('packstation', True):
+                continue
+            return not packstation, True, rule.get('shipping_options', [])
+        return False, False, []
+
+    def _get_rule_indexes(self, country_code, zip_code):
+        if country_code not in self._countries:
+            return []
+        exact_zip_codes, prefix_trie = self._countries[country_code]
+        indexes = list(exact_zip_codes.get(zip_code, []))
+        node = prefix_trie
+        indexes.extend(node.get(None, []))
+        for char in zip_code:
+            node = node.get(char)
+            if node is None:
+                break
+            indexes.extend(node.get(None, []))
+        return sorted(indexes)
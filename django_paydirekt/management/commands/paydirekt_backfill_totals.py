@@ -0,0 +1,54 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Sum
+
+from django_paydirekt.models import FAILED_TRANSACTION_STATUSES, PaydirektCapture, PaydirektCheckout, PaydirektRefund
+
+
+class Command(BaseCommand):
+    help = 'Sets the captured and refunded totals of all checkouts from their captures and refunds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of checkouts loaded and updated at once. Default: 1000.')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        processed_count = 0
+        changed_count = 0
+        start = time.monotonic()
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                paydirekt_checkouts = list(PaydirektCheckout.objects.select_for_update().filter(pk__gt=last_pk).order_by('pk').only(
+                    'pk', 'captured_amount', 'refunded_amount', 'capture_count')[:chunk_size])
+                if not paydirekt_checkouts:
+                    break
+                changed_count += self._backfill(paydirekt_checkouts)
+            processed_count += len(paydirekt_checkouts)
+            last_pk = paydirekt_checkouts[-1].pk
+        duration = time.monotonic() - start
+        self.stdout.write('{0} checkouts backfilled, {1} changed in {2:.1f}s'.format(processed_count, changed_count, duration))
+
+    def _backfill(self, paydirekt_checkouts):
+        checkout_pks = [paydirekt_checkout.pk for paydirekt_checkout in paydirekt_checkouts]
+        captures = dict((row['checkout'], row) for row in PaydirektCapture.objects.filter(checkout__in=checkout_pks).exclude(
+            status__in=FAILED_TRANSACTION_STATUSES).values('checkout').annotate(amount=Sum('amount'), count=Count('pk')))
+        refunds = dict((row['checkout'], row) for row in PaydirektRefund.objects.filter(checkout__in=checkout_pks).exclude(
+            status__in=FAILED_TRANSACTION_STATUSES).values('checkout').annotate(amount=Sum('amount')))
+
+        changed_checkouts = []
+        for paydirekt_checkout in paydirekt_checkouts:
+            totals = (
+                captures.get(paydirekt_checkout.pk, {}).get('amount') or 0,
+                refunds.get(paydirekt_checkout.pk, {}).get('amount') or 0,
+                captures.get(paydirekt_checkout.pk, {}).get('count') or 0,
+            )
+            if totals != (paydirekt_checkout.captured_amount, paydirekt_checkout.refunded_amount, paydirekt_checkout.capture_count):
+                paydirekt_checkout.captured_amount, paydirekt_checkout.refunded_amount, paydirekt_checkout.capture_count = totals
+                changed_checkouts.append(paydirekt_checkout)
+        if changed_checkouts:
+            PaydirektCheckout.objects.bulk_update(changed_checkouts, ['captured_amount', 'refunded_amount', 'capture_count'])
+        return len(changed_checkouts)
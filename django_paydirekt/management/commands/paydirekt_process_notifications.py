@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_paydirekt.models import PaydirektNotification
+
+
+class Command(BaseCommand):
+    help = 'Processes the notifications stored in the notification inbox.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of notifications processed at once. Default: 100.')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep waiting for new notifications instead of stopping when the inbox is empty.')
+        parser.add_argument('--interval', type=float, default=1,
+                            help='Seconds to wait for new notifications in loop mode. Default: 1.')
+
+    def handle(self, *args, **options):
+        processed_count = 0
+        while True:
+            batch_count = PaydirektNotification.objects.process_pending(batch_size=options['batch_size'])
+            processed_count += batch_count
+            if batch_count:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write('{0} notifications processed'.format(processed_count))
@@ -0,0 +1,66 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from django_paydirekt import settings as django_paydirekt_settings
+from django_paydirekt.models import OPEN_CHECKOUT_STATUSES, PaydirektCheckout
+from django_paydirekt.utils import PaydirektRateLimiter
+from django_paydirekt.wrappers import PaydirektWrapper
+
+
+class Command(BaseCommand):
+    help = 'Refreshes checkouts in non-terminal states from paydirekt, e.g. after missed notifications.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status', action='append', dest='statuses',
+                            help='Checkout status to reconcile, may be repeated. Default: OPEN, PENDING and APPROVED.')
+        parser.add_argument('--older-than', type=int, default=60,
+                            help='Only reconcile checkouts created more than this many minutes ago. Default: 60.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of checkouts loaded and updated at once. Default: 500.')
+        parser.add_argument('--workers', type=int, default=django_paydirekt_settings.PAYDIREKT_MAX_WORKERS,
+                            help='Number of concurrent API calls.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Maximum API calls per second, 0 for no limit. Default: 0.')
+
+    def handle(self, *args, **options):
+        statuses = options['statuses'] or OPEN_CHECKOUT_STATUSES
+        cutoff = timezone.now() - timedelta(minutes=options['older_than'])
+        chunk_size = options['chunk_size']
+        rate_limiter = PaydirektRateLimiter(options['rate']) if options['rate'] else None
+        paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        })
+
+        # keyset pagination by pk, refreshed checkouts leaving the statuses drop out without shifting the next chunks
+        processed_count = 0
+        changed_count = 0
+        failed_count = 0
+        start = time.monotonic()
+        last_pk = 0
+        while True:
+            chunk = list(PaydirektCheckout.objects.filter(status__in=statuses, created_at__lt=cutoff, pk__gt=last_pk).order_by(
+                'pk')[:chunk_size])
+            if not chunk:
+                break
+            changed_checkouts, failed_checkouts = self._reconcile(chunk, paydirekt_wrapper, options['workers'], rate_limiter)
+            processed_count += len(chunk)
+            changed_count += len(changed_checkouts)
+            failed_count += len(failed_checkouts)
+            last_pk = chunk[-1].pk
+            if len(chunk) == chunk_size:
+                self._report(processed_count, changed_count, failed_count, start)
+        self._report(processed_count, changed_count, failed_count, start)
+
+    def _reconcile(self, paydirekt_checkouts, paydirekt_wrapper, workers, rate_limiter):
+        return PaydirektCheckout.objects.refresh_many(paydirekt_checkouts, paydirekt_wrapper, max_workers=workers,
+                                                      rate_limiter=rate_limiter)
+
+    def _report(self, processed_count, changed_count, failed_count, start):
+        duration = time.monotonic() - start
+        throughput = processed_count / duration if duration else 0
+        self.stdout.write('{0} checkouts reconciled, {1} changed, {2} errors, {3:.1f} checkouts/s'.format(
+            processed_count, changed_count, failed_count, throughput))
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_paydirekt import settings as django_paydirekt_settings
+from django_paydirekt.models import PaydirektTransaction
+from django_paydirekt.wrappers import PaydirektWrapper
+
+
+class Command(BaseCommand):
+    help = 'Stores the paydirekt transactions reported since the last run.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=int, default=24,
+                            help='Hours of transactions fetched per request. Default: 24.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of windows fetched concurrently. Default: 1.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of transactions inserted at once. Default: 500.')
+
+    def handle(self, *args, **options):
+        if options['window'] < 1:
+            raise CommandError('--window must be at least 1 hour.')
+        paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        })
+        transaction_count = PaydirektTransaction.objects.sync(paydirekt_wrapper,
+                                                              window=timedelta(hours=options['window']),
+                                                              max_workers=options['workers'],
+                                                              batch_size=options['batch_size'])
+        self.stdout.write('{0} transactions synced'.format(transaction_count))
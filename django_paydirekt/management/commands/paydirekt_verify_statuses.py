@@ -0,0 +1,56 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from django_paydirekt import settings as django_paydirekt_settings
+from django_paydirekt.models import PaydirektCapture, PaydirektCheckout
+from django_paydirekt.utils import PaydirektRateLimiter
+from django_paydirekt.wrappers import PaydirektWrapper
+
+
+class Command(BaseCommand):
+    help = 'Checks the statuses applied from notifications against paydirekt (PAYDIREKT_NOTIFICATION_TRUST_STATUS).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of objects loaded and updated at once. Default: 500.')
+        parser.add_argument('--workers', type=int, default=django_paydirekt_settings.PAYDIREKT_MAX_WORKERS,
+                            help='Number of concurrent API calls.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Maximum API calls per second, 0 for no limit. Default: 0.')
+
+    def handle(self, *args, **options):
+        rate_limiter = PaydirektRateLimiter(options['rate']) if options['rate'] else None
+        paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        })
+        for name, model in (('checkouts', PaydirektCheckout), ('captures', PaydirektCapture)):
+            self._verify(name, model, paydirekt_wrapper, options['chunk_size'], options['workers'], rate_limiter)
+
+    def _verify(self, name, model, paydirekt_wrapper, chunk_size, workers, rate_limiter):
+        paydirekt_objects = model.objects.filter(status_verified=False).order_by('pk')
+        processed_count = 0
+        mismatched_count = 0
+        failed_count = 0
+        start = time.monotonic()
+        chunk = []
+        for paydirekt_object in paydirekt_objects.iterator(chunk_size=chunk_size):
+            chunk.append(paydirekt_object)
+            if len(chunk) < chunk_size:
+                continue
+            mismatched_objects, failed_objects = model.objects.verify_statuses(chunk, paydirekt_wrapper, max_workers=workers,
+                                                                               rate_limiter=rate_limiter)
+            processed_count += len(chunk)
+            mismatched_count += len(mismatched_objects)
+            failed_count += len(failed_objects)
+            chunk = []
+        if chunk:
+            mismatched_objects, failed_objects = model.objects.verify_statuses(chunk, paydirekt_wrapper, max_workers=workers,
+                                                                               rate_limiter=rate_limiter)
+            processed_count += len(chunk)
+            mismatched_count += len(mismatched_objects)
+            failed_count += len(failed_objects)
+        duration = time.monotonic() - start
+        self.stdout.write('{0} {1} verified, {2} mismatches, {3} errors in {4:.1f}s'.format(
+            processed_count, name, mismatched_count, failed_count, duration))
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_paydirekt', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaydirektTransactionSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True, verbose_name='key')),
+                ('synced_until', models.DateTimeField(blank=True, null=True, verbose_name='synced until')),
+                ('last_modified', models.DateTimeField(auto_now=True, verbose_name='last modified')),
+            ],
+            options={
+                'verbose_name': 'Paydirekt Transaction Sync',
+                'verbose_name_plural': 'Paydirekt Transaction Syncs',
+            },
+        ),
+        migrations.CreateModel(
+            name='PaydirektTransaction',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payment_information_id', models.CharField(db_index=True, max_length=255, verbose_name='payment information id')),
+                ('merchant_reference_number', models.CharField(blank=True, db_index=True, max_length=255, verbose_name='merchant reference number')),
+                ('transaction_type', models.CharField(blank=True, max_length=255, verbose_name='transaction type')),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=9, null=True, verbose_name='amount')),
+                ('currency', models.CharField(blank=True, max_length=255, verbose_name='currency')),
+                ('timestamp', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='timestamp')),
+                ('data', models.TextField(blank=True, verbose_name='data')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+            ],
+            options={
+                'verbose_name': 'Paydirekt Transaction',
+                'verbose_name_plural': 'Paydirekt Transactions',
+                'unique_together': {('payment_information_id', 'transaction_type')},
+            },
+        ),
+    ]
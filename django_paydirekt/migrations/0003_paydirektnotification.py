@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_paydirekt', '0002_paydirekttransaction'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaydirektNotification',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('notification_type', models.CharField(max_length=255, verbose_name='notification type')),
+                ('checkout_id', models.CharField(max_length=255, verbose_name='checkout id')),
+                ('transaction_id', models.CharField(blank=True, max_length=255, verbose_name='transaction id')),
+                ('status', models.CharField(blank=True, max_length=255, verbose_name='status')),
+                ('payload', models.TextField(verbose_name='payload')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('response_status', models.PositiveIntegerField(blank=True, null=True, verbose_name='response status')),
+                ('processed_at', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='processed at')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created at')),
+                ('last_modified', models.DateTimeField(auto_now=True, verbose_name='last modified')),
+            ],
+            options={
+                'verbose_name': 'Paydirekt Notification',
+                'verbose_name_plural': 'Paydirekt Notifications',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 13:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_paydirekt', '0003_paydirektnotification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paydirektcapture',
+            name='status_verified',
+            field=models.BooleanField(db_index=True, default=True, verbose_name='status verified'),
+        ),
+        migrations.AddField(
+            model_name='paydirektcheckout',
+            name='status_verified',
+            field=models.BooleanField(db_index=True, default=True, verbose_name='status verified'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_paydirekt', '0004_status_verified'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='paydirektcapture',
+            index=models.Index(fields=['status', 'checkout'], name='paydirekt_capture_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paydirektcheckout',
+            index=models.Index(fields=['status', 'created_at'], name='paydirekt_checkout_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paydirektcheckout',
+            index=models.Index(fields=['created_at'], name='paydirekt_checkout_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paydirektcheckout',
+            index=models.Index(condition=models.Q(('status__in', ('OPEN', 'PENDING', 'APPROVED'))), fields=['created_at'], name='paydirekt_checkout_open_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='paydirektrefund',
+            index=models.Index(fields=['status', 'checkout'], name='paydirekt_refund_status_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:13
+
+from django.db import migrations, models
+from django.db.models import Count, DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+# FAILED_TRANSACTION_STATUSES of django_paydirekt.models at the time of this migration
+FAILED_TRANSACTION_STATUSES = ('REJECTED', 'FAILED', 'ERROR')
+
+
+def backfill_totals(apps, schema_editor):
+    PaydirektCheckout = apps.get_model('django_paydirekt', 'PaydirektCheckout')
+    PaydirektCapture = apps.get_model('django_paydirekt', 'PaydirektCapture')
+    PaydirektRefund = apps.get_model('django_paydirekt', 'PaydirektRefund')
+    amount_field = DecimalField(max_digits=9, decimal_places=2)
+    captures = PaydirektCapture.objects.filter(checkout=OuterRef('pk')).exclude(
+        status__in=FAILED_TRANSACTION_STATUSES).order_by().values('checkout')
+    refunds = PaydirektRefund.objects.filter(checkout=OuterRef('pk')).exclude(
+        status__in=FAILED_TRANSACTION_STATUSES).order_by().values('checkout')
+    PaydirektCheckout.objects.update(
+        captured_amount=Coalesce(Subquery(captures.annotate(total=Sum('amount')).values('total')), Value(0), output_field=amount_field),
+        capture_count=Coalesce(Subquery(captures.annotate(count=Count('pk')).values('count')), Value(0)),
+        refunded_amount=Coalesce(Subquery(refunds.annotate(total=Sum('amount')).values('total')), Value(0), output_field=amount_field),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_paydirekt', '0005_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paydirektcheckout',
+            name='capture_count',
+            field=models.PositiveIntegerField(default=0, verbose_name='capture count'),
+        ),
+        migrations.AddField(
+            model_name='paydirektcheckout',
+            name='captured_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=9, verbose_name='captured amount'),
+        ),
+        migrations.AddField(
+            model_name='paydirektcheckout',
+            name='refunded_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=9, verbose_name='refunded amount'),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_paydirekt', '0006_checkout_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paydirektnotification',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='claimed until'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-18 14:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_paydirekt', '0007_notification_claim'),
+    ]
+
+    operations = [
+        # unknown for the existing checkouts, False for new ones
+        migrations.AddField(
+            model_name='paydirektcheckout',
+            name='overcapture',
+            field=models.BooleanField(null=True, verbose_name='overcapture'),
+        ),
+        migrations.AlterField(
+            model_name='paydirektcheckout',
+            name='overcapture',
+            field=models.BooleanField(default=False, null=True, verbose_name='overcapture'),
+        ),
+    ]
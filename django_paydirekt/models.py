@@ -1,24 +1,294 @@
+import asyncio
+import json
 import logging
 
-from django.db import models
+from asgiref.sync import async_to_sync, sync_to_async
+from datetime import timedelta
+from decimal import Decimal
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
-from django_paydirekt.utils import build_paydirekt_full_uri
+from django_paydirekt import settings as django_paydirekt_settings
+from django_paydirekt.utils import PaydirektBulkResult, build_paydirekt_full_uri, call_api_many, get_notification_deduplicator, get_unknown_id_cache
+
+# checkout statuses which may still change without a capture, refund or close of ours
+OPEN_CHECKOUT_STATUSES = ('OPEN', 'PENDING', 'APPROVED')
+
+# checkout statuses which don't change anymore and don't accept captures
+CLOSED_CHECKOUT_STATUSES = ('REJECTED', 'CANCELED', 'CLOSED', 'EXPIRED')
+
+# capture and refund statuses which don't count towards the totals of their checkout
+FAILED_TRANSACTION_STATUSES = ('REJECTED', 'FAILED', 'ERROR')
+
+
+class PaydirektManager(models.Manager):
+    refresh_fields = ('status',)
+
+    def refresh_many(self, paydirekt_objects, paydirekt_wrapper, max_workers=None, batch_size=None, rate_limiter=None, deadline=None):
+        """
+            Fetches the state of all objects concurrently and saves the changed ones with one bulk_update.
+            Returns the lists of changed and failed objects, objects not fetched before the deadline failed.
+        """
+        paydirekt_objects = list(paydirekt_objects)
+        if not paydirekt_objects:
+            return [], []
+        responses = call_api_many(paydirekt_wrapper, [(paydirekt_object.link, None) for paydirekt_object in paydirekt_objects],
+                                        max_workers=max_workers, rate_limiter=rate_limiter, deadline=deadline)
+
+        changed_objects = []
+        changed_old_totals = []
+        failed_objects = []
+        now = timezone.now()
+        for paydirekt_object, response in zip(paydirekt_objects, responses):
+            old_values = [getattr(paydirekt_object, field) for field in self.refresh_fields]
+            old_totals = self._get_checkout_totals(paydirekt_object)
+            if not paydirekt_object._update_from_response(response):
+                failed_objects.append(paydirekt_object)
+                continue
+            if old_values != [getattr(paydirekt_object, field) for field in self.refresh_fields]:
+                paydirekt_object.last_modified = now
+                changed_objects.append(paydirekt_object)
+                changed_old_totals.append(old_totals)
+        if changed_objects:
+            with transaction.atomic(savepoint=False):
+                self.bulk_update(changed_objects, list(self.refresh_fields) + ['last_modified'], batch_size=batch_size)
+                self._update_checkout_totals(changed_objects, changed_old_totals)
+        return changed_objects, failed_objects
+
+    def apply_notified_status(self, paydirekt_object, status):
+        """
+            Sets a notified status without asking paydirekt, verify_statuses checks it later.
+            Returns True if the status changed.
+        """
+        now = timezone.now()
+        old_totals = self._get_checkout_totals(paydirekt_object)
+        with transaction.atomic(savepoint=False):
+            updated = self.filter(pk=paydirekt_object.pk).exclude(status=status).update(
+                status=status, status_verified=False, last_modified=now)
+            if updated:
+                paydirekt_object.status = status
+                paydirekt_object.status_verified = False
+                paydirekt_object.last_modified = now
+                self._update_checkout_totals([paydirekt_object], [old_totals])
+        return bool(updated)
+
+    def verify_statuses(self, paydirekt_objects, paydirekt_wrapper, max_workers=None, batch_size=None, rate_limiter=None, deadline=None):
+        """
+            Checks notified statuses against paydirekt, mismatching ones are replaced by the status at paydirekt.
+            Returns the lists of mismatching and failed objects.
+        """
+        paydirekt_objects = list(paydirekt_objects)
+        notified_statuses = [paydirekt_object.status for paydirekt_object in paydirekt_objects]
+        changed_objects, failed_objects = self.refresh_many(paydirekt_objects, paydirekt_wrapper, max_workers=max_workers,
+                                                            batch_size=batch_size, rate_limiter=rate_limiter, deadline=deadline)
+        failed_pks = set(paydirekt_object.pk for paydirekt_object in failed_objects)
+        mismatched_objects = []
+        for paydirekt_object, notified_status in zip(paydirekt_objects, notified_statuses):
+            if paydirekt_object.pk not in failed_pks and paydirekt_object.status != notified_status:
+                logger = logging.getLogger(__name__)
+                logger.error("Paydirekt Status Mismatch of {0}: notified: {1}, found: {2}".format(
+                    paydirekt_object, notified_status, paydirekt_object.status))
+                mismatched_objects.append(paydirekt_object)
+        return mismatched_objects, failed_objects
+
+    def _get_checkout_totals(self, paydirekt_object):
+        """
+            Returns the amounts the object adds to the running totals of its checkout.
+        """
+        return {}
+
+    def _create_many(self, results, requests, get_fields, error, paydirekt_wrapper, max_workers=None, batch_size=None,
+                     rate_limiter=None, deadline=None):
+        """
+            Posts the request of each result concurrently and inserts the created objects with one bulk_create.
+        """
+        responses = call_api_many(paydirekt_wrapper, requests, max_workers=max_workers, rate_limiter=rate_limiter,
+                                        deadline=deadline)
+        paydirekt_objects = []
+        for result, response in zip(results, responses):
+            fields = get_fields(result.item, response)
+            if fields:
+                result.paydirekt_object = self.model(**fields)
+                paydirekt_objects.append(result.paydirekt_object)
+            else:
+                result.error = error
+        if paydirekt_objects:
+            self._bulk_create_with_totals(paydirekt_objects, batch_size=batch_size)
+        return paydirekt_objects
+
+    def _bulk_create_with_totals(self, paydirekt_objects, batch_size=None):
+        """
+            Inserts captures or refunds with one bulk_create and adds them to the running totals of their checkouts.
+        """
+        with transaction.atomic(savepoint=False):
+            self.bulk_create(paydirekt_objects, batch_size=batch_size)
+            self._update_checkout_totals(paydirekt_objects, [{}] * len(paydirekt_objects))
+        for paydirekt_object in paydirekt_objects:
+            for field, value in self._get_checkout_totals(paydirekt_object).items():
+                setattr(paydirekt_object.checkout, field, getattr(paydirekt_object.checkout, field) + value)
+
+    def _update_checkout_totals(self, paydirekt_objects, old_totals):
+        """
+            Adds the changes of the objects to the running totals of their checkouts with F() expressions.
+        """
+        checkout_deltas = {}
+        for paydirekt_object, old_object_totals in zip(paydirekt_objects, old_totals):
+            totals = self._get_checkout_totals(paydirekt_object)
+            if not totals and not old_object_totals:
+                continue
+            deltas = checkout_deltas.setdefault(paydirekt_object.checkout_id, {})
+            for field in set(totals) | set(old_object_totals):
+                deltas[field] = deltas.get(field, 0) + totals.get(field, 0) - old_object_totals.get(field, 0)
+        for checkout_pk, deltas in checkout_deltas.items():
+            updates = dict((field, F(field) + delta) for field, delta in deltas.items() if delta)
+            if updates:
+                PaydirektCheckout.objects.filter(pk=checkout_pk).update(**updates)
+
+
+class PaydirektCheckoutManager(PaydirektManager):
+    refresh_fields = ('status', 'status_verified', 'close_link', 'captures_link', 'refunds_link')
+
+    def close_many(self, paydirekt_checkouts, paydirekt_wrapper, max_workers=None, batch_size=None, rate_limiter=None, deadline=None):
+        """
+            Closes the checkouts concurrently and saves the closed ones with one bulk_update.
+            Returns a PaydirektBulkResult per checkout in the given order.
+        """
+        results = [PaydirektBulkResult(paydirekt_checkout) for paydirekt_checkout in paydirekt_checkouts]
+        pending_results = []
+        for result in results:
+            if result.item.close_link:
+                pending_results.append(result)
+            else:
+                result.error = 'checkout has no close link'
+        responses = call_api_many(paydirekt_wrapper, [(result.item.close_link, '') for result in pending_results],
+                                        max_workers=max_workers, rate_limiter=rate_limiter, deadline=deadline)
+
+        closed_checkouts = []
+        now = timezone.now()
+        for result, close_response in zip(pending_results, responses):
+            if result.item._update_from_close_response(close_response):
+                result.item.last_modified = now
+                result.paydirekt_object = result.item
+                closed_checkouts.append(result.item)
+            else:
+                result.error = 'close failed at paydirekt'
+        if closed_checkouts:
+            self.bulk_update(closed_checkouts, ['status', 'last_modified'], batch_size=batch_size)
+        return results
+
+
+class PaydirektCaptureManager(PaydirektManager):
+    refresh_fields = ('status', 'status_verified')
+
+    def create_many(self, captures, paydirekt_wrapper, max_workers=None, batch_size=None, rate_limiter=None, deadline=None,
+                    validate=None):
+        """
+            Captures the (checkout, amount, final, reference_number) tuples concurrently and inserts the captures with one bulk_create.
+            Returns a PaydirektBulkResult per tuple in the given order.
+        """
+        results = [PaydirektBulkResult(capture) for capture in captures]
+        pending_results = []
+        pending_amounts = {}
+        for result in results:
+            paydirekt_checkout, amount, final, reference_number = result.item
+            if not paydirekt_checkout.captures_link:
+                result.error = 'checkout has no captures link'
+                continue
+            error = paydirekt_checkout._get_capture_error(amount, pending_amounts.get(paydirekt_checkout.pk, 0))
+            if not paydirekt_checkout._validate_locally('Capture', error, validate):
+                result.error = error
+                continue
+            pending_amounts[paydirekt_checkout.pk] = pending_amounts.get(paydirekt_checkout.pk, 0) + Decimal(str(amount))
+            pending_results.append(result)
+
+        requests = []
+        for result in pending_results:
+            paydirekt_checkout, amount, final, reference_number = result.item
+            requests.append((paydirekt_checkout.captures_link, paydirekt_checkout._get_capture_data(
+                amount, None, final, reference_number, None, None, None, None)))
+        paydirekt_captures = self._create_many(
+            pending_results, requests, lambda item, capture_response: item[0]._get_capture_fields(item[1], item[2], capture_response),
+            'capture failed at paydirekt', paydirekt_wrapper, max_workers=max_workers, batch_size=batch_size,
+            rate_limiter=rate_limiter, deadline=deadline)
+        if paydirekt_captures:
+            # bulk_create sends no post_save
+            unknown_id_cache = get_unknown_id_cache()
+            if unknown_id_cache:
+                transaction_ids = [paydirekt_capture.transaction_id for paydirekt_capture in paydirekt_captures]
+                transaction.on_commit(lambda: unknown_id_cache.forget('transaction', transaction_ids))
+        return results
+
+    def _get_checkout_totals(self, paydirekt_capture):
+        if paydirekt_capture.status in FAILED_TRANSACTION_STATUSES:
+            return {}
+        return {'captured_amount': Decimal(str(paydirekt_capture.amount)), 'capture_count': 1}
+
+
+class PaydirektRefundManager(PaydirektManager):
+
+    def create_many(self, refunds, paydirekt_wrapper, max_workers=None, batch_size=None, rate_limiter=None, deadline=None,
+                    validate=None):
+        """
+            Refunds the (checkout, amount, reason, reference_number) tuples concurrently and inserts the refunds with one bulk_create.
+            Returns a PaydirektBulkResult per tuple in the given order.
+        """
+        results = [PaydirektBulkResult(refund) for refund in refunds]
+        pending_results = []
+        pending_amounts = {}
+        for result in results:
+            paydirekt_checkout, amount, reason, reference_number = result.item
+            if not paydirekt_checkout.refunds_link:
+                result.error = 'checkout has no refunds link'
+                continue
+            error = paydirekt_checkout._get_refund_error(amount, pending_amounts.get(paydirekt_checkout.pk, 0))
+            if not paydirekt_checkout._validate_locally('Refund', error, validate):
+                result.error = error
+                continue
+            pending_amounts[paydirekt_checkout.pk] = pending_amounts.get(paydirekt_checkout.pk, 0) + Decimal(str(amount))
+            pending_results.append(result)
+
+        requests = []
+        for result in pending_results:
+            paydirekt_checkout, amount, reason, reference_number = result.item
+            requests.append((paydirekt_checkout.refunds_link, paydirekt_checkout._get_refund_data(
+                amount, None, reason, reference_number, None)))
+        self._create_many(
+            pending_results, requests, lambda item, refund_response: item[0]._get_refund_fields(item[1], refund_response),
+            'refund failed at paydirekt', paydirekt_wrapper, max_workers=max_workers, batch_size=batch_size,
+            rate_limiter=rate_limiter, deadline=deadline)
+        return results
+
+    def _get_checkout_totals(self, paydirekt_refund):
+        if paydirekt_refund.status in FAILED_TRANSACTION_STATUSES:
+            return {}
+        return {'refunded_amount': Decimal(str(paydirekt_refund.amount))}
 
 
 class PaydirektCheckout(models.Model):
     checkout_id = models.CharField(_("checkout id"), max_length=255, unique=True)
     payment_type = models.CharField(_("payment type"), max_length=255)
     total_amount = models.DecimalField(_("total amount"), max_digits=9, decimal_places=2)
+    # None for checkouts created before it was stored
+    overcapture = models.BooleanField(_("overcapture"), null=True, default=False)
     status = models.CharField(_("status"), max_length=255, blank=True)
+    status_verified = models.BooleanField(_("status verified"), default=True, db_index=True)
     link = models.URLField(_("link"))
     approve_link = models.URLField(_("approve link"))
     close_link = models.URLField(_("close link"), blank=True)
     captures_link = models.URLField(_("captures link"), blank=True)
     refunds_link = models.URLField(_("refunds link"), blank=True)
+    captured_amount = models.DecimalField(_("captured amount"), max_digits=9, decimal_places=2, default=0)
+    refunded_amount = models.DecimalField(_("refunded amount"), max_digits=9, decimal_places=2, default=0)
+    capture_count = models.PositiveIntegerField(_("capture count"), default=0)
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     last_modified = models.DateTimeField(_("last modified"), auto_now=True)
 
-    objects = models.Manager()
+    objects = PaydirektCheckoutManager()
 
     def __str__(self):
         return self.checkout_id
@@ -26,6 +296,15 @@ class PaydirektCheckout(models.Model):
     class Meta:
         verbose_name = _("Paydirekt Checkout")
         verbose_name_plural = _("Paydirekt Checkouts")
+        indexes = [
+            # admin status filter ordered by creation, reconciliation of old checkouts by status
+            models.Index(fields=['status', 'created_at'], name='paydirekt_checkout_status_idx'),
+            # admin list ordered by creation
+            models.Index(fields=['created_at'], name='paydirekt_checkout_created_idx'),
+            # reconciliation of the few checkouts still open, ignored by MySQL
+            models.Index(fields=['created_at'], name='paydirekt_checkout_open_idx',
+                         condition=Q(status__in=OPEN_CHECKOUT_STATUSES)),
+        ]
 
     def create_capture(self,
                        amount,
@@ -36,7 +315,178 @@ class PaydirektCheckout(models.Model):
                        reconciliation_reference_number=None,
                        invoice_reference_number=None,
                        notification_url=None,
-                       delivery_information=None):
+                       delivery_information=None,
+                       deadline=None,
+                       validate=None):
+        if not self.captures_link:
+            return False
+        if not self._validate_locally('Capture', self._get_capture_error(amount), validate):
+            return False
+        capture_data = self._get_capture_data(amount, note, final, reference_number, reconciliation_reference_number,
+                                              invoice_reference_number, notification_url, delivery_information)
+        capture_response = paydirekt_wrapper.call_api(url=self.captures_link, data=capture_data, deadline=deadline)
+        capture_fields = self._get_capture_fields(amount, final, capture_response)
+        if capture_fields:
+            return self._create_with_totals(PaydirektCapture, capture_fields)
+        else:
+            return False
+
+    async def acreate_capture(self,
+                              amount,
+                              paydirekt_wrapper,
+                              note=None,
+                              final=False,
+                              reference_number=None,
+                              reconciliation_reference_number=None,
+                              invoice_reference_number=None,
+                              notification_url=None,
+                              delivery_information=None,
+                              deadline=None,
+                              validate=None):
+        if not self.captures_link:
+            return False
+        if not self._validate_locally('Capture', self._get_capture_error(amount), validate):
+            return False
+        capture_data = self._get_capture_data(amount, note, final, reference_number, reconciliation_reference_number,
+                                              invoice_reference_number, notification_url, delivery_information)
+        capture_response = await paydirekt_wrapper.call_api(url=self.captures_link, data=capture_data, deadline=deadline)
+        capture_fields = self._get_capture_fields(amount, final, capture_response)
+        if capture_fields:
+            return await sync_to_async(self._create_with_totals)(PaydirektCapture, capture_fields)
+        else:
+            return False
+
+    def create_refund(self,
+                       amount,
+                       paydirekt_wrapper,
+                       note=None,
+                       reason=None,
+                       reference_number=None,
+                       reconciliation_reference_number=None,
+                       deadline=None,
+                       validate=None):
+        if not self.refunds_link:
+            return False
+        if not self._validate_locally('Refund', self._get_refund_error(amount), validate):
+            return False
+        refund_data = self._get_refund_data(amount, note, reason, reference_number, reconciliation_reference_number)
+        refund_response = paydirekt_wrapper.call_api(url=self.refunds_link, data=refund_data, deadline=deadline)
+        refund_fields = self._get_refund_fields(amount, refund_response)
+        if refund_fields:
+            return self._create_with_totals(PaydirektRefund, refund_fields)
+        else:
+            return False
+
+    async def acreate_refund(self,
+                             amount,
+                             paydirekt_wrapper,
+                             note=None,
+                             reason=None,
+                             reference_number=None,
+                             reconciliation_reference_number=None,
+                             deadline=None,
+                             validate=None):
+        if not self.refunds_link:
+            return False
+        if not self._validate_locally('Refund', self._get_refund_error(amount), validate):
+            return False
+        refund_data = self._get_refund_data(amount, note, reason, reference_number, reconciliation_reference_number)
+        refund_response = await paydirekt_wrapper.call_api(url=self.refunds_link, data=refund_data, deadline=deadline)
+        refund_fields = self._get_refund_fields(amount, refund_response)
+        if refund_fields:
+            return await sync_to_async(self._create_with_totals)(PaydirektRefund, refund_fields)
+        else:
+            return False
+
+    def close(self, paydirekt_wrapper, deadline=None):
+        if not self.close_link:
+            return False
+        close_response = paydirekt_wrapper.call_api(url=self.close_link, data='', deadline=deadline)
+        if self._update_from_close_response(close_response):
+            self.save()
+            return True
+        return False
+
+    async def aclose(self, paydirekt_wrapper, deadline=None):
+        if not self.close_link:
+            return False
+        close_response = await paydirekt_wrapper.call_api(url=self.close_link, data='', deadline=deadline)
+        if self._update_from_close_response(close_response):
+            await sync_to_async(self.save)()
+            return True
+        return False
+
+    def refresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None, deadline=None):
+        checkout_response = paydirekt_wrapper.call_api(url=self.link, deadline=deadline)
+        if self._update_from_response(checkout_response, expected_status):
+            self.save()
+            return True
+        return False
+
+    async def arefresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None, deadline=None):
+        checkout_response = await paydirekt_wrapper.call_api(url=self.link, deadline=deadline)
+        if self._update_from_response(checkout_response, expected_status):
+            await sync_to_async(self.save)()
+            return True
+        return False
+
+    def _create_with_totals(self, model, fields):
+        """
+            Creates the capture or refund and adds it to the running totals of this checkout.
+        """
+        with transaction.atomic(savepoint=False):
+            paydirekt_object = model.objects.create(**fields)
+            model.objects._update_checkout_totals([paydirekt_object], [{}])
+        for field, value in model.objects._get_checkout_totals(paydirekt_object).items():
+            setattr(self, field, getattr(self, field) + value)
+        return paydirekt_object
+
+    def _validate_locally(self, operation, error, validate=None):
+        """
+            Rejects a capture or refund paydirekt would reject anyway, without a request.
+        """
+        if validate is None:
+            validate = django_paydirekt_settings.PAYDIREKT_LOCAL_VALIDATION
+        if validate and error:
+            logger = logging.getLogger(__name__)
+            logger.error("Paydirekt {0} of {1} rejected: {2}".format(operation, self, error))
+            return False
+        return True
+
+    def _get_capture_error(self, amount, pending_amount=0):
+        """
+            Uses the stored status and totals, captures made elsewhere only make the remaining amount look larger.
+            pending_amount is captured by earlier items of the same bulk capture.
+        """
+        if self.status in CLOSED_CHECKOUT_STATUSES:
+            return 'checkout is {0}'.format(self.status)
+        if self.payment_type == 'DIRECT_SALE':
+            return 'direct sales are captured on approval'
+        amount = Decimal(str(amount))
+        if amount <= 0:
+            return 'amount {0} is not positive'.format(amount)
+        if self.overcapture is not False:
+            # paydirekt allows captures above the total amount, None: unknown
+            return None
+        remaining_amount = Decimal(str(self.total_amount)) - Decimal(str(self.captured_amount)) - pending_amount
+        if amount > remaining_amount:
+            return 'amount {0} is above the remaining {1}'.format(amount, remaining_amount)
+        return None
+
+    def _get_refund_error(self, amount, pending_amount=0):
+        amount = Decimal(str(amount))
+        if amount <= 0:
+            return 'amount {0} is not positive'.format(amount)
+        if self.payment_type == 'DIRECT_SALE':
+            refundable_amount = Decimal(str(self.total_amount)) - Decimal(str(self.refunded_amount)) - pending_amount
+        else:
+            refundable_amount = Decimal(str(self.captured_amount)) - Decimal(str(self.refunded_amount)) - pending_amount
+        if amount > refundable_amount:
+            return 'amount {0} is above the refundable {1}'.format(amount, refundable_amount)
+        return None
+
+    def _get_capture_data(self, amount, note, final, reference_number, reconciliation_reference_number,
+                          invoice_reference_number, notification_url, delivery_information):
         capture_data = {
             'amount': amount,
         }
@@ -55,31 +505,22 @@ class PaydirektCheckout(models.Model):
             capture_data.update({'callbackUrlStatusUpdates': notification_url})
         if delivery_information:
             capture_data.update({'deliveryInformation': delivery_information})
+        return capture_data
 
-        capture_response = paydirekt_wrapper.call_api(url=self.captures_link, data=capture_data)
-
+    def _get_capture_fields(self, amount, final, capture_response):
         if capture_response and 'amount' in capture_response and capture_response['amount'] == float(amount):
-            return PaydirektCapture.objects.create(
-                checkout=self,
-                amount=amount,
-                final=final,
-                transaction_id=capture_response['transactionId'],
-                status=capture_response['status'],
-                link=capture_response['_links']['self']['href'],
-                capture_type=capture_response['type']
-            )
-        else:
-            return False
-
-    def create_refund(self,
-                       amount,
-                       paydirekt_wrapper,
-                       note=None,
-                       reason=None,
-                       reference_number=None,
-                       reconciliation_reference_number=None):
-        if not self.refunds_link:
-            return False
+            return {
+                'checkout': self,
+                'amount': amount,
+                'final': final,
+                'transaction_id': capture_response['transactionId'],
+                'status': capture_response['status'],
+                'link': capture_response['_links']['self']['href'],
+                'capture_type': capture_response['type'],
+            }
+        return None
+
+    def _get_refund_data(self, amount, note, reason, reference_number, reconciliation_reference_number):
         refund_data = {
             'amount': amount,
         }
@@ -91,33 +532,27 @@ class PaydirektCheckout(models.Model):
             refund_data.update({'merchantRefundReferenceNumber': reference_number})
         if reconciliation_reference_number:
             refund_data.update({'merchantReconciliationReferenceNumber': reconciliation_reference_number})
+        return refund_data
 
-        refund_response = paydirekt_wrapper.call_api(url=self.refunds_link, data=refund_data)
-
+    def _get_refund_fields(self, amount, refund_response):
         if refund_response and 'amount' in refund_response and refund_response['amount'] == float(amount):
-            return PaydirektRefund.objects.create(
-                checkout=self,
-                amount=amount,
-                transaction_id=refund_response['transactionId'],
-                status=refund_response['status'],
-                link=refund_response['_links']['self']['href'],
-                refund_type=refund_response['type']
-            )
-        else:
-            return False
-
-    def close(self, paydirekt_wrapper):
-        if not self.close_link:
-            return False
-        close_response = paydirekt_wrapper.call_api(url=self.close_link, data='')
+            return {
+                'checkout': self,
+                'amount': amount,
+                'transaction_id': refund_response['transactionId'],
+                'status': refund_response['status'],
+                'link': refund_response['_links']['self']['href'],
+                'refund_type': refund_response['type'],
+            }
+        return None
+
+    def _update_from_close_response(self, close_response):
         if close_response and 'status' in close_response and close_response['status'] == 'CLOSED':
             self.status = 'CLOSED'
-            self.save()
             return True
         return False
 
-    def refresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None):
-        checkout_response = paydirekt_wrapper.call_api(url=self.link)
+    def _update_from_response(self, checkout_response, expected_status=None):
         if not checkout_response:
             logger = logging.getLogger(__name__)
             logger.error("Paydirekt Checkout Link not available: {}".format(self.link))
@@ -129,6 +564,7 @@ class PaydirektCheckout(models.Model):
             return False
 
         self.status = checkout_response['status']
+        self.status_verified = True
 
         if '_links' in checkout_response:
             if 'close' in checkout_response['_links']:
@@ -137,8 +573,6 @@ class PaydirektCheckout(models.Model):
                 self.captures_link = checkout_response['_links']['captures']['href']
             if 'refunds' in checkout_response['_links']:
                 self.refunds_link = checkout_response['_links']['refunds']['href']
-        self.save()
-
         return True
 
 
@@ -149,12 +583,13 @@ class PaydirektCapture(models.Model):
     final = models.BooleanField(_("final"), default=False)
     link = models.URLField(_("link"))
     status = models.CharField(_("status"), max_length=255, blank=True)
+    status_verified = models.BooleanField(_("status verified"), default=True, db_index=True)
     capture_type = models.CharField(_("capture type"), max_length=255, blank=True)
 
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     last_modified = models.DateTimeField(_("last modified"), auto_now=True)
 
-    objects = models.Manager()
+    objects = PaydirektCaptureManager()
 
     def __str__(self):
         return self.transaction_id
@@ -162,9 +597,33 @@ class PaydirektCapture(models.Model):
     class Meta:
         verbose_name = _("Paydirekt Capture")
         verbose_name_plural = _("Paydirekt Captures")
+        indexes = [
+            # captures by status, also of a single checkout
+            models.Index(fields=['status', 'checkout'], name='paydirekt_capture_status_idx'),
+        ]
+
+    def refresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None, deadline=None):
+        old_totals = type(self).objects._get_checkout_totals(self)
+        capture_response = paydirekt_wrapper.call_api(url=self.link, deadline=deadline)
+        if self._update_from_response(capture_response, expected_status):
+            self._save_with_totals(old_totals)
+            return True
+        return False
 
-    def refresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None):
-        capture_response = paydirekt_wrapper.call_api(url=self.link)
+    async def arefresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None, deadline=None):
+        old_totals = type(self).objects._get_checkout_totals(self)
+        capture_response = await paydirekt_wrapper.call_api(url=self.link, deadline=deadline)
+        if self._update_from_response(capture_response, expected_status):
+            await sync_to_async(self._save_with_totals)(old_totals)
+            return True
+        return False
+
+    def _save_with_totals(self, old_totals):
+        with transaction.atomic(savepoint=False):
+            self.save()
+            type(self).objects._update_checkout_totals([self], [old_totals])
+
+    def _update_from_response(self, capture_response, expected_status=None):
         if not capture_response:
             logger = logging.getLogger(__name__)
             logger.error("Paydirekt Capture Link not available: {}".format(self.link))
@@ -176,8 +635,7 @@ class PaydirektCapture(models.Model):
             return False
 
         self.status = capture_response['status']
-        self.save()
-
+        self.status_verified = True
         return True
 
 
@@ -192,7 +650,7 @@ class PaydirektRefund(models.Model):
     created_at = models.DateTimeField(_("created at"), auto_now_add=True)
     last_modified = models.DateTimeField(_("last modified"), auto_now=True)
 
-    objects = models.Manager()
+    objects = PaydirektRefundManager()
 
     def __str__(self):
         return self.transaction_id
@@ -200,9 +658,33 @@ class PaydirektRefund(models.Model):
     class Meta:
         verbose_name = _("Paydirekt Refund")
         verbose_name_plural = _("Paydirekt Refund")
+        indexes = [
+            # refunds by status, also of a single checkout
+            models.Index(fields=['status', 'checkout'], name='paydirekt_refund_status_idx'),
+        ]
+
+    def refresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None, deadline=None):
+        old_totals = type(self).objects._get_checkout_totals(self)
+        refund_response = paydirekt_wrapper.call_api(url=self.link, deadline=deadline)
+        if self._update_from_response(refund_response, expected_status):
+            self._save_with_totals(old_totals)
+            return True
+        return False
 
-    def refresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None):
-        refund_response = paydirekt_wrapper.call_api(url=self.link)
+    async def arefresh_from_paydirekt(self, paydirekt_wrapper, expected_status=None, deadline=None):
+        old_totals = type(self).objects._get_checkout_totals(self)
+        refund_response = await paydirekt_wrapper.call_api(url=self.link, deadline=deadline)
+        if self._update_from_response(refund_response, expected_status):
+            await sync_to_async(self._save_with_totals)(old_totals)
+            return True
+        return False
+
+    def _save_with_totals(self, old_totals):
+        with transaction.atomic(savepoint=False):
+            self.save()
+            type(self).objects._update_checkout_totals([self], [old_totals])
+
+    def _update_from_response(self, refund_response, expected_status=None):
         if not refund_response:
             logger = logging.getLogger(__name__)
             logger.error("Paydirekt Refund Link not available: {}".format(self.link))
@@ -214,6 +696,204 @@ class PaydirektRefund(models.Model):
             return False
 
         self.status = refund_response['status']
-        self.save()
+        return True
+
 
+class PaydirektTransactionManager(models.Manager):
+
+    def sync(self, paydirekt_wrapper, key='default', from_datetime=None, to_datetime=None, window=timedelta(days=1),
+             max_workers=1, batch_size=500, overlap=timedelta(hours=1)):
+        """
+            Stores the reported transactions since the last sync and moves the high-water mark forward.
+            The last overlap before the high-water mark is fetched again to catch late transactions.
+            Returns the number of fetched transactions.
+        """
+        transaction_sync, created = PaydirektTransactionSync.objects.get_or_create(key=key)
+        if from_datetime is None:
+            if transaction_sync.synced_until:
+                from_datetime = transaction_sync.synced_until - overlap
+            else:
+                from_datetime = timezone.now() - timedelta(days=django_paydirekt_settings.PAYDIREKT_TRANSACTION_SYNC_DAYS)
+        to_datetime = to_datetime or timezone.now()
+
+        transaction_count = 0
+        paydirekt_transactions = []
+        for report_transaction in paydirekt_wrapper.iter_transactions(from_datetime, to_datetime, window=window, max_workers=max_workers):
+            paydirekt_transactions.append(self.model.from_report(report_transaction))
+            transaction_count += 1
+            if len(paydirekt_transactions) >= batch_size:
+                self.bulk_create(paydirekt_transactions, ignore_conflicts=True)
+                paydirekt_transactions = []
+        if paydirekt_transactions:
+            self.bulk_create(paydirekt_transactions, ignore_conflicts=True)
+
+        if not transaction_sync.synced_until or transaction_sync.synced_until < to_datetime:
+            transaction_sync.synced_until = to_datetime
+            transaction_sync.save()
+        return transaction_count
+
+
+class PaydirektTransaction(models.Model):
+    payment_information_id = models.CharField(_("payment information id"), max_length=255, db_index=True)
+    merchant_reference_number = models.CharField(_("merchant reference number"), max_length=255, blank=True, db_index=True)
+    transaction_type = models.CharField(_("transaction type"), max_length=255, blank=True)
+    amount = models.DecimalField(_("amount"), max_digits=9, decimal_places=2, null=True, blank=True)
+    currency = models.CharField(_("currency"), max_length=255, blank=True)
+    timestamp = models.DateTimeField(_("timestamp"), null=True, blank=True, db_index=True)
+    data = models.TextField(_("data"), blank=True)
+
+    created_at = models.DateTimeField(_("created at"), auto_now_add=True)
+
+    objects = PaydirektTransactionManager()
+
+    def __str__(self):
+        return self.payment_information_id
+
+    class Meta:
+        verbose_name = _("Paydirekt Transaction")
+        verbose_name_plural = _("Paydirekt Transactions")
+        unique_together = ('payment_information_id', 'transaction_type')
+
+    @classmethod
+    def from_report(cls, transaction):
+        amount = transaction.get('amount')
+        timestamp = transaction.get('timestamp')
+        return cls(
+            payment_information_id=transaction.get('paymentInformationId', ''),
+            merchant_reference_number=transaction.get('merchantReferenceNumber') or '',
+            transaction_type=transaction.get('transactionType') or '',
+            amount=Decimal(str(amount)) if amount is not None else None,
+            currency=transaction.get('currency') or '',
+            timestamp=parse_datetime(timestamp) if timestamp else None,
+            data=json.dumps(transaction)
+        )
+
+
+class PaydirektTransactionSync(models.Model):
+    key = models.CharField(_("key"), max_length=255, unique=True)
+    synced_until = models.DateTimeField(_("synced until"), null=True, blank=True)
+    last_modified = models.DateTimeField(_("last modified"), auto_now=True)
+
+    objects = models.Manager()
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        verbose_name = _("Paydirekt Transaction Sync")
+        verbose_name_plural = _("Paydirekt Transaction Syncs")
+
+
+class PaydirektNotificationManager(models.Manager):
+
+    def store(self, notification_type, request_data):
+        paydirekt_notification = self.create(
+            notification_type=notification_type,
+            checkout_id=request_data['checkoutId'],
+            transaction_id=request_data.get('transactionId') or '',
+            status=request_data.get('captureStatus') or request_data.get('checkoutStatus') or '',
+            payload=json.dumps(request_data)
+        )
+        if django_paydirekt_settings.PAYDIREKT_NOTIFICATION_INBOX_HOOK:
+            hook = import_string(django_paydirekt_settings.PAYDIREKT_NOTIFICATION_INBOX_HOOK)
+            transaction.on_commit(lambda: hook(paydirekt_notification))
+        return paydirekt_notification
+
+    def process_pending(self, batch_size=100, view_class=None):
+        """
+            Processes a batch of pending notifications with the handlers of the notification view.
+            Returns the number of processed notifications.
+        """
+        view_class = view_class or import_string(django_paydirekt_settings.PAYDIREKT_NOTIFICATION_VIEW)
+        view = view_class()
+        paydirekt_notifications = self._claim_pending(batch_size)
+        for paydirekt_notification in paydirekt_notifications:
+            if paydirekt_notification.process(view):
+                paydirekt_notification.claimed_until = None
+            else:
+                # e.g. paydirekt unavailable, the following batches skip it until the backoff passed
+                backoff = django_paydirekt_settings.PAYDIREKT_NOTIFICATION_RETRY_BACKOFF * 2 ** (paydirekt_notification.attempts - 1)
+                paydirekt_notification.claimed_until = timezone.now() + timedelta(seconds=backoff)
+        if paydirekt_notifications:
+            self.bulk_update(paydirekt_notifications, ['attempts', 'response_status', 'processed_at', 'claimed_until', 'last_modified'])
+        return len(paydirekt_notifications)
+
+    def _claim_pending(self, batch_size):
+        """
+            Claims a batch of pending notifications for PAYDIREKT_NOTIFICATION_CLAIM_TIMEOUT seconds,
+            so other workers skip them while they are processed outside of the transaction.
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            paydirekt_notifications = list(self.select_for_update(skip_locked=True).filter(
+                Q(claimed_until__isnull=True) | Q(claimed_until__lt=now),
+                processed_at__isnull=True,
+                attempts__lt=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_MAX_ATTEMPTS
+            ).order_by('pk')[:batch_size])
+            if paydirekt_notifications:
+                claimed_until = now + timedelta(seconds=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_CLAIM_TIMEOUT)
+                self.filter(pk__in=[paydirekt_notification.pk for paydirekt_notification in paydirekt_notifications]).update(
+                    claimed_until=claimed_until)
+        return paydirekt_notifications
+
+
+class PaydirektNotification(models.Model):
+    notification_type = models.CharField(_("notification type"), max_length=255)
+    checkout_id = models.CharField(_("checkout id"), max_length=255)
+    transaction_id = models.CharField(_("transaction id"), max_length=255, blank=True)
+    status = models.CharField(_("status"), max_length=255, blank=True)
+    payload = models.TextField(_("payload"))
+    attempts = models.PositiveIntegerField(_("attempts"), default=0)
+    response_status = models.PositiveIntegerField(_("response status"), null=True, blank=True)
+    processed_at = models.DateTimeField(_("processed at"), null=True, blank=True, db_index=True)
+    claimed_until = models.DateTimeField(_("claimed until"), null=True, blank=True)
+
+    created_at = models.DateTimeField(_("created at"), auto_now_add=True)
+    last_modified = models.DateTimeField(_("last modified"), auto_now=True)
+
+    objects = PaydirektNotificationManager()
+
+    def __str__(self):
+        return self.checkout_id
+
+    class Meta:
+        verbose_name = _("Paydirekt Notification")
+        verbose_name_plural = _("Paydirekt Notifications")
+
+    def process(self, view):
+        self.attempts += 1
+        self.last_modified = timezone.now()
+        try:
+            # no transaction around the paydirekt calls, the handlers save their changes themselves
+            if asyncio.iscoroutinefunction(view.process_notification):
+                response = async_to_sync(view.process_notification)(json.loads(self.payload), self.notification_type)
+            else:
+                response = view.process_notification(json.loads(self.payload), self.notification_type)
+        except Exception as e:
+            logger = logging.getLogger(__name__)
+            logger.error("Paydirekt Notification {0} failed: {1}".format(self.pk, e))
+            return False
+        self.response_status = response.status_code
+        if response.status_code != 200:
+            # e.g. paydirekt unavailable while refreshing, retried until PAYDIREKT_NOTIFICATION_MAX_ATTEMPTS
+            return False
+        self.processed_at = timezone.now()
+        notification_deduplicator = get_notification_deduplicator()
+        if notification_deduplicator:
+            notification_deduplicator.mark_processed(json.loads(self.payload))
         return True
+
+
+@receiver(post_save, sender=PaydirektCheckout)
+def forget_unknown_checkout_id(sender, instance, created, **kwargs):
+    unknown_id_cache = get_unknown_id_cache()
+    if created and unknown_id_cache:
+        # after the commit, a notification finding no row before would mark the id unknown again
+        transaction.on_commit(lambda: unknown_id_cache.forget('checkout', [instance.checkout_id]))
+
+
+@receiver(post_save, sender=PaydirektCapture)
+def forget_unknown_transaction_id(sender, instance, created, **kwargs):
+    unknown_id_cache = get_unknown_id_cache()
+    if created and unknown_id_cache:
+        transaction.on_commit(lambda: unknown_id_cache.forget('transaction', [instance.transaction_id]))
@@ -15,16 +15,78 @@ PAYDIREKT_CHECKOUTS_URL = getattr(settings, 'PAYDIREKT_CHECKOUTS_URL', '/api/che
 PAYDIREKT_TOKEN_OBTAIN_URL = getattr(settings, 'PAYDIREKT_TOKEN_OBTAIN_URL', '/api/merchantintegration/v1/token/obtain')
 PAYDIREKT_TRANSACTION_URL = getattr(settings, 'PAYDIREKT_TRANSACTION_URL', '/api/reporting/v1/reports/transactions')
 
+# connections
+PAYDIREKT_CONNECTION_POOL = getattr(settings, 'PAYDIREKT_CONNECTION_POOL', True)
+PAYDIREKT_CONNECTION_POOL_MAXSIZE = getattr(settings, 'PAYDIREKT_CONNECTION_POOL_MAXSIZE', 10)
+
+# timeouts in seconds per operation: token obtain, checkout creation, capture, refund and close, refresh and transaction reports
+PAYDIREKT_TIMEOUTS = dict({
+    'token': 10,
+    'checkout': 20,
+    'capture': 20,
+    'refresh': 10,
+    'reporting': 60,
+}, **getattr(settings, 'PAYDIREKT_TIMEOUTS', {}))
+
+# retries and circuit breaker
+PAYDIREKT_RETRIES = getattr(settings, 'PAYDIREKT_RETRIES', 2)
+PAYDIREKT_RETRY_BACKOFF = getattr(settings, 'PAYDIREKT_RETRY_BACKOFF', 0.5)
+PAYDIREKT_RETRY_BACKOFF_MAX = getattr(settings, 'PAYDIREKT_RETRY_BACKOFF_MAX', 10)
+PAYDIREKT_RETRY_STATUS = getattr(settings, 'PAYDIREKT_RETRY_STATUS', [429, 500, 502, 503, 504])
+PAYDIREKT_RETRY_UNSAFE_STATUS = getattr(settings, 'PAYDIREKT_RETRY_UNSAFE_STATUS', [429, 503])
+# consecutive upstream failures opening the circuit breaker, None to disable it
+PAYDIREKT_CIRCUIT_BREAKER_THRESHOLD = getattr(settings, 'PAYDIREKT_CIRCUIT_BREAKER_THRESHOLD', None)
+PAYDIREKT_CIRCUIT_BREAKER_TIMEOUT = getattr(settings, 'PAYDIREKT_CIRCUIT_BREAKER_TIMEOUT', 30)
+
+# concurrency of bulk operations
+PAYDIREKT_MAX_WORKERS = getattr(settings, 'PAYDIREKT_MAX_WORKERS', 10)
+
+# days fetched by the first transaction sync
+PAYDIREKT_TRANSACTION_SYNC_DAYS = getattr(settings, 'PAYDIREKT_TRANSACTION_SYNC_DAYS', 30)
+
+# access tokens
+PAYDIREKT_TOKEN_CACHE = getattr(settings, 'PAYDIREKT_TOKEN_CACHE', True)
+PAYDIREKT_TOKEN_REFRESH_AHEAD = getattr(settings, 'PAYDIREKT_TOKEN_REFRESH_AHEAD', 60)
+PAYDIREKT_TOKEN_CACHE_ALIAS = getattr(settings, 'PAYDIREKT_TOKEN_CACHE_ALIAS', None)
+PAYDIREKT_TOKEN_LEASE_TIMEOUT = getattr(settings, 'PAYDIREKT_TOKEN_LEASE_TIMEOUT', 30)
+
+# reject captures and refunds above the stored totals or on closed checkouts without a request
+PAYDIREKT_LOCAL_VALIDATION = getattr(settings, 'PAYDIREKT_LOCAL_VALIDATION', True)
+
 PAYDIREKT_VALID_CAPTURE_STATUS = getattr(settings, 'PAYDIREKT_VALID_CAPTURE_STATUS', ['PENDING', 'SUCCESSFUL', 'REJECTED'])
 PAYDIREKT_VALID_CHECKOUT_STATUS = getattr(settings, 'PAYDIREKT_VALID_CHECKOUT_STATUS', ['OPEN', 'PENDING', 'APPROVED', 'REJECTED', 'CANCELED', 'CLOSED', 'EXPIRED'])
 PAYDIREKT_VALID_REFUND_STATUS = getattr(settings, 'PAYDIREKT_VALID_REFUND_STATUS', ['PENDING', 'SUCCESSFUL', 'ERROR', 'FAILED'])
 
-PAYDIREKT_SHIPPING_OPTIONS = [{
+PAYDIREKT_SHIPPING_OPTIONS = getattr(settings, 'PAYDIREKT_SHIPPING_OPTIONS', [{
     'code': 'DHL_PAKET',
     'name': 'DHL Paket',
     'description': 'Lieferung innerhalb von 1-3 Werktagen',
     'amount': 6.99
-}]
+}])
+
+# dotted path of the JSON codec for request and response bodies, default: orjson if installed, else json
+PAYDIREKT_JSON_CODEC = getattr(settings, 'PAYDIREKT_JSON_CODEC', None)
+
+# notification inbox
+PAYDIREKT_NOTIFICATION_INBOX = getattr(settings, 'PAYDIREKT_NOTIFICATION_INBOX', False)
+PAYDIREKT_NOTIFICATION_INBOX_HOOK = getattr(settings, 'PAYDIREKT_NOTIFICATION_INBOX_HOOK', None)
+PAYDIREKT_NOTIFICATION_VIEW = getattr(settings, 'PAYDIREKT_NOTIFICATION_VIEW', 'django_paydirekt.views.NotifyPaydirektView')
+PAYDIREKT_NOTIFICATION_MAX_ATTEMPTS = getattr(settings, 'PAYDIREKT_NOTIFICATION_MAX_ATTEMPTS', 5)
+# seconds before a failed notification is retried, doubled with every further attempt
+PAYDIREKT_NOTIFICATION_RETRY_BACKOFF = getattr(settings, 'PAYDIREKT_NOTIFICATION_RETRY_BACKOFF', 60)
+# seconds a worker may take for a batch before other workers pick up its notifications again
+PAYDIREKT_NOTIFICATION_CLAIM_TIMEOUT = getattr(settings, 'PAYDIREKT_NOTIFICATION_CLAIM_TIMEOUT', 5 * 60)
+
+# apply notified statuses without asking paydirekt, run paydirekt_verify_statuses to check them later
+PAYDIREKT_NOTIFICATION_TRUST_STATUS = getattr(settings, 'PAYDIREKT_NOTIFICATION_TRUST_STATUS', False)
+
+# skip redelivered notifications, remembered in one of your CACHES for the given seconds
+PAYDIREKT_NOTIFICATION_DEDUP_CACHE_ALIAS = getattr(settings, 'PAYDIREKT_NOTIFICATION_DEDUP_CACHE_ALIAS', None)
+PAYDIREKT_NOTIFICATION_DEDUP_TIMEOUT = getattr(settings, 'PAYDIREKT_NOTIFICATION_DEDUP_TIMEOUT', 24 * 60 * 60)
+
+# reject notifications for unknown checkout and transaction ids without a query, remembered for the given seconds
+PAYDIREKT_UNKNOWN_ID_CACHE_ALIAS = getattr(settings, 'PAYDIREKT_UNKNOWN_ID_CACHE_ALIAS', None)
+PAYDIREKT_UNKNOWN_ID_CACHE_TIMEOUT = getattr(settings, 'PAYDIREKT_UNKNOWN_ID_CACHE_TIMEOUT', 5 * 60)
 
 # checkout urls
 PAYDIREKT_SUCCESS_URL = getattr(settings, 'PAYDIREKT_SUCCESS_URL', '/')
@@ -34,8 +96,11 @@ PAYDIREKT_NOTIFICATION_URL = getattr(settings, 'PAYDIREKT_NOTIFICATION_URL', '/p
 
 # express
 PAYDIREKT_VALID_COUNTRY_CODES = getattr(settings, 'PAYDIREKT_VALID_COUNTRY_CODES', ['DE'])
-PAYDIREKT_VALID_ZIP_CODES = getattr(settings, 'PAYDIREKT_VALID_COUNTRY_CODES', ['*'])
+PAYDIREKT_VALID_ZIP_CODES = getattr(settings, 'PAYDIREKT_VALID_ZIP_CODES', ['*'])
 PAYDIREKT_VALID_PACKSTATION = getattr(settings, 'PAYDIREKT_VALID_PACKSTATION', True)
+# list of rules with country_codes, zip_codes, packstation and shipping_options, default: one rule of the settings above
+PAYDIREKT_DESTINATION_RULES = getattr(settings, 'PAYDIREKT_DESTINATION_RULES', None)
+PAYDIREKT_DESTINATION_CACHE_SIZE = getattr(settings, 'PAYDIREKT_DESTINATION_CACHE_SIZE', 4096)
 PAYDIREKT_SHIPPING_TERMS_URL = getattr(settings, 'PAYDIREKT_SHIPPING_TERMS_URL', '/')
 
 if getattr(settings, 'PAYDIREKT', False):
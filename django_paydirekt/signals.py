@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# sent after every paydirekt API call with the arguments
+# endpoint, method, url, status, duration, request_size, response_size, token_cache ('hit', 'miss' or None) and attempt
+paydirekt_api_called = Signal()
+
+# sent after every notification with the arguments branch, status and duration
+paydirekt_notification_handled = Signal()
@@ -0,0 +1,399 @@
+import asyncio
+import base64
+import certifi
+import email.parser
+import http.client
+import io
+import select
+import socket
+import ssl
+import threading
+import time
+import weakref
+
+from django_paydirekt import settings as django_paydirekt_settings
+
+from urllib.error import HTTPError
+from urllib.parse import unquote, urlsplit
+from urllib.request import getproxies, proxy_bypass, urlopen as urllib_urlopen
+
+RECONNECT_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError)
+ASYNC_RECONNECT_ERRORS = RECONNECT_ERRORS + (asyncio.IncompleteReadError,)
+# sent again on a new connection if the reused one failed, other requests may have reached paydirekt
+RESEND_METHODS = ('GET', 'HEAD')
+
+_ssl_context = None
+_ssl_context_lock = threading.Lock()
+
+
+def get_ssl_context():
+    global _ssl_context
+    with _ssl_context_lock:
+        if _ssl_context is None:
+            _ssl_context = ssl.create_default_context(cafile=certifi.where())
+    return _ssl_context
+
+
+def get_proxy(url):
+    """
+        Returns the proxy for url from the HTTP(S)_PROXY environment variables, None for a direct connection.
+    """
+    split_url = urlsplit(url)
+    proxy = getproxies().get(split_url.scheme)
+    if not proxy or proxy_bypass(split_url.hostname):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://{0}'.format(proxy)
+    return proxy
+
+
+def get_proxy_headers(proxy):
+    split_proxy = urlsplit(proxy)
+    if split_proxy.username is None:
+        return {}
+    credentials = '{0}:{1}'.format(unquote(split_proxy.username), unquote(split_proxy.password or ''))
+    return {'Proxy-Authorization': 'Basic {0}'.format(base64.b64encode(credentials.encode('utf-8')).decode('ascii'))}
+
+
+class PaydirektResponse(object):
+    """
+        Fully read response, so the connection can go back to the pool right away.
+    """
+
+    def __init__(self, url, status, reason, headers, body):
+        super(PaydirektResponse, self).__init__()
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.fp = io.BytesIO(body)
+
+    def read(self, *args):
+        return self.fp.read(*args)
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def close(self):
+        self.fp.close()
+
+
+class PaydirektHTTPSConnection(http.client.HTTPSConnection):
+    tls_session = None
+
+    def connect(self):
+        # same as HTTPSConnection.connect, but resumes the last TLS session of the pool
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname, session=self.tls_session)
+
+
+class PaydirektConnectionPool(object):
+    """
+        Keep-alive connections per host, shared by all wrappers of a process.
+        At most maxsize connections per host are open at the same time.
+    """
+    maxsize = django_paydirekt_settings.PAYDIREKT_CONNECTION_POOL_MAXSIZE
+
+    def __init__(self, maxsize=None, ssl_context=None):
+        super(PaydirektConnectionPool, self).__init__()
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self.ssl_context = ssl_context
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def urlopen(self, request, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        url = request.full_url
+        host = self._get_host(url)
+        body = request.data
+        headers = dict(request.header_items())
+        split_url = urlsplit(url)
+        path = split_url.path or '/'
+        if split_url.query:
+            path = '{0}?{1}'.format(path, split_url.query)
+        if host['proxy'] and host['scheme'] != 'https':
+            # plain http is forwarded by the proxy, https is tunneled through it
+            path = url
+            headers.update(get_proxy_headers(host['proxy']))
+
+        timeout = self._acquire(host, timeout)
+        try:
+            connection, reused = self._get_connection(host, timeout)
+            try:
+                try:
+                    response = self._request(connection, request.get_method(), path, body, headers)
+                except RECONNECT_ERRORS:
+                    # the server closed the idle keep-alive connection
+                    connection.close()
+                    if not reused or request.get_method() not in RESEND_METHODS:
+                        raise
+                    connection = self._new_connection(host, timeout)
+                    response = self._request(connection, request.get_method(), path, body, headers)
+                response_body = response.read()
+            except Exception:
+                connection.close()
+                raise
+            self._release_connection(host, connection, response)
+        finally:
+            host['semaphore'].release()
+
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason, response.msg, io.BytesIO(response_body))
+        return PaydirektResponse(url, response.status, response.reason, response.msg, response_body)
+
+    def clear(self):
+        with self._lock:
+            hosts = list(self._hosts.values())
+            self._hosts = {}
+        for host in hosts:
+            for connection in host['connections']:
+                connection.close()
+
+    def _acquire(self, host, timeout):
+        """
+            Waits for a free connection slot of the host, returns what is left of the timeout.
+        """
+        if timeout is None or timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+            host['semaphore'].acquire()
+            return timeout
+        start = time.monotonic()
+        if not host['semaphore'].acquire(timeout=timeout):
+            raise socket.timeout('timed out waiting for a connection to {0}'.format(host['hostname']))
+        remaining = timeout - (time.monotonic() - start)
+        if remaining <= 0:
+            host['semaphore'].release()
+            raise socket.timeout('timed out waiting for a connection to {0}'.format(host['hostname']))
+        return remaining
+
+    def _request(self, connection, method, path, body, headers):
+        connection.request(method, path, body=body, headers=headers)
+        return connection.getresponse()
+
+    def _get_host(self, url):
+        split_url = urlsplit(url)
+        key = (split_url.scheme, split_url.hostname, split_url.port)
+        with self._lock:
+            if key not in self._hosts:
+                self._hosts[key] = {
+                    'scheme': split_url.scheme,
+                    'hostname': split_url.hostname,
+                    'port': split_url.port,
+                    'proxy': get_proxy(url),
+                    'connections': [],
+                    'tls_session': None,
+                    'semaphore': threading.BoundedSemaphore(self.maxsize),
+                }
+            return self._hosts[key]
+
+    def _get_connection(self, host, timeout):
+        while True:
+            with self._lock:
+                connection = host['connections'].pop() if host['connections'] else None
+            if connection is None:
+                return self._new_connection(host, timeout), False
+            if connection.sock is None or self._is_dropped(connection.sock):
+                connection.close()
+                continue
+            connection.timeout = timeout
+            connection.sock.settimeout(None if timeout is socket._GLOBAL_DEFAULT_TIMEOUT else timeout)
+            return connection, True
+
+    def _is_dropped(self, sock):
+        # an idle keep-alive connection is only readable if the server closed it
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def _new_connection(self, host, timeout):
+        hostname, port = host['hostname'], host['port']
+        if host['proxy']:
+            split_proxy = urlsplit(host['proxy'])
+            hostname, port = split_proxy.hostname, split_proxy.port
+        if host['scheme'] == 'https':
+            connection = PaydirektHTTPSConnection(hostname, port, timeout=timeout, context=self.ssl_context or get_ssl_context())
+            connection.tls_session = host['tls_session']
+            if host['proxy']:
+                connection.set_tunnel(host['hostname'], host['port'], headers=get_proxy_headers(host['proxy']))
+            return connection
+        return http.client.HTTPConnection(hostname, port, timeout=timeout)
+
+    def _release_connection(self, host, connection, response):
+        if response.will_close or connection.sock is None:
+            connection.close()
+            return
+        if isinstance(connection.sock, ssl.SSLSocket) and connection.sock.session is not None:
+            host['tls_session'] = connection.sock.session
+        with self._lock:
+            host['connections'].append(connection)
+
+
+paydirekt_connection_pool = PaydirektConnectionPool()
+
+
+def urlopen(request, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    if django_paydirekt_settings.PAYDIREKT_CONNECTION_POOL:
+        return paydirekt_connection_pool.urlopen(request, timeout=timeout)
+    return urllib_urlopen(request, timeout=timeout, context=get_ssl_context())
+
+
+class AsyncPaydirektConnectionPool(object):
+    """
+        asyncio counterpart of PaydirektConnectionPool, connections are kept per event loop.
+    """
+    maxsize = django_paydirekt_settings.PAYDIREKT_CONNECTION_POOL_MAXSIZE
+
+    def __init__(self, maxsize=None, ssl_context=None):
+        super(AsyncPaydirektConnectionPool, self).__init__()
+        if maxsize is not None:
+            self.maxsize = maxsize
+        self.ssl_context = ssl_context
+        self._loops = weakref.WeakKeyDictionary()
+
+    async def urlopen(self, request, timeout=None):
+        if timeout is None:
+            return await self._urlopen(request)
+        return await asyncio.wait_for(self._urlopen(request), timeout)
+
+    def clear(self):
+        for hosts in list(self._loops.values()):
+            for host in hosts.values():
+                for reader, writer in host['connections']:
+                    writer.close()
+        self._loops = weakref.WeakKeyDictionary()
+
+    async def _urlopen(self, request):
+        url = request.full_url
+        host = self._get_host(url)
+        split_url = urlsplit(url)
+        path = split_url.path or '/'
+        if split_url.query:
+            path = '{0}?{1}'.format(path, split_url.query)
+        request_bytes = self._get_request_bytes(request, split_url.netloc, path)
+
+        async with host['semaphore']:
+            connection, reused = await self._get_connection(host)
+            try:
+                try:
+                    status, reason, headers, body, will_close = await self._request(connection, request_bytes, request.get_method())
+                except ASYNC_RECONNECT_ERRORS:
+                    # the server closed the idle keep-alive connection
+                    connection[1].close()
+                    if not reused or request.get_method() not in RESEND_METHODS:
+                        raise
+                    connection = await self._new_connection(host)
+                    status, reason, headers, body, will_close = await self._request(connection, request_bytes, request.get_method())
+            except BaseException:
+                connection[1].close()
+                raise
+            if will_close:
+                connection[1].close()
+            else:
+                host['connections'].append(connection)
+
+        if status >= 400:
+            raise HTTPError(url, status, reason, headers, io.BytesIO(body))
+        return PaydirektResponse(url, status, reason, headers, body)
+
+    def _get_request_bytes(self, request, netloc, path):
+        headers = dict((name.lower(), (name, value)) for name, value in request.header_items())
+        headers.setdefault('host', ('Host', netloc))
+        if request.data is not None:
+            headers.setdefault('content-length', ('Content-Length', len(request.data)))
+        lines = ['{0} {1} HTTP/1.1'.format(request.get_method(), path)]
+        lines.extend('{0}: {1}'.format(name, value) for name, value in headers.values())
+        request_bytes = '{0}\r\n\r\n'.format('\r\n'.join(lines)).encode('latin-1')
+        if request.data:
+            request_bytes += request.data
+        return request_bytes
+
+    async def _request(self, connection, request_bytes, method):
+        reader, writer = connection
+        writer.write(request_bytes)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected('Remote end closed connection without response')
+        status_line = status_line.decode('latin-1').rstrip('\r\n').split(' ', 2)
+        if len(status_line) < 2 or not status_line[0].startswith('HTTP/'):
+            raise http.client.BadStatusLine(' '.join(status_line))
+        version, status = status_line[0], int(status_line[1])
+        reason = status_line[2] if len(status_line) > 2 else ''
+
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line.decode('iso-8859-1'))
+        headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(''.join(header_lines))
+
+        connection_header = (headers.get('Connection') or '').lower()
+        will_close = connection_header == 'close' or (version == 'HTTP/1.0' and connection_header != 'keep-alive')
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            body = b''
+        elif 'chunked' in (headers.get('Transfer-Encoding') or '').lower():
+            body = await self._read_chunked(reader)
+        elif headers.get('Content-Length') is not None:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            body = await reader.read()
+            will_close = True
+        return status, reason, headers, body, will_close
+
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # skip trailers
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    def _get_host(self, url):
+        split_url = urlsplit(url)
+        key = (split_url.scheme, split_url.hostname, split_url.port)
+        hosts = self._loops.setdefault(asyncio.get_event_loop(), {})
+        if key not in hosts:
+            hosts[key] = {
+                'scheme': split_url.scheme,
+                'hostname': split_url.hostname,
+                'port': split_url.port or (443 if split_url.scheme == 'https' else 80),
+                'connections': [],
+                'semaphore': asyncio.Semaphore(self.maxsize),
+            }
+        return hosts[key]
+
+    async def _get_connection(self, host):
+        while host['connections']:
+            connection = host['connections'].pop()
+            if not connection[0].at_eof():
+                return connection, True
+            connection[1].close()
+        return await self._new_connection(host), False
+
+    async def _new_connection(self, host):
+        if host['scheme'] == 'https':
+            return await asyncio.open_connection(host['hostname'], host['port'],
+                                                 ssl=self.ssl_context or get_ssl_context(),
+                                                 server_hostname=host['hostname'])
+        return await asyncio.open_connection(host['hostname'], host['port'])
+
+
+async_paydirekt_connection_pool = AsyncPaydirektConnectionPool()
+
+
+async def async_urlopen(request, timeout=None):
+    # behind a proxy the calls go through the threaded connection pool
+    if django_paydirekt_settings.PAYDIREKT_CONNECTION_POOL and not get_proxy(request.full_url):
+        return await async_paydirekt_connection_pool.urlopen(request, timeout=timeout)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, urlopen, request, timeout or socket._GLOBAL_DEFAULT_TIMEOUT)
@@ -1,7 +1,336 @@
+import asyncio
+import email.utils
+import json
+import logging
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from urllib.parse import urlsplit
+
 from django_paydirekt import settings as django_paydirekt_settings
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def build_paydirekt_full_uri(url):
     if url.startswith('/'):
         url = '{0}{1}'.format(django_paydirekt_settings.PAYDIREKT_ROOT_URL, url)
     return url
+
+
+ENDPOINT_LABELS = (
+    (re.compile(r'/token/obtain$'), 'token_obtain'),
+    (re.compile(r'/reports/transactions$'), 'transactions'),
+    (re.compile(r'/checkouts/?$'), 'checkout_create'),
+    (re.compile(r'/checkouts/[^/]+/captures/?$'), 'capture_create'),
+    (re.compile(r'/checkouts/[^/]+/captures/[^/]+/?$'), 'capture'),
+    (re.compile(r'/checkouts/[^/]+/refunds/?$'), 'refund_create'),
+    (re.compile(r'/checkouts/[^/]+/refunds/[^/]+/?$'), 'refund'),
+    (re.compile(r'/checkouts/[^/]+/close/?$'), 'close'),
+    (re.compile(r'/checkouts/[^/]+/?$'), 'checkout'),
+)
+
+
+def get_endpoint_label(url):
+    path = urlsplit(url).path
+    for pattern, label in ENDPOINT_LABELS:
+        if pattern.search(path):
+            return label
+    return 'other'
+
+
+class PaydirektJSONCodec(object):
+    """
+        Encodes to and decodes from UTF-8 bytes with the standard library.
+    """
+
+    def dumps(self, data):
+        return json.dumps(data, default=self._default).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def _default(self, value):
+        # amounts are often passed straight from DecimalFields
+        if isinstance(value, Decimal):
+            return float(value)
+        raise TypeError('Object of type {0} is not JSON serializable'.format(type(value).__name__))
+
+
+class PaydirektOrjsonCodec(PaydirektJSONCodec):
+    """
+        Encodes to and decodes from UTF-8 bytes with orjson.
+    """
+
+    def dumps(self, data):
+        return orjson.dumps(data, default=self._default)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+_json_codec = None
+
+
+def get_json_codec():
+    global _json_codec
+    if _json_codec is None:
+        if django_paydirekt_settings.PAYDIREKT_JSON_CODEC:
+            _json_codec = import_string(django_paydirekt_settings.PAYDIREKT_JSON_CODEC)()
+        elif orjson is not None:
+            _json_codec = PaydirektOrjsonCodec()
+        else:
+            _json_codec = PaydirektJSONCodec()
+    return _json_codec
+
+
+class PaydirektRateLimiter(object):
+    """
+        Allows at most rate calls per second, shared by all threads using it.
+    """
+
+    def __init__(self, rate):
+        super(PaydirektRateLimiter, self).__init__()
+        self.interval = 1.0 / rate
+        self._next_call = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _reserve(self):
+        """
+            Reserves the next call slot, returns the seconds to wait for it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next_call - now
+            self._next_call = max(self._next_call, now) + self.interval
+        return wait
+
+
+def call_api_many(paydirekt_wrapper, requests, max_workers=None, rate_limiter=None, deadline=None):
+    """
+        Calls the (url, data) requests concurrently, returns the responses in the same order, False for failed ones.
+    """
+    def call_api(request):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            return paydirekt_wrapper.call_api(url=request[0], data=request[1], deadline=deadline)
+        except Exception as e:
+            logger = logging.getLogger(__name__)
+            logger.error("Paydirekt Error calling {0}: {1}".format(request[0], e))
+            return False
+
+    with ThreadPoolExecutor(max_workers=max_workers or django_paydirekt_settings.PAYDIREKT_MAX_WORKERS) as executor:
+        return list(executor.map(call_api, requests))
+
+
+async def acall_api_many(paydirekt_wrapper, requests, max_workers=None, rate_limiter=None, deadline=None):
+    """
+        asyncio counterpart of call_api_many for an AsyncPaydirektWrapper, max_workers bounds the concurrent calls.
+    """
+    semaphore = asyncio.Semaphore(max_workers or django_paydirekt_settings.PAYDIREKT_MAX_WORKERS)
+
+    async def call_api(request):
+        async with semaphore:
+            if rate_limiter:
+                await rate_limiter.aacquire()
+            try:
+                return await paydirekt_wrapper.call_api(url=request[0], data=request[1], deadline=deadline)
+            except Exception as e:
+                logger = logging.getLogger(__name__)
+                logger.error("Paydirekt Error calling {0}: {1}".format(request[0], e))
+                return False
+
+    return list(await asyncio.gather(*[call_api(request) for request in requests]))
+
+
+class PaydirektBulkResult(object):
+    """
+        Outcome of one item of a bulk operation, the saved object or the reason it failed.
+    """
+
+    def __init__(self, item, paydirekt_object=None, error=None):
+        super(PaydirektBulkResult, self).__init__()
+        self.item = item
+        self.paydirekt_object = paydirekt_object
+        self.error = error
+
+    def __bool__(self):
+        return self.paydirekt_object is not None and not self.error
+
+    def __repr__(self):
+        return '<PaydirektBulkResult: {0}>'.format(self.error or self.paydirekt_object)
+
+
+class PaydirektNotificationDeduplicator(object):
+    """
+        Remembers successfully processed notifications by checkout id, transaction id and status,
+        so redelivered notifications can be answered without calling paydirekt again.
+    """
+    timeout = django_paydirekt_settings.PAYDIREKT_NOTIFICATION_DEDUP_TIMEOUT
+
+    def __init__(self, cache_alias='default', timeout=None):
+        super(PaydirektNotificationDeduplicator, self).__init__()
+        self.cache_alias = cache_alias
+        if timeout is not None:
+            self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def is_duplicate(self, request_data):
+        return self.cache.get(self.get_key(request_data)) is not None
+
+    def mark_processed(self, request_data):
+        self.cache.set(self.get_key(request_data), True, self.timeout)
+
+    def get_key(self, request_data):
+        status = request_data.get('captureStatus') or request_data.get('checkoutStatus') or ''
+        return 'django_paydirekt:notification:{0}:{1}:{2}'.format(
+            request_data.get('checkoutId') or '', request_data.get('transactionId') or '', status)
+
+
+def get_notification_deduplicator():
+    if not django_paydirekt_settings.PAYDIREKT_NOTIFICATION_DEDUP_CACHE_ALIAS:
+        return None
+    return PaydirektNotificationDeduplicator(cache_alias=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_DEDUP_CACHE_ALIAS)
+
+
+class PaydirektUnknownIdCache(object):
+    """
+        Remembers checkout ids and capture transaction ids that are not in the database,
+        so notifications for them can be rejected without a query.
+    """
+    timeout = django_paydirekt_settings.PAYDIREKT_UNKNOWN_ID_CACHE_TIMEOUT
+
+    def __init__(self, cache_alias='default', timeout=None):
+        super(PaydirektUnknownIdCache, self).__init__()
+        self.cache_alias = cache_alias
+        if timeout is not None:
+            self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def is_unknown(self, request_data):
+        keys = [self.get_key('checkout', request_data['checkoutId'])]
+        if request_data.get('transactionId'):
+            keys.append(self.get_key('transaction', request_data['transactionId']))
+        return bool(self.cache.get_many(keys))
+
+    def mark_unknown(self, kind, value):
+        self.cache.set(self.get_key(kind, value), True, self.timeout)
+
+    def forget(self, kind, values):
+        self.cache.delete_many([self.get_key(kind, value) for value in values])
+
+    def get_key(self, kind, value):
+        return 'django_paydirekt:unknown:{0}:{1}'.format(kind, value)
+
+
+def get_unknown_id_cache():
+    if not django_paydirekt_settings.PAYDIREKT_UNKNOWN_ID_CACHE_ALIAS:
+        return None
+    return PaydirektUnknownIdCache(cache_alias=django_paydirekt_settings.PAYDIREKT_UNKNOWN_ID_CACHE_ALIAS)
+
+
+def get_retry_after(headers):
+    """
+        Returns the seconds to wait from a Retry-After header, given as seconds or HTTP date.
+    """
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class PaydirektCircuitBreaker(object):
+    """
+        Opens after threshold consecutive upstream failures and rejects calls for timeout seconds,
+        then lets a single trial call through which closes it again on success.
+    """
+    TRIAL = 'trial'
+
+    def __init__(self, threshold, timeout):
+        super(PaydirektCircuitBreaker, self).__init__()
+        self.threshold = threshold
+        self.timeout = timeout
+        self.failure_count = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+            Returns TRIAL for the trial call, which must be ended with end_trial whatever its outcome.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return self.TRIAL
+
+    def end_trial(self):
+        # a trial without recorded success or failure, e.g. cancelled, lets the next call try again
+        with self._lock:
+            self._trial_running = False
+
+    def record_success(self):
+        with self._lock:
+            self.failure_count = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failure_count += 1
+            if self._trial_running or self.failure_count >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(key):
+    if not django_paydirekt_settings.PAYDIREKT_CIRCUIT_BREAKER_THRESHOLD:
+        return None
+    with _circuit_breakers_lock:
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = PaydirektCircuitBreaker(django_paydirekt_settings.PAYDIREKT_CIRCUIT_BREAKER_THRESHOLD,
+                                                             django_paydirekt_settings.PAYDIREKT_CIRCUIT_BREAKER_TIMEOUT)
+        return _circuit_breakers[key]
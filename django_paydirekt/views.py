@@ -1,78 +1,125 @@
-import json
+import asyncio
+import time
 
+from asgiref.sync import sync_to_async
 from django.http import HttpResponse
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 
-from .wrappers import PaydirektWrapper
-from .models import PaydirektCapture, PaydirektCheckout
+from .destinations import PaydirektDestinationRules
+from .wrappers import AsyncPaydirektWrapper, PaydirektWrapper
+from .models import PaydirektCapture, PaydirektCheckout, PaydirektNotification
+from .signals import paydirekt_notification_handled
+from .utils import get_json_codec, get_notification_deduplicator, get_unknown_id_cache
 from django_paydirekt import settings as django_paydirekt_settings
 
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
 
 class NotifyPaydirektView(View):
     paydirekt_wrapper = PaydirektWrapper(auth={
         'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
         'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
     })
+    destination_rules = PaydirektDestinationRules.from_settings()
 
     def post(self, request, *args, **kwargs):
-        request_data = json.loads(request.body.decode('utf-8'))
+        start = time.perf_counter()
+        branch, response = self._handle_notification(request)
+        self._send_notification_handled(branch, response, start)
+        return response
 
-        # general attributes
-        if 'checkoutId' not in request_data:
-            return HttpResponse(status=400)
-        checkout_id = request_data['checkoutId']
+    def _handle_notification(self, request):
+        request_data = get_json_codec().loads(request.body)
+        notification_type = self.get_notification_type(request_data)
+        if not notification_type:
+            return 'invalid', HttpResponse(status=400)
+        unknown_id_cache = get_unknown_id_cache()
+        if unknown_id_cache and unknown_id_cache.is_unknown(request_data):
+            return 'unknown', HttpResponse(status=400)
+        if notification_type == 'destinations':
+            return notification_type, self.process_notification(request_data, notification_type, request)
 
-        if 'merchantOrderReferenceNumber' not in request_data:
-            return HttpResponse(status=400)
-        reference_number = request_data['merchantOrderReferenceNumber']
+        # redelivered status updates were already handled
+        notification_deduplicator = get_notification_deduplicator()
+        if notification_deduplicator and notification_deduplicator.is_duplicate(request_data):
+            return 'duplicate', HttpResponse(status=200)
+
+        # status updates are processed later, express checkouts need an answer right away
+        if django_paydirekt_settings.PAYDIREKT_NOTIFICATION_INBOX:
+            PaydirektNotification.objects.store(notification_type, request_data)
+            return 'inbox', HttpResponse(status=200)
+        response = self.process_notification(request_data, notification_type, request)
+        if notification_deduplicator and response.status_code == 200:
+            notification_deduplicator.mark_processed(request_data)
+        return notification_type, response
+
+    def process_notification(self, request_data, notification_type, request=None):
+        checkout_id = request_data['checkoutId']
 
         # capture attributes
-        if 'transactionId' in request_data:
-            transaction_id = request_data['transactionId']
-            if 'captureStatus' not in request_data:
-                return HttpResponse(status=400)
-            capture_status = request_data['captureStatus']
+        if notification_type == 'capture':
             try:
                 PaydirektCheckout.objects.get(checkout_id=checkout_id)
             except PaydirektCheckout.DoesNotExist:
-                return HttpResponse(status=400)
+                return self._reject_unknown_id('checkout', checkout_id)
             try:
-                paydirekt_capture = PaydirektCapture.objects.get(transaction_id=transaction_id)
+                paydirekt_capture = PaydirektCapture.objects.get(transaction_id=request_data['transactionId'])
             except PaydirektCapture.DoesNotExist:
-                return HttpResponse(status=400)
-            return self.handle_updated_capture(paydirekt_capture=paydirekt_capture, expected_status=capture_status)
+                return self._reject_unknown_id('transaction', request_data['transactionId'])
+            return self.handle_updated_capture(paydirekt_capture=paydirekt_capture, expected_status=request_data['captureStatus'])
+
+        try:
+            paydirekt_checkout = PaydirektCheckout.objects.get(checkout_id=checkout_id)
+        except PaydirektCheckout.DoesNotExist:
+            return self._reject_unknown_id('checkout', checkout_id)
+
+        # express checkout attributes
+        if notification_type == 'destinations':
+            return self.check_destinations(paydirekt_checkout, request_data, request)
+
+        # normal checkout attributes
+        return self.handle_updated_checkout(paydirekt_checkout=paydirekt_checkout, expected_status=request_data['checkoutStatus'])
+
+    def get_notification_type(self, request_data):
+        # general attributes
+        if 'checkoutId' not in request_data:
+            return None
+        if 'merchantOrderReferenceNumber' not in request_data:
+            return None
+
+        # capture attributes
+        if 'transactionId' in request_data:
+            if 'captureStatus' not in request_data:
+                return None
+            return 'capture'
 
         # express checkout attributes
         elif 'destinations' in request_data:
             if 'orderAmount' not in request_data:
-                return HttpResponse(status=400)
+                return None
             for destination in request_data['destinations']:
                 if 'id' not in destination:
-                    return HttpResponse(status=400)
+                    return None
                 if 'countryCode' not in destination:
-                    return HttpResponse(status=400)
+                    return None
                 if 'zip' not in destination:
-                    return HttpResponse(status=400)
+                    return None
                 if 'dhlPackstation' not in destination:
-                    return HttpResponse(status=400)
-            try:
-                paydirekt_checkout = PaydirektCheckout.objects.get(checkout_id=checkout_id)
-            except PaydirektCheckout.DoesNotExist:
-                return HttpResponse(status=400)
-            self.check_destinations(paydirekt_checkout, request_data, request)
+                    return None
+            return 'destinations'
 
         # normal checkout attributes
         else:
             if 'checkoutStatus' not in request_data:
-                return HttpResponse(status=400)
-            checkout_status = request_data['checkoutStatus']
-            try:
-                paydirekt_checkout = PaydirektCheckout.objects.get(checkout_id=checkout_id)
-            except PaydirektCheckout.DoesNotExist:
-                return HttpResponse(status=400)
-            return self.handle_updated_checkout(paydirekt_checkout=paydirekt_checkout, expected_status=checkout_status)
+                return None
+            return 'checkout'
 
     @csrf_exempt
     def dispatch(self, request, *args, **kwargs):
@@ -85,44 +132,24 @@ class NotifyPaydirektView(View):
         links = {'self': {'href': request.path}}
         checked_destinations = []
         for destination in request_data['destinations']:
-            id = destination['id']
-            country_code = destination['countryCode']
-            zip = destination['zip']
-            dhl_packstation = destination['dhlPackstation']
-
-            zip_valid = False
-            for zip_code in django_paydirekt_settings.PAYDIREKT_VALID_ZIP_CODES:
-                if '*' in zip_code:
-                    if zip.startsWith(zip_code.split('*')[0]):
-                        zip_valid = True
-                else:
-                    if zip == zip_code:
-                        zip_valid = True
-            if country_code in django_paydirekt_settings.PAYDIREKT_VALID_COUNTRY_CODES and zip_valid and \
-               (not dhl_packstation or django_paydirekt_settings.PAYDIREKT_VALID_PACKSTATION):
-                if dhl_packstation:
-                    valid_billing_destination = False
-                else:
-                    valid_billing_destination = True
-                valid_shipping_destination = True
-                shipping_options = django_paydirekt_settings.PAYDIREKT_SHIPPING_OPTIONS
-            else:
-                valid_billing_destination = False
-                valid_shipping_destination = False
-                shipping_options = []
-            checked_destinations.append({'id': id,
-                                         'countryCode': country_code,
-                                         'zip': zip,
-                                         'dhl_packstation': dhl_packstation,
+            valid_billing_destination, valid_shipping_destination, shipping_options = self.destination_rules.check(
+                destination['countryCode'], destination['zip'], bool(destination['dhlPackstation']))
+            checked_destinations.append({'id': destination['id'],
+                                         'countryCode': destination['countryCode'],
+                                         'zip': destination['zip'],
+                                         'dhl_packstation': destination['dhlPackstation'],
                                          'validBillingDestination': valid_billing_destination,
                                          'validShippingDestination': valid_shipping_destination,
                                          'shippingOptions': shipping_options})
-        return HttpResponse({'checkedDestinations': checked_destinations, '_links': links}, status=200, content_type='application/hal+json;charset=UTF-8')
+        return HttpResponse(get_json_codec().dumps({'checkedDestinations': checked_destinations, '_links': links}), status=200,
+                            content_type='application/hal+json;charset=UTF-8')
 
     def handle_updated_checkout(self, paydirekt_checkout, expected_status=None):
         """
             Override to use the paydirekt_checkout in the way you want.
         """
+        if django_paydirekt_settings.PAYDIREKT_NOTIFICATION_TRUST_STATUS:
+            return self._apply_notified_status(paydirekt_checkout, expected_status, django_paydirekt_settings.PAYDIREKT_VALID_CHECKOUT_STATUS)
         updated_checkout = paydirekt_checkout
         if updated_checkout.refresh_from_paydirekt(self.paydirekt_wrapper, expected_status=expected_status):
             if updated_checkout.status not in django_paydirekt_settings.PAYDIREKT_VALID_CHECKOUT_STATUS:
@@ -137,6 +164,8 @@ class NotifyPaydirektView(View):
         """
             Override to use the paydirekt_capture in the way you want.
         """
+        if django_paydirekt_settings.PAYDIREKT_NOTIFICATION_TRUST_STATUS:
+            return self._apply_notified_status(paydirekt_capture, expected_status, django_paydirekt_settings.PAYDIREKT_VALID_CAPTURE_STATUS)
         updated_capture = paydirekt_capture
         if updated_capture.refresh_from_paydirekt(self.paydirekt_wrapper, expected_status=expected_status):
             if updated_capture.status not in django_paydirekt_settings.PAYDIREKT_VALID_CAPTURE_STATUS:
@@ -146,3 +175,142 @@ class NotifyPaydirektView(View):
                 return HttpResponse(status=400)
             return HttpResponse(status=200)
         return HttpResponse(status=400)
+
+    def _apply_notified_status(self, paydirekt_object, status, valid_statuses):
+        type(paydirekt_object).objects.apply_notified_status(paydirekt_object, status)
+        if status not in valid_statuses:
+            import logging
+            logger = logging.getLogger(__name__)
+            logger.error(_('Paydirekt: Status of {} is now {}').format(paydirekt_object, status))
+            return HttpResponse(status=400)
+        return HttpResponse(status=200)
+
+    def _send_notification_handled(self, branch, response, start):
+        if not paydirekt_notification_handled.has_listeners(type(self)):
+            return
+        paydirekt_notification_handled.send(sender=type(self), branch=branch, status=response.status_code,
+                                            duration=time.perf_counter() - start)
+
+    def _reject_unknown_id(self, kind, value):
+        unknown_id_cache = get_unknown_id_cache()
+        if unknown_id_cache:
+            unknown_id_cache.mark_unknown(kind, value)
+        return HttpResponse(status=400)
+
+
+class AsyncNotifyPaydirektView(NotifyPaydirektView):
+    """
+        Notification view for ASGI deployments, the override hooks are coroutines here.
+    """
+    paydirekt_wrapper = AsyncPaydirektWrapper(auth={
+        'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+        'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+    })
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super(AsyncNotifyPaydirektView, cls).as_view(**initkwargs)
+        return markcoroutinefunction(view)
+
+    async def post(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        branch, response = await self._handle_notification(request)
+        self._send_notification_handled(branch, response, start)
+        return response
+
+    async def _handle_notification(self, request):
+        request_data = get_json_codec().loads(request.body)
+        notification_type = self.get_notification_type(request_data)
+        if not notification_type:
+            return 'invalid', HttpResponse(status=400)
+        unknown_id_cache = get_unknown_id_cache()
+        if unknown_id_cache and await sync_to_async(unknown_id_cache.is_unknown)(request_data):
+            return 'unknown', HttpResponse(status=400)
+        if notification_type == 'destinations':
+            return notification_type, await self.process_notification(request_data, notification_type, request)
+
+        # redelivered status updates were already handled
+        notification_deduplicator = get_notification_deduplicator()
+        if notification_deduplicator and await sync_to_async(notification_deduplicator.is_duplicate)(request_data):
+            return 'duplicate', HttpResponse(status=200)
+
+        # status updates are processed later, express checkouts need an answer right away
+        if django_paydirekt_settings.PAYDIREKT_NOTIFICATION_INBOX:
+            await sync_to_async(PaydirektNotification.objects.store)(notification_type, request_data)
+            return 'inbox', HttpResponse(status=200)
+        response = await self.process_notification(request_data, notification_type, request)
+        if notification_deduplicator and response.status_code == 200:
+            await sync_to_async(notification_deduplicator.mark_processed)(request_data)
+        return notification_type, response
+
+    async def process_notification(self, request_data, notification_type, request=None):
+        checkout_id = request_data['checkoutId']
+
+        # capture attributes
+        if notification_type == 'capture':
+            if not await sync_to_async(PaydirektCheckout.objects.filter(checkout_id=checkout_id).exists)():
+                return await sync_to_async(self._reject_unknown_id)('checkout', checkout_id)
+            try:
+                paydirekt_capture = await sync_to_async(PaydirektCapture.objects.get)(transaction_id=request_data['transactionId'])
+            except PaydirektCapture.DoesNotExist:
+                return await sync_to_async(self._reject_unknown_id)('transaction', request_data['transactionId'])
+            return await self.handle_updated_capture(paydirekt_capture=paydirekt_capture, expected_status=request_data['captureStatus'])
+
+        try:
+            paydirekt_checkout = await sync_to_async(PaydirektCheckout.objects.get)(checkout_id=checkout_id)
+        except PaydirektCheckout.DoesNotExist:
+            return await sync_to_async(self._reject_unknown_id)('checkout', checkout_id)
+
+        # express checkout attributes
+        if notification_type == 'destinations':
+            return await self.check_destinations(paydirekt_checkout, request_data, request)
+
+        # normal checkout attributes
+        return await self.handle_updated_checkout(paydirekt_checkout=paydirekt_checkout, expected_status=request_data['checkoutStatus'])
+
+    @csrf_exempt
+    async def dispatch(self, request, *args, **kwargs):
+        response = super(AsyncNotifyPaydirektView, self).dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    async def check_destinations(self, paydirekt_checkout, request_data, request):
+        """
+            Override to check destinations in the way you want.
+        """
+        return super(AsyncNotifyPaydirektView, self).check_destinations(paydirekt_checkout, request_data, request)
+
+    async def handle_updated_checkout(self, paydirekt_checkout, expected_status=None):
+        """
+            Override to use the paydirekt_checkout in the way you want.
+        """
+        if django_paydirekt_settings.PAYDIREKT_NOTIFICATION_TRUST_STATUS:
+            return await sync_to_async(self._apply_notified_status)(paydirekt_checkout, expected_status,
+                                                                    django_paydirekt_settings.PAYDIREKT_VALID_CHECKOUT_STATUS)
+        updated_checkout = paydirekt_checkout
+        if await updated_checkout.arefresh_from_paydirekt(self.paydirekt_wrapper, expected_status=expected_status):
+            if updated_checkout.status not in django_paydirekt_settings.PAYDIREKT_VALID_CHECKOUT_STATUS:
+                import logging
+                logger = logging.getLogger(__name__)
+                logger.error(_('Paydirekt: Status of checkout {} is now {}').format(updated_checkout.checkout_id, updated_checkout.status))
+                return HttpResponse(status=400)
+            return HttpResponse(status=200)
+        return HttpResponse(status=400)
+
+    async def handle_updated_capture(self, paydirekt_capture, expected_status=None):
+        """
+            Override to use the paydirekt_capture in the way you want.
+        """
+        if django_paydirekt_settings.PAYDIREKT_NOTIFICATION_TRUST_STATUS:
+            return await sync_to_async(self._apply_notified_status)(paydirekt_capture, expected_status,
+                                                                    django_paydirekt_settings.PAYDIREKT_VALID_CAPTURE_STATUS)
+        updated_capture = paydirekt_capture
+        if await updated_capture.arefresh_from_paydirekt(self.paydirekt_wrapper, expected_status=expected_status):
+            if updated_capture.status not in django_paydirekt_settings.PAYDIREKT_VALID_CAPTURE_STATUS:
+                import logging
+                logger = logging.getLogger(__name__)
+                logger.error(_('Paydirekt: Status of capture {} is now {}').format(updated_capture.transaction_id, updated_capture.status))
+                return HttpResponse(status=400)
+            return HttpResponse(status=200)
+        return HttpResponse(status=400)
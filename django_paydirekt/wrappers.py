@@ -1,26 +1,290 @@
+import asyncio
 import base64
-import certifi
+import collections
 import hashlib
 import hmac
-import json
+import http.client
+import inspect
 import logging
 import random
 import string
-import sys
+import threading
 import time
 import uuid
+import weakref
+
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
 
 from django_paydirekt import settings as django_paydirekt_settings
 from django_paydirekt.models import PaydirektCheckout
-from django_paydirekt.utils import build_paydirekt_full_uri
+from django_paydirekt.signals import paydirekt_api_called
+from django_paydirekt.transport import async_urlopen, urlopen
+from django_paydirekt.utils import PaydirektBulkResult, PaydirektCircuitBreaker, acall_api_many, build_paydirekt_full_uri, call_api_many, get_circuit_breaker, get_endpoint_label, get_json_codec, get_retry_after, get_unknown_id_cache
 
-from urllib.error import HTTPError
-from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
 from urllib.request import Request
 
 
+UPSTREAM_ERRORS = (OSError, http.client.HTTPException)
+
+# PAYDIREKT_TIMEOUTS key per endpoint, every other call refreshes an object
+TIMEOUT_OPERATIONS = {
+    'token_obtain': 'token',
+    'checkout_create': 'checkout',
+    'capture_create': 'capture',
+    'refund_create': 'capture',
+    'close': 'capture',
+    'transactions': 'reporting',
+}
+
+
+class PaydirektTransactionsError(Exception):
+    pass
+
+
+class PaydirektCircuitOpenError(URLError):
+    pass
+
+
+class PaydirektDeadlineExceeded(URLError):
+    pass
+
+
+def get_remaining_time(deadline, description):
+    """
+        Returns the seconds left until the time.monotonic() deadline, None without deadline.
+    """
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise PaydirektDeadlineExceeded('Paydirekt deadline exceeded {0}'.format(description))
+    return remaining
+
+
+class PaydirektTokenStore(object):
+    """
+        In-process access token cache, shared by all wrappers using the same API key and API url.
+        Tokens are refreshed ahead of expiry by a single thread while the others keep using the current one.
+    """
+    refresh_ahead = django_paydirekt_settings.PAYDIREKT_TOKEN_REFRESH_AHEAD
+
+    def __init__(self, refresh_ahead=None):
+        super(PaydirektTokenStore, self).__init__()
+        if refresh_ahead is not None:
+            self.refresh_ahead = refresh_ahead
+        self._tokens = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._async_locks = weakref.WeakKeyDictionary()
+
+    def get_token(self, key, obtain_token, deadline=None):
+        token = self._tokens.get(key)
+        if token and time.time() < token['refresh_at']:
+            return token['access_token']
+
+        lock = self._get_lock(key)
+        if token and time.time() < token['expires_at']:
+            # someone else is already refreshing, the current token is still valid
+            if not lock.acquire(False):
+                return token['access_token']
+        else:
+            remaining = get_remaining_time(deadline, 'waiting for the access token')
+            if not lock.acquire(timeout=-1 if remaining is None else remaining):
+                raise PaydirektDeadlineExceeded('Paydirekt deadline exceeded waiting for the access token')
+        try:
+            token = self._tokens.get(key)
+            if token and time.time() < token['refresh_at']:
+                return token['access_token']
+            new_token = self._refresh_token(key, obtain_token, deadline)
+            if new_token:
+                self._tokens[key] = new_token
+                return new_token['access_token']
+            if token and time.time() < token['expires_at']:
+                return token['access_token']
+            return None
+        finally:
+            lock.release()
+
+    async def aget_token(self, key, obtain_token, deadline=None):
+        token = self._tokens.get(key)
+        if token and time.time() < token['refresh_at']:
+            return token['access_token']
+
+        lock = self._get_async_lock(key)
+        if token and time.time() < token['expires_at'] and lock.locked():
+            # someone else is already refreshing, the current token is still valid
+            return token['access_token']
+        try:
+            await asyncio.wait_for(lock.acquire(), get_remaining_time(deadline, 'waiting for the access token'))
+        except asyncio.TimeoutError:
+            raise PaydirektDeadlineExceeded('Paydirekt deadline exceeded waiting for the access token')
+        try:
+            token = self._tokens.get(key)
+            if token and time.time() < token['refresh_at']:
+                return token['access_token']
+            new_token = await self._arefresh_token(key, obtain_token, deadline)
+            if new_token:
+                self._tokens[key] = new_token
+                return new_token['access_token']
+            if token and time.time() < token['expires_at']:
+                return token['access_token']
+            return None
+        finally:
+            lock.release()
+
+    def set_token(self, key, token_response):
+        self._tokens[key] = self._build_token(token_response)
+
+    def invalidate(self, key):
+        self._tokens.pop(key, None)
+
+    def clear(self):
+        self._tokens.clear()
+
+    def _refresh_token(self, key, obtain_token, deadline=None):
+        token_response = obtain_token()
+        if not token_response or 'access_token' not in token_response:
+            return None
+        return self._build_token(token_response)
+
+    async def _arefresh_token(self, key, obtain_token, deadline=None):
+        token_response = await obtain_token()
+        if not token_response or 'access_token' not in token_response:
+            return None
+        return self._build_token(token_response)
+
+    def _build_token(self, token_response):
+        now = time.time()
+        expires_in = token_response.get('expires_in', 0)
+        return {
+            'access_token': token_response['access_token'],
+            'expires_at': now + expires_in,
+            'refresh_at': now + expires_in - min(self.refresh_ahead, expires_in / 2.0),
+        }
+
+    def _get_lock(self, key):
+        with self._locks_lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _get_async_lock(self, key):
+        locks = self._async_locks.setdefault(asyncio.get_event_loop(), {})
+        if key not in locks:
+            locks[key] = asyncio.Lock()
+        return locks[key]
+
+
+class PaydirektCacheTokenStore(PaydirektTokenStore):
+    """
+        Token store sharing access tokens between processes through Django's cache framework.
+        A lease in the cache makes sure only one process obtains a new token, the others keep using the current one.
+    """
+    lease_timeout = django_paydirekt_settings.PAYDIREKT_TOKEN_LEASE_TIMEOUT
+    lease_poll_interval = 0.1
+
+    def __init__(self, cache_alias='default', refresh_ahead=None, lease_timeout=None):
+        super(PaydirektCacheTokenStore, self).__init__(refresh_ahead=refresh_ahead)
+        self.cache_alias = cache_alias
+        if lease_timeout is not None:
+            self.lease_timeout = lease_timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def set_token(self, key, token_response):
+        token = self._build_token(token_response)
+        self._tokens[key] = token
+        self._set_shared_token(key, token)
+
+    def invalidate(self, key):
+        super(PaydirektCacheTokenStore, self).invalidate(key)
+        self.cache.delete(key)
+
+    def _refresh_token(self, key, obtain_token, deadline=None):
+        lease_key = '{0}:lease'.format(key)
+        lease_deadline = time.time() + self.lease_timeout
+        while True:
+            token = self.cache.get(key)
+            if token and time.time() < token['refresh_at']:
+                return token
+            if self.cache.add(lease_key, True, self.lease_timeout):
+                try:
+                    # the token may have been refreshed right before we got the lease
+                    token = self.cache.get(key)
+                    if token and time.time() < token['refresh_at']:
+                        return token
+                    token = super(PaydirektCacheTokenStore, self)._refresh_token(key, obtain_token)
+                    if token:
+                        self._set_shared_token(key, token)
+                    return token
+                finally:
+                    self.cache.delete(lease_key)
+            if token and time.time() < token['expires_at']:
+                # another process is refreshing, keep using the current token
+                return token
+            if time.time() >= lease_deadline:
+                return super(PaydirektCacheTokenStore, self)._refresh_token(key, obtain_token)
+            get_remaining_time(deadline, 'waiting for the access token lease')
+            time.sleep(self.lease_poll_interval)
+
+    async def _arefresh_token(self, key, obtain_token, deadline=None):
+        cache_get = sync_to_async(self.cache.get, thread_sensitive=False)
+        cache_add = sync_to_async(self.cache.add, thread_sensitive=False)
+        cache_delete = sync_to_async(self.cache.delete, thread_sensitive=False)
+        lease_key = '{0}:lease'.format(key)
+        lease_deadline = time.time() + self.lease_timeout
+        while True:
+            token = await cache_get(key)
+            if token and time.time() < token['refresh_at']:
+                return token
+            if await cache_add(lease_key, True, self.lease_timeout):
+                try:
+                    token = await cache_get(key)
+                    if token and time.time() < token['refresh_at']:
+                        return token
+                    token = await super(PaydirektCacheTokenStore, self)._arefresh_token(key, obtain_token)
+                    if token:
+                        await sync_to_async(self._set_shared_token, thread_sensitive=False)(key, token)
+                    return token
+                finally:
+                    await cache_delete(lease_key)
+            if token and time.time() < token['expires_at']:
+                return token
+            if time.time() >= lease_deadline:
+                return await super(PaydirektCacheTokenStore, self)._arefresh_token(key, obtain_token)
+            get_remaining_time(deadline, 'waiting for the access token lease')
+            await asyncio.sleep(self.lease_poll_interval)
+
+    def _set_shared_token(self, key, token):
+        self.cache.set(key, token, max(int(token['expires_at'] - time.time()), 1))
+
+
+paydirekt_token_store = None
+_token_store_lock = threading.Lock()
+
+
+def get_default_token_store():
+    global paydirekt_token_store
+    if not django_paydirekt_settings.PAYDIREKT_TOKEN_CACHE:
+        return None
+    with _token_store_lock:
+        if paydirekt_token_store is None:
+            if django_paydirekt_settings.PAYDIREKT_TOKEN_CACHE_ALIAS:
+                paydirekt_token_store = PaydirektCacheTokenStore(cache_alias=django_paydirekt_settings.PAYDIREKT_TOKEN_CACHE_ALIAS)
+            else:
+                paydirekt_token_store = PaydirektTokenStore()
+    return paydirekt_token_store
+
 
 class PaydirektWrapper(object):
     interface_version = 'django_paydirekt_v{}'.format(django_paydirekt_settings.DJANGO_PAYDIREKT_VERSION)
@@ -31,10 +295,19 @@ class PaydirektWrapper(object):
     token_obtain_url = django_paydirekt_settings.PAYDIREKT_TOKEN_OBTAIN_URL
     transactions_url = django_paydirekt_settings.PAYDIREKT_TRANSACTION_URL
 
+    retries = django_paydirekt_settings.PAYDIREKT_RETRIES
+    retry_backoff = django_paydirekt_settings.PAYDIREKT_RETRY_BACKOFF
+    retry_backoff_max = django_paydirekt_settings.PAYDIREKT_RETRY_BACKOFF_MAX
+    retry_status = django_paydirekt_settings.PAYDIREKT_RETRY_STATUS
+    retry_unsafe_status = django_paydirekt_settings.PAYDIREKT_RETRY_UNSAFE_STATUS
+    timeouts = django_paydirekt_settings.PAYDIREKT_TIMEOUTS
+
     auth = None
+    token_store = None
 
-    def __init__(self, auth=None, sandbox=None):
+    def __init__(self, auth=None, sandbox=None, token_store=None):
         super(PaydirektWrapper, self).__init__()
+        self.token_store = token_store if token_store is not None else get_default_token_store()
         if getattr(settings, 'PAYDIREKT', False):
             self.auth = auth
             if sandbox is not None:
@@ -44,34 +317,240 @@ class PaydirektWrapper(object):
                 if django_paydirekt_settings.PAYDIREKT_SANDBOX:
                     self.api_url = self.sandbox_url
 
-    def init(self, total_amount, reference_number, payment_type, currency_code='EUR',
-             success_url=django_paydirekt_settings.PAYDIREKT_SUCCESS_URL,
-             cancellation_url=django_paydirekt_settings.PAYDIREKT_CANCELLATION_URL,
-             rejection_url=django_paydirekt_settings.PAYDIREKT_REJECTION_URL,
-             notification_url=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_URL,
-             overcapture=False,
-             email_address=None,
-             note=None,
-             shipping_amount=None,
-             order_amount=None,
-             shopping_cart_type=None,
-             delivery_information=None,
-             delivery_type=None,
-             shipping_address=None,
-             invoice_reference_number=None,
-             reconciliation_reference_number=None,
-             minimum_age=None,
-             minimum_age_fail_url=None,
-             items=None,
-             customer_number=None,
-             express=False,
-             shipping_terms_url=django_paydirekt_settings.PAYDIREKT_SHIPPING_TERMS_URL,
-             check_destinations_url=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_URL
-        ):
+    def init(self, total_amount, reference_number, payment_type, *args, **kwargs):
+        if not self.auth:
+            return False
+        deadline = kwargs.pop('deadline', None)
+        checkout_data = self._get_checkout_data(total_amount, reference_number, payment_type, *args, **kwargs)
+        if not checkout_data:
+            return False
+        checkout_response = self.call_api(url=self.checkouts_url, data=checkout_data, deadline=deadline)
+        checkout_fields = self._get_checkout_fields(checkout_data, checkout_response)
+        if checkout_fields:
+            return PaydirektCheckout.objects.create(**checkout_fields)
+        return False
+
+    def init_many(self, checkouts, max_workers=None, batch_size=None, rate_limiter=None, deadline=None):
+        """
+            Creates the checkouts, given as dicts of init arguments, concurrently and inserts them with one bulk_create.
+            Returns a PaydirektBulkResult per dict in the given order.
+        """
+        if not self.auth:
+            return False
+        results, pending_checkouts = self._get_pending_checkouts(checkouts)
+        checkout_responses = call_api_many(self, [(self.checkouts_url, checkout_data) for result, checkout_data in pending_checkouts],
+                                           max_workers=max_workers, rate_limiter=rate_limiter, deadline=deadline)
+        self._create_checkouts(pending_checkouts, checkout_responses, batch_size=batch_size)
+        return results
+
+    def transactions(self, *args, **kwargs):
+        if not self.auth:
+            return False
+        deadline = kwargs.pop('deadline', None)
+        transactions_filters = self._get_transactions_filters(*args, **kwargs)
+        transactions_response = self.call_api(self.transactions_url, data=transactions_filters, deadline=deadline)
+        if transactions_response and 'transactions' in transactions_response:
+            return transactions_response['transactions']
+        return False
+
+    def iter_transactions(self, from_datetime, to_datetime, window=timedelta(days=1), max_workers=1, **kwargs):
+        """
+            Yields the transactions between from_datetime and to_datetime, fetched in windows of the given size.
+            Up to max_workers windows are fetched concurrently, the transactions are yielded in order.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending_windows = collections.deque()
+            for window_from, window_to in self._get_transaction_windows(from_datetime, to_datetime, window):
+                pending_windows.append((window_from, window_to, executor.submit(self.transactions, window_from, window_to, **kwargs)))
+                if len(pending_windows) >= max_workers:
+                    window_from, window_to, future = pending_windows.popleft()
+                    for report_transaction in self._get_window_transactions(window_from, window_to, future.result()):
+                        yield report_transaction
+            while pending_windows:
+                window_from, window_to, future = pending_windows.popleft()
+                for report_transaction in self._get_window_transactions(window_from, window_to, future.result()):
+                    yield report_transaction
 
+    def call_api(self, url=None, access_token=None, data=None, deadline=None):
         if not self.auth:
             return False
+        cached_access_token = access_token is None
+        token_cache = None
+        if cached_access_token:
+            access_token, token_cache = self._get_access_token_and_cache_status(deadline)
+        request = self._get_api_request(url, access_token, data)
+        try:
+            response_body = self._urlopen(request, token_cache, deadline)
+        except HTTPError as e:
+            self._handle_http_error(e, cached_access_token)
+        else:
+            return get_json_codec().loads(response_body)
+        return False
+
+    def _get_access_token(self):
+        return self._get_access_token_and_cache_status()[0]
+
+    def _get_access_token_and_cache_status(self, deadline=None):
+        if self.token_store:
+            obtained = []
 
+            def obtain_access_token():
+                obtained.append(True)
+                return self._obtain_access_token(deadline)
+
+            access_token = self.token_store.get_token(self._get_token_store_key(), obtain_access_token, deadline)
+            return access_token, 'miss' if obtained else 'hit'
+        token_response = self._obtain_access_token(deadline)
+        if token_response and 'access_token' in token_response:
+            return token_response['access_token'], None
+        return None, None
+
+    def _obtain_access_token(self, deadline=None):
+        try:
+            # signed again for each attempt, paydirekt rejects a request id, nonce and timestamp seen before
+            response_body = self._urlopen(self._get_token_request(), deadline=deadline, build_request=self._get_token_request)
+        except HTTPError as e:
+            self._handle_http_error(e)
+        else:
+            return get_json_codec().loads(response_body)
+
+    def _urlopen(self, request, token_cache=None, deadline=None, build_request=None):
+        """
+            Sends the request and returns the response body, retrying failed attempts until the time.monotonic() deadline.
+            Retries send a new request from build_request if given.
+        """
+        idempotent = self._is_idempotent(request)
+        circuit_breaker = get_circuit_breaker(self.api_url)
+        attempt = 0
+        while True:
+            timeout = self._get_timeout(request, deadline)
+            permit = circuit_breaker.allow() if circuit_breaker else True
+            if not permit:
+                raise PaydirektCircuitOpenError('Paydirekt API {0} unavailable'.format(self.api_url))
+            try:
+                try:
+                    response_body = self._urlopen_once(request, token_cache, attempt, timeout)
+                except UPSTREAM_ERRORS as e:
+                    retry_delay = self._handle_upstream_error(request, e, circuit_breaker, attempt, idempotent, deadline)
+                    if retry_delay is None:
+                        raise
+                else:
+                    if circuit_breaker:
+                        circuit_breaker.record_success()
+                    return response_body
+            finally:
+                if permit == PaydirektCircuitBreaker.TRIAL:
+                    circuit_breaker.end_trial()
+            time.sleep(retry_delay)
+            attempt += 1
+            if build_request:
+                request = build_request()
+
+    def _urlopen_once(self, request, token_cache, attempt, timeout):
+        start = time.perf_counter()
+        status = None
+        response_body = None
+        try:
+            response = urlopen(request, timeout=timeout)
+            status = getattr(response, 'status', None)
+            response_body = response.read()
+        except HTTPError as e:
+            status = e.code
+            raise
+        finally:
+            self._send_api_called(request, status, start, response_body, token_cache, attempt)
+        return response_body
+
+    def _get_timeout(self, request, deadline):
+        timeout = self.timeouts.get(TIMEOUT_OPERATIONS.get(get_endpoint_label(request.full_url), 'refresh'))
+        remaining = get_remaining_time(deadline, 'before calling {0}'.format(request.full_url))
+        if remaining is not None and (timeout is None or remaining < timeout):
+            return remaining
+        return timeout
+
+    def _is_idempotent(self, request):
+        """
+            GET requests, token obtains and transaction reports can be sent again safely.
+        """
+        if request.get_method() == 'GET':
+            return True
+        path = urlsplit(request.full_url).path
+        return path in (urlsplit(self.token_obtain_url).path, urlsplit(self.transactions_url).path)
+
+    def _handle_upstream_error(self, request, e, circuit_breaker, attempt, idempotent, deadline):
+        """
+            Records the failed attempt and returns the seconds to wait before the next one, None to give up.
+        """
+        upstream_failure = not isinstance(e, HTTPError) or e.code >= 500 or e.code == 429
+        if circuit_breaker:
+            if upstream_failure:
+                circuit_breaker.record_failure()
+            else:
+                circuit_breaker.record_success()
+        if not upstream_failure or attempt >= self.retries:
+            return None
+
+        retry_after = None
+        if isinstance(e, HTTPError):
+            if e.code not in (self.retry_status if idempotent else self.retry_unsafe_status):
+                return None
+            retry_after = get_retry_after(e.headers)
+        elif not idempotent and not isinstance(e, ConnectionRefusedError):
+            # the request may have reached paydirekt
+            return None
+        if retry_after is None:
+            retry_after = random.uniform(0, min(self.retry_backoff_max, self.retry_backoff * 2 ** attempt))
+        elif retry_after > self.retry_backoff_max:
+            return None
+        if deadline is not None and time.monotonic() + retry_after >= deadline:
+            return None
+
+        logger = logging.getLogger(__name__)
+        logger.warning("Paydirekt Error calling {0}, retrying in {1:.2f}s: {2}".format(request.full_url, retry_after, e))
+        if isinstance(e, HTTPError):
+            e.close()
+        return retry_after
+
+    def _send_api_called(self, request, status, start, response_body, token_cache, attempt=0):
+        if not paydirekt_api_called.has_listeners(type(self)):
+            return
+        paydirekt_api_called.send(
+            sender=type(self),
+            endpoint=get_endpoint_label(request.full_url),
+            method=request.get_method(),
+            url=request.full_url,
+            status=status,
+            duration=time.perf_counter() - start,
+            request_size=len(request.data or b''),
+            response_size=len(response_body) if response_body is not None else None,
+            token_cache=token_cache,
+            attempt=attempt,
+        )
+
+    def _get_checkout_data(self, total_amount, reference_number, payment_type, currency_code='EUR',
+                           success_url=django_paydirekt_settings.PAYDIREKT_SUCCESS_URL,
+                           cancellation_url=django_paydirekt_settings.PAYDIREKT_CANCELLATION_URL,
+                           rejection_url=django_paydirekt_settings.PAYDIREKT_REJECTION_URL,
+                           notification_url=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_URL,
+                           overcapture=False,
+                           email_address=None,
+                           note=None,
+                           shipping_amount=None,
+                           order_amount=None,
+                           shopping_cart_type=None,
+                           delivery_information=None,
+                           delivery_type=None,
+                           shipping_address=None,
+                           invoice_reference_number=None,
+                           reconciliation_reference_number=None,
+                           minimum_age=None,
+                           minimum_age_fail_url=None,
+                           items=None,
+                           customer_number=None,
+                           express=False,
+                           shipping_terms_url=django_paydirekt_settings.PAYDIREKT_SHIPPING_TERMS_URL,
+                           check_destinations_url=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_URL
+        ):
         if payment_type not in ('DIRECT_SALE', 'ORDER'):
             return False
 
@@ -134,38 +613,71 @@ class PaydirektWrapper(object):
             sha256_hashed_email_address = base64.b64encode(sha256_hashed_email_address.digest())
             checkout_data.update({'sha256hashedEmailAddress': str(sha256_hashed_email_address)})
 
-        checkout_response = self.call_api(url=self.checkouts_url, data=checkout_data)
+        return checkout_data
+
+    def _get_checkout_fields(self, checkout_data, checkout_response):
         if checkout_response and 'totalAmount' in checkout_response and checkout_response['totalAmount'] == float(
-                total_amount):
-            checkout_id = checkout_response['checkoutId']
-            status = checkout_response['status']
-            approve_link = checkout_response['_links']['approve']['href']
-            link = checkout_response['_links']['self']['href']
-            return PaydirektCheckout.objects.create(
-                payment_type=payment_type,
-                total_amount=total_amount,
-                checkout_id=checkout_id,
-                status=status,
-                approve_link=approve_link,
-                link=link
-            )
-        return False
+                checkout_data['totalAmount']):
+            return {
+                'payment_type': checkout_data['type'],
+                'total_amount': checkout_data['totalAmount'],
+                'overcapture': checkout_data['overcapture'],
+                'checkout_id': checkout_response['checkoutId'],
+                'status': checkout_response['status'],
+                'approve_link': checkout_response['_links']['approve']['href'],
+                'link': checkout_response['_links']['self']['href'],
+            }
+        return None
 
-    def transactions(self,
-                     from_datetime=None,
-                     to_datetime=None,
-                     fields=None,
-                     reconciliation_references=None,
-                     payment_information_ids=None,
-                     merchant_reference_numbers=None,
-                     checkout_invoice_numbers=None,
-                     capture_invoice_numbers=None):
-        if not self.auth:
-            return False
+    def _get_pending_checkouts(self, checkouts):
+        results = []
+        pending_checkouts = []
+        for checkout_kwargs in checkouts:
+            result = PaydirektBulkResult(checkout_kwargs)
+            results.append(result)
+            try:
+                inspect.signature(self._get_checkout_data).bind(**checkout_kwargs)
+            except TypeError as e:
+                # missing or unknown init arguments
+                result.error = 'invalid checkout arguments: {0}'.format(e)
+                continue
+            checkout_data = self._get_checkout_data(**checkout_kwargs)
+            if checkout_data:
+                pending_checkouts.append((result, checkout_data))
+            else:
+                result.error = 'invalid checkout data'
+        return results, pending_checkouts
+
+    def _create_checkouts(self, pending_checkouts, checkout_responses, batch_size=None):
+        paydirekt_checkouts = []
+        for (result, checkout_data), checkout_response in zip(pending_checkouts, checkout_responses):
+            checkout_fields = self._get_checkout_fields(checkout_data, checkout_response)
+            if checkout_fields:
+                result.paydirekt_object = PaydirektCheckout(**checkout_fields)
+                paydirekt_checkouts.append(result.paydirekt_object)
+            else:
+                result.error = 'checkout failed at paydirekt'
+        if paydirekt_checkouts:
+            PaydirektCheckout.objects.bulk_create(paydirekt_checkouts, batch_size=batch_size)
+            # bulk_create sends no post_save
+            unknown_id_cache = get_unknown_id_cache()
+            if unknown_id_cache:
+                checkout_ids = [paydirekt_checkout.checkout_id for paydirekt_checkout in paydirekt_checkouts]
+                transaction.on_commit(lambda: unknown_id_cache.forget('checkout', checkout_ids))
+
+    def _get_transactions_filters(self,
+                                  from_datetime=None,
+                                  to_datetime=None,
+                                  fields=None,
+                                  reconciliation_references=None,
+                                  payment_information_ids=None,
+                                  merchant_reference_numbers=None,
+                                  checkout_invoice_numbers=None,
+                                  capture_invoice_numbers=None):
         transactions_filters = {}
         if from_datetime:
             transactions_filters.update({'from': from_datetime.isoformat()})
-        if from_datetime:
+        if to_datetime:
             transactions_filters.update({'to': to_datetime.isoformat()})
         if fields:
             transactions_filters.update({'fields': fields})
@@ -179,50 +691,55 @@ class PaydirektWrapper(object):
             transactions_filters.update({'checkoutInvoiceNumbers': checkout_invoice_numbers})
         if capture_invoice_numbers:
             transactions_filters.update({'captureInvoiceNumbers': capture_invoice_numbers})
-        transactions_response = self.call_api(self.transactions_url, data=transactions_filters)
-        if transactions_response and 'transactions' in transactions_response:
-            return transactions_response['transactions']
-        return False
+        return transactions_filters
 
-    def call_api(self, url=None, access_token=None, data=None):
-        if not self.auth:
-            return False
+    def _get_transaction_windows(self, from_datetime, to_datetime, window):
+        if window <= timedelta(0):
+            raise ValueError('Paydirekt transaction window must be positive, got {0}'.format(window))
+        window_from = from_datetime
+        while window_from < to_datetime:
+            window_to = min(window_from + window, to_datetime)
+            yield window_from, window_to
+            window_from = window_to
+
+    def _get_window_transactions(self, window_from, window_to, transactions):
+        if transactions is False:
+            raise PaydirektTransactionsError('Paydirekt transactions from {0} to {1} not available'.format(
+                window_from.isoformat(), window_to.isoformat()))
+        return transactions
+
+    def _get_api_request(self, url, access_token, data):
         if not url.lower().startswith('http'):
             url = '{0}{1}'.format(self.api_url, url)
         request = Request(url)
 
-        if access_token is None:
-            access_token = self._get_access_token()
         request.add_header('Authorization', 'Bearer {0}'.format(access_token))
         if data:
-            data = json.dumps(data)
-            data_len = len(data)
+            request.data = get_json_codec().dumps(data)
             request.add_header('Content-Type', 'application/hal+json;charset=utf-8')
-            request.add_header('Content-Length', data_len)
-            request.data = data.encode(encoding='utf-8')
+            request.add_header('Content-Length', len(request.data))
         elif data == '':
             request.method = 'POST'
             request.data = ''.encode(encoding='utf-8')
         request.add_header('Accept', 'application/json')
-        try:
-            if sys.version_info.major > 2 or (sys.version_info.major == 2 and sys.version_info.major > 7 or (sys.version_info.major == 7 and sys.version_info.major >= 9)):
-                response = urlopen(request, cafile=certifi.where())
-            else:
-                response = urlopen(request)
-        except HTTPError as e:
-            logger = logging.getLogger(__name__)
-            fp = e.fp
-            body = fp.read()
-            fp.close()
-            if hasattr(e, 'code'):
-                logger.error("Paydirekt Error {0}({1}): {2}".format(e.code, e.msg, body))
-            else:
-                logger.error("Paydirekt Error({0}): {1}".format(e.msg, body))
+        return request
+
+    def _handle_http_error(self, e, cached_access_token=False):
+        logger = logging.getLogger(__name__)
+        fp = e.fp
+        body = fp.read()
+        fp.close()
+        if hasattr(e, 'code'):
+            logger.error("Paydirekt Error {0}({1}): {2}".format(e.code, e.msg, body))
+            if e.code == 401 and cached_access_token and self.token_store:
+                self.token_store.invalidate(self._get_token_store_key())
         else:
-            return json.loads(response.read().decode('utf-8'))
-        return False
+            logger.error("Paydirekt Error({0}): {1}".format(e.msg, body))
 
-    def _get_access_token(self):
+    def _get_token_store_key(self):
+        return 'django_paydirekt:token:{0}:{1}'.format(self.api_url, self.auth['API_KEY'])
+
+    def _get_token_request(self):
         data = {
             'grantType': 'api_key',
         }
@@ -251,29 +768,11 @@ class PaydirektWrapper(object):
 
         request.add_header('X-Auth-Key', self.auth['API_KEY'])
         request.add_header('X-Auth-Code', signature)
-        data = json.dumps(data)
-        data_len = len(data)
+        request.data = get_json_codec().dumps(data)
         request.add_header('Content-Type', 'application/hal+json;charset=utf-8')
         request.add_header('Accept', 'application/hal+json')
-        request.add_header('Content-Length', data_len)
-        request.data = data.encode(encoding='utf-8')
-
-        try:
-            if sys.version_info.major > 2 or (sys.version_info.major == 2 and sys.version_info.major > 7 or (sys.version_info.major == 7 and sys.version_info.major >= 9)):
-                response = urlopen(request, cafile=certifi.where())
-            else:
-                response = urlopen(request)
-        except HTTPError as e:
-            logger = logging.getLogger(__name__)
-            fp = e.fp
-            body = fp.read()
-            fp.close()
-            if hasattr(e, 'code'):
-                logger.error("Paydirekt Error {0}({1}): {2}".format(e.code, e.msg, body))
-            else:
-                logger.error("Paydirekt Error({0}): {1}".format(e.msg, body))
-        else:
-            return json.loads(response.read().decode('utf-8'))['access_token']
+        request.add_header('Content-Length', len(request.data))
+        return request
 
     def _format_timestamp_for_header(self, timestamp):
         weekdayname = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
@@ -290,3 +789,144 @@ class PaydirektWrapper(object):
     def _get_random(self, length=64):
         valid_chars = string.ascii_letters + string.digits + '-' + '_'
         return ''.join(random.SystemRandom().choice(valid_chars) for x in range(length))
+
+
+class AsyncPaydirektWrapper(PaydirektWrapper):
+    """
+        asyncio counterpart of PaydirektWrapper, use it with the async methods of the models, e.g. acreate_capture.
+    """
+
+    async def init(self, total_amount, reference_number, payment_type, *args, **kwargs):
+        if not self.auth:
+            return False
+        deadline = kwargs.pop('deadline', None)
+        checkout_data = self._get_checkout_data(total_amount, reference_number, payment_type, *args, **kwargs)
+        if not checkout_data:
+            return False
+        checkout_response = await self.call_api(url=self.checkouts_url, data=checkout_data, deadline=deadline)
+        checkout_fields = self._get_checkout_fields(checkout_data, checkout_response)
+        if checkout_fields:
+            return await sync_to_async(PaydirektCheckout.objects.create)(**checkout_fields)
+        return False
+
+    async def init_many(self, checkouts, max_workers=None, batch_size=None, rate_limiter=None, deadline=None):
+        if not self.auth:
+            return False
+        results, pending_checkouts = self._get_pending_checkouts(checkouts)
+        checkout_responses = await acall_api_many(self, [(self.checkouts_url, checkout_data) for result, checkout_data in pending_checkouts],
+                                                  max_workers=max_workers, rate_limiter=rate_limiter, deadline=deadline)
+        await sync_to_async(self._create_checkouts)(pending_checkouts, checkout_responses, batch_size=batch_size)
+        return results
+
+    async def transactions(self, *args, **kwargs):
+        if not self.auth:
+            return False
+        deadline = kwargs.pop('deadline', None)
+        transactions_filters = self._get_transactions_filters(*args, **kwargs)
+        transactions_response = await self.call_api(self.transactions_url, data=transactions_filters, deadline=deadline)
+        if transactions_response and 'transactions' in transactions_response:
+            return transactions_response['transactions']
+        return False
+
+    async def iter_transactions(self, from_datetime, to_datetime, window=timedelta(days=1), max_workers=1, **kwargs):
+        pending_windows = collections.deque()
+        try:
+            for window_from, window_to in self._get_transaction_windows(from_datetime, to_datetime, window):
+                pending_windows.append((window_from, window_to, asyncio.ensure_future(self.transactions(window_from, window_to, **kwargs))))
+                if len(pending_windows) >= max_workers:
+                    window_from, window_to, task = pending_windows.popleft()
+                    for report_transaction in self._get_window_transactions(window_from, window_to, await task):
+                        yield report_transaction
+            while pending_windows:
+                window_from, window_to, task = pending_windows.popleft()
+                for report_transaction in self._get_window_transactions(window_from, window_to, await task):
+                    yield report_transaction
+        finally:
+            for window_from, window_to, task in pending_windows:
+                task.cancel()
+
+    async def call_api(self, url=None, access_token=None, data=None, deadline=None):
+        if not self.auth:
+            return False
+        cached_access_token = access_token is None
+        token_cache = None
+        if cached_access_token:
+            access_token, token_cache = await self._get_access_token_and_cache_status(deadline)
+        request = self._get_api_request(url, access_token, data)
+        try:
+            response_body = await self._urlopen(request, token_cache, deadline)
+        except HTTPError as e:
+            self._handle_http_error(e, cached_access_token)
+        else:
+            return get_json_codec().loads(response_body)
+        return False
+
+    async def _get_access_token(self):
+        return (await self._get_access_token_and_cache_status())[0]
+
+    async def _get_access_token_and_cache_status(self, deadline=None):
+        if self.token_store:
+            obtained = []
+
+            async def obtain_access_token():
+                obtained.append(True)
+                return await self._obtain_access_token(deadline)
+
+            access_token = await self.token_store.aget_token(self._get_token_store_key(), obtain_access_token, deadline)
+            return access_token, 'miss' if obtained else 'hit'
+        token_response = await self._obtain_access_token(deadline)
+        if token_response and 'access_token' in token_response:
+            return token_response['access_token'], None
+        return None, None
+
+    async def _obtain_access_token(self, deadline=None):
+        try:
+            # signed again for each attempt, paydirekt rejects a request id, nonce and timestamp seen before
+            response_body = await self._urlopen(self._get_token_request(), deadline=deadline, build_request=self._get_token_request)
+        except HTTPError as e:
+            self._handle_http_error(e)
+        else:
+            return get_json_codec().loads(response_body)
+
+    async def _urlopen(self, request, token_cache=None, deadline=None, build_request=None):
+        idempotent = self._is_idempotent(request)
+        circuit_breaker = get_circuit_breaker(self.api_url)
+        attempt = 0
+        while True:
+            timeout = self._get_timeout(request, deadline)
+            permit = circuit_breaker.allow() if circuit_breaker else True
+            if not permit:
+                raise PaydirektCircuitOpenError('Paydirekt API {0} unavailable'.format(self.api_url))
+            try:
+                try:
+                    response_body = await self._urlopen_once(request, token_cache, attempt, timeout)
+                except UPSTREAM_ERRORS + (asyncio.TimeoutError,) as e:
+                    retry_delay = self._handle_upstream_error(request, e, circuit_breaker, attempt, idempotent, deadline)
+                    if retry_delay is None:
+                        raise
+                else:
+                    if circuit_breaker:
+                        circuit_breaker.record_success()
+                    return response_body
+            finally:
+                if permit == PaydirektCircuitBreaker.TRIAL:
+                    circuit_breaker.end_trial()
+            await asyncio.sleep(retry_delay)
+            attempt += 1
+            if build_request:
+                request = build_request()
+
+    async def _urlopen_once(self, request, token_cache, attempt, timeout):
+        start = time.perf_counter()
+        status = None
+        response_body = None
+        try:
+            response = await async_urlopen(request, timeout=timeout)
+            status = getattr(response, 'status', None)
+            response_body = response.read()
+        except HTTPError as e:
+            status = e.code
+            raise
+        finally:
+            self._send_api_called(request, status, start, response_body, token_cache, attempt)
+        return response_body
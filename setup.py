@@ -40,8 +40,9 @@ def get_package_data(package):
     return {package: filepaths}
 
 REQUIREMENTS = [
-    'Django>=1.8',
+    'Django>=3.1',
     'certifi>=2018.10.15',
+    'asgiref>=3.2',
 ]
 
 version = get_version('django_paydirekt')
@@ -71,11 +72,14 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
         'Framework :: Django',
         'Topic :: Software Development :: Libraries :: Application Frameworks',
         'Topic :: Software Development :: Libraries :: Python Modules'],
+    python_requires='>=3.6',
     install_requires=REQUIREMENTS,
+    extras_require={'orjson': ['orjson>=3']},
     zip_safe=False)
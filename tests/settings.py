@@ -1,4 +1,6 @@
 # Django settings for testproject project.
+import tempfile
+
 from django.conf import settings
 
 settings.configure(
@@ -9,6 +11,15 @@ settings.configure(
             'NAME': ':memory:'
         }
     },
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'file': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': tempfile.mkdtemp(prefix='django_paydirekt_tests'),
+        },
+    },
     ROOT_URLCONF='tests.test_urls',
     INSTALLED_APPS=(
         'django.contrib.auth',
@@ -0,0 +1,260 @@
+import json
+import os
+import random
+import re
+import select
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit
+
+from .test_response_mockups import TEST_RESPONSES
+
+CHECKOUTS_PATH = '/api/checkout/v1/checkouts'
+CHECKOUT_PATH = re.compile(r'^/api/checkout/v1/checkouts/(?P<checkout_id>[^/]+)/?(?P<action>captures|refunds|close)?/?$')
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """
+        Minimal paydirekt API: token obtain, checkouts, captures, refunds, close and the transactions report.
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super(StubRequestHandler, self).setup()
+        with self.server.lock:
+            self.server.connection_count += 1
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self._respond()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request_data = json.loads(self.rfile.read(length)) if length else {}
+        with self.server.lock:
+            self.server.request_count += 1
+            failed = self.server.error_rate and self.server.random.random() < self.server.error_rate
+            dropped = self.server.drop_count > 0
+            self.server.drop_count -= dropped
+        if dropped:
+            self.close_connection = True
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if failed:
+            status, response = self.server.error_status, {}
+        else:
+            status, response = self._route(request_data)
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        if failed and self.server.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.retry_after))
+        self.send_header('Content-Type', 'application/hal+json;charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, request_data):
+        # absolute-form when sent through a proxy
+        path = urlsplit(self.path).path
+        if path.endswith('/token/obtain'):
+            return 200, TEST_RESPONSES['token_obtain']
+        if path == '/api/reporting/v1/reports/transactions':
+            return 200, self._get_transactions(request_data)
+        if path == CHECKOUTS_PATH and self.command == 'POST':
+            return 200, self._create_checkout(request_data)
+        match = CHECKOUT_PATH.match(path)
+        if not match or not self.server.is_known_checkout(match.group('checkout_id')):
+            return 404, {}
+        checkout_id = match.group('checkout_id')
+        if match.group('action') == 'captures':
+            return 200, self._create_transaction(checkout_id, 'captures', 'CAPTURE_ORDER', 'SUCCESSFUL', request_data)
+        if match.group('action') == 'refunds':
+            return 200, self._create_transaction(checkout_id, 'refunds', 'REFUND', 'PENDING', request_data)
+        if match.group('action') == 'close':
+            return 200, {'checkoutId': checkout_id, 'status': 'CLOSED'}
+        return 200, self._get_checkout(checkout_id)
+
+    def _create_checkout(self, request_data):
+        checkout_id = str(uuid.uuid4())
+        with self.server.lock:
+            self.server.checkout_ids.add(checkout_id)
+        return {
+            'checkoutId': checkout_id,
+            'status': 'OPEN',
+            'type': request_data.get('type'),
+            'totalAmount': request_data.get('totalAmount'),
+            'currency': request_data.get('currency'),
+            '_links': {
+                'self': {'href': self._get_url(checkout_id)},
+                'approve': {'href': 'https://sandbox.paydirekt.de/checkout/#/checkout/{0}'.format(checkout_id)},
+            }
+        }
+
+    def _get_checkout(self, checkout_id):
+        checkout = dict(TEST_RESPONSES['status_approved'], checkoutId=checkout_id)
+        checkout['_links'] = {
+            'self': {'href': self._get_url(checkout_id)},
+            'close': {'href': self._get_url(checkout_id, 'close')},
+            'captures': {'href': self._get_url(checkout_id, 'captures')},
+            'refunds': {'href': self._get_url(checkout_id, 'refunds')},
+        }
+        return checkout
+
+    def _create_transaction(self, checkout_id, action, transaction_type, status, request_data):
+        transaction_id = str(uuid.uuid4())
+        return {
+            'transactionId': transaction_id,
+            'type': transaction_type,
+            'amount': request_data.get('amount'),
+            'status': status,
+            '_links': {'self': {'href': '{0}/{1}'.format(self._get_url(checkout_id, action), transaction_id)}},
+        }
+
+    def _get_transactions(self, request_data):
+        return {'transactions': [{
+            'paymentInformationId': 'payment-{0}'.format(i),
+            'merchantReferenceNumber': str(i),
+            'transactionType': 'CAPTURE',
+            'amount': 10.5,
+            'currency': 'EUR',
+            'timestamp': request_data.get('from'),
+        } for i in range(self.server.transactions_per_report)]}
+
+    def _get_url(self, checkout_id, action=None):
+        url = '{0}{1}/{2}'.format(self.server.url, CHECKOUTS_PATH, checkout_id)
+        if action:
+            url = '{0}/{1}'.format(url, action)
+        return url
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+        Local paydirekt API stub, latency in seconds is added to every response
+        and error_rate is the share of requests answered with error_status, with retry_after as Retry-After header.
+        The next drop_count requests are read and the connection is closed without a response.
+    """
+    daemon_threads = True
+
+    def __init__(self, handler_class=StubRequestHandler, tls=False, latency=0, error_rate=0, error_status=503, retry_after=None,
+                 transactions_per_report=10, seed=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), handler_class)
+        self.lock = threading.Lock()
+        self.connection_count = 0
+        self.request_count = 0
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.drop_count = 0
+        self.transactions_per_report = transactions_per_report
+        self.random = random.Random(seed)
+        self.checkout_ids = set(['123-abc-approved'])
+        self.certificate_dir = None
+        self.scheme = 'http'
+        if tls:
+            self.certificate_dir = tempfile.mkdtemp(prefix='django_paydirekt_stub')
+            self.certfile = os.path.join(self.certificate_dir, 'cert.pem')
+            keyfile = os.path.join(self.certificate_dir, 'key.pem')
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                                   '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+                                   '-keyout', keyfile, '-out', self.certfile],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, keyfile)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+            self.scheme = 'https'
+
+    @property
+    def url(self):
+        return '{0}://127.0.0.1:{1}'.format(self.scheme, self.server_address[1])
+
+    def is_known_checkout(self, checkout_id):
+        with self.lock:
+            return checkout_id in self.checkout_ids
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.certificate_dir:
+            shutil.rmtree(self.certificate_dir, ignore_errors=True)
+
+
+class StubProxyRequestHandler(BaseHTTPRequestHandler):
+    """
+        Tunnels CONNECT requests to the requested host.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_CONNECT(self):
+        with self.server.lock:
+            self.server.tunnels.append((self.path, self.headers.get('Proxy-Authorization')))
+        hostname, port = self.path.rsplit(':', 1)
+        upstream = socket.create_connection((hostname, int(port)))
+        self.send_response(200)
+        self.end_headers()
+        sockets = [self.connection, upstream]
+        try:
+            while True:
+                readable = select.select(sockets, [], [], 5)[0]
+                if not readable:
+                    return
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+        finally:
+            upstream.close()
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubProxy(ThreadingMixIn, HTTPServer):
+    """
+        Local HTTP proxy, tunnels records the CONNECT target and Proxy-Authorization header of every tunnel.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubProxyRequestHandler)
+        self.lock = threading.Lock()
+        self.tunnels = []
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -126,4 +126,37 @@ TEST_RESPONSES = {
         'redirectUrlAfterCancellation': 'https://spielauto-versand.de/order/123/cancellation',
         'redirectUrlAfterRejection': 'https://spielauto-versand.de/order/123/rejection'
     },
+    'checkout_created': {
+        'checkoutId': '123-abc-created',
+        'status': 'OPEN',
+        'type': 'ORDER',
+        'totalAmount': 100.0,
+        'currency': 'EUR',
+        '_links': {
+            'self': {'href': 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-created'},
+            'approve': {'href': 'https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-created'}
+        }
+    },
+    'capture_created': {
+        'transactionId': '123-abc-capture',
+        'type': 'CAPTURE_ORDER',
+        'amount': 50.0,
+        'status': 'SUCCESSFUL',
+        '_links': {
+            'self': {'href': 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures/123-abc-capture'}
+        }
+    },
+    'refund_created': {
+        'transactionId': '123-abc-refund',
+        'type': 'REFUND',
+        'amount': 50.0,
+        'status': 'PENDING',
+        '_links': {
+            'self': {'href': 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/refunds/123-abc-refund'}
+        }
+    },
+    'checkout_closed': {
+        'checkoutId': '123-abc-approved',
+        'status': 'CLOSED'
+    }
 }
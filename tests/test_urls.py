@@ -1,5 +1,8 @@
 from django.conf.urls import include, url
 
+from django_paydirekt.views import AsyncNotifyPaydirektView
+
 urlpatterns = [
     url('^paydirekt/', include('django_paydirekt.urls')),
+    url('^paydirekt-async/notify/$', AsyncNotifyPaydirektView.as_view()),
 ]
@@ -1,15 +1,34 @@
+import asyncio
 import certifi
+import http.client
 import json
 import logging
+import shutil
+import socket
+import ssl
+import threading
 import time
-
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
 from django.test import Client, TestCase
-from testfixtures import replace
+from django.utils import timezone
+from testfixtures import Replacer, replace
 
 from django_paydirekt import settings as django_paydirekt_settings
-from django_paydirekt.models import PaydirektCheckout
-from django_paydirekt.wrappers import PaydirektWrapper
-
+from django_paydirekt.destinations import PaydirektDestinationRules
+from django_paydirekt.signals import paydirekt_api_called, paydirekt_notification_handled
+from django_paydirekt.models import PaydirektCapture, PaydirektCheckout, PaydirektNotification, PaydirektRefund, PaydirektTransaction, PaydirektTransactionSync
+from django_paydirekt.utils import PaydirektCircuitBreaker, PaydirektJSONCodec, PaydirektRateLimiter, PaydirektOrjsonCodec, get_circuit_breaker, get_json_codec, get_retry_after, orjson
+from django_paydirekt.transport import AsyncPaydirektConnectionPool, PaydirektConnectionPool, async_urlopen as async_transport_urlopen, urlopen as transport_urlopen
+from django_paydirekt.wrappers import AsyncPaydirektWrapper, PaydirektCacheTokenStore, PaydirektCircuitOpenError, PaydirektDeadlineExceeded, PaydirektTokenStore, PaydirektTransactionsError, PaydirektWrapper
+
+from .stub_server import StubProxy, StubServer
 from .test_response_mockups import TEST_RESPONSES
 
 from urllib.error import HTTPError
@@ -22,7 +41,7 @@ def mock_generate_uuid(length=12):
     return '12345678901234567890'
 
 
-def mock_urlopen(request, cafile=None):
+def mock_urlopen(request, timeout=None):
     response = {}
     url = request.get_full_url()
     try:
@@ -34,12 +53,24 @@ def mock_urlopen(request, cafile=None):
             response = TEST_RESPONSES['status_expired']
         if url == 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved-minimal/':
             response = TEST_RESPONSES['minimal_status_approved']
+        if url == 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts':
+            response = TEST_RESPONSES['checkout_created']
+        if url == 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures':
+            response = TEST_RESPONSES['capture_created']
+        if url == 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/refunds':
+            response = TEST_RESPONSES['refund_created']
+        if url == 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/close':
+            response = TEST_RESPONSES['checkout_closed']
     except KeyError:
         response = False
     result = MockResponse(response)
     return result
 
 
+async def mock_async_urlopen(request, timeout=None):
+    return mock_urlopen(request)
+
+
 class MockResponse(object):
     response = ''
 
@@ -117,6 +148,1455 @@ class TestPaydirektNotifications(TestCase):
             approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/'+checkout_id)
 
 
+def failing_urlopen(request, timeout=None):
+    raise AssertionError('Unexpected request to {}'.format(request.get_full_url()))
+
+
+def not_found_urlopen(request, timeout=None):
+    if request.get_full_url().endswith('/token/obtain'):
+        return mock_urlopen(request, timeout)
+    raise HTTPError(request.get_full_url(), 404, 'Not Found', {}, StringIO())
+
+
+async def failing_async_urlopen(request, timeout=None):
+    raise AssertionError('Unexpected request to {}'.format(request.get_full_url()))
+
+
+stored_notifications = []
+
+
+def store_notification_hook(paydirekt_notification):
+    stored_notifications.append(paydirekt_notification)
+
+
+class TestPaydirektNotificationInbox(TestCase):
+
+    def setUp(self):
+        self.replacer = Replacer()
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_NOTIFICATION_INBOX', True)
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', failing_urlopen)
+        self.replacer.replace('django_paydirekt.wrappers.async_urlopen', failing_async_urlopen)
+        self.addCleanup(self.replacer.restore)
+        PaydirektCheckout.objects.create(
+            total_amount=1.0,
+            checkout_id='123-abc-approved',
+            status='OPEN',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-approved')
+
+    def test_notification_stored_and_processed(self):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'checkoutStatus': 'APPROVED'}
+        response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-approved').status, 'OPEN')
+        paydirekt_notification = PaydirektNotification.objects.get()
+        self.assertEqual(paydirekt_notification.notification_type, 'checkout')
+        self.assertEqual(paydirekt_notification.status, 'APPROVED')
+        self.assertIsNone(paydirekt_notification.processed_at)
+
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+        stdout = StringIO()
+        call_command('paydirekt_process_notifications', stdout=stdout)
+        self.assertIn('1 notifications processed', stdout.getvalue())
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-approved').status, 'APPROVED')
+        paydirekt_notification.refresh_from_db()
+        self.assertEqual(paydirekt_notification.response_status, 200)
+        self.assertEqual(paydirekt_notification.attempts, 1)
+        self.assertIsNotNone(paydirekt_notification.processed_at)
+        self.assertEqual(PaydirektNotification.objects.process_pending(), 0)
+
+    def test_invalid_notification_not_stored(self):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved'}
+        response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(PaydirektNotification.objects.exists())
+
+    def test_failed_notification_retried(self):
+        PaydirektNotification.objects.store('checkout', {'checkoutId': '123-abc-approved', 'checkoutStatus': 'APPROVED'})
+        call_command('paydirekt_process_notifications', stdout=StringIO())
+        paydirekt_notification = PaydirektNotification.objects.get()
+        self.assertEqual(paydirekt_notification.attempts, 1)
+        self.assertIsNone(paydirekt_notification.processed_at)
+        retry_at = timezone.now() + timedelta(seconds=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_RETRY_BACKOFF)
+        self.assertAlmostEqual(paydirekt_notification.claimed_until, retry_at, delta=timedelta(seconds=5))
+        for i in range(django_paydirekt_settings.PAYDIREKT_NOTIFICATION_MAX_ATTEMPTS - 1):
+            # backoff passed
+            PaydirektNotification.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+            PaydirektNotification.objects.process_pending()
+        paydirekt_notification = PaydirektNotification.objects.get()
+        self.assertEqual(paydirekt_notification.attempts, django_paydirekt_settings.PAYDIREKT_NOTIFICATION_MAX_ATTEMPTS)
+        retry_at = timezone.now() + timedelta(seconds=django_paydirekt_settings.PAYDIREKT_NOTIFICATION_RETRY_BACKOFF * 2 ** (django_paydirekt_settings.PAYDIREKT_NOTIFICATION_MAX_ATTEMPTS - 1))
+        self.assertAlmostEqual(paydirekt_notification.claimed_until, retry_at, delta=timedelta(seconds=5))
+
+    def test_rejected_notification_retried(self):
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', not_found_urlopen)
+        PaydirektNotification.objects.store('checkout', {'checkoutId': '123-abc-approved', 'checkoutStatus': 'APPROVED'})
+        self.assertEqual(PaydirektNotification.objects.process_pending(), 1)
+        paydirekt_notification = PaydirektNotification.objects.get()
+        self.assertEqual((paydirekt_notification.attempts, paydirekt_notification.response_status), (1, 400))
+        self.assertIsNone(paydirekt_notification.processed_at)
+        self.assertEqual(PaydirektNotification.objects.process_pending(), 0)
+
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+        PaydirektNotification.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(PaydirektNotification.objects.process_pending(), 1)
+        paydirekt_notification.refresh_from_db()
+        self.assertEqual((paydirekt_notification.attempts, paydirekt_notification.response_status), (2, 200))
+        self.assertIsNotNone(paydirekt_notification.processed_at)
+
+    def test_claimed_notification_skipped(self):
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+        paydirekt_notification = PaydirektNotification.objects.store('checkout', {'checkoutId': '123-abc-approved', 'checkoutStatus': 'APPROVED'})
+        PaydirektNotification.objects.filter(pk=paydirekt_notification.pk).update(claimed_until=timezone.now() + timedelta(minutes=1))
+        self.assertEqual(PaydirektNotification.objects.process_pending(), 0)
+        # claimed by a crashed worker
+        PaydirektNotification.objects.filter(pk=paydirekt_notification.pk).update(claimed_until=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(PaydirektNotification.objects.process_pending(), 1)
+        paydirekt_notification.refresh_from_db()
+        self.assertIsNotNone(paydirekt_notification.processed_at)
+        self.assertIsNone(paydirekt_notification.claimed_until)
+
+    def test_notification_hook(self):
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_NOTIFICATION_INBOX_HOOK', 'tests.tests.store_notification_hook')
+        del stored_notifications[:]
+        with self.captureOnCommitCallbacks(execute=True):
+            paydirekt_notification = PaydirektNotification.objects.store('checkout', {'checkoutId': '123-abc-approved', 'checkoutStatus': 'APPROVED'})
+        self.assertEqual(stored_notifications, [paydirekt_notification])
+
+    def test_async_notification_stored(self):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'checkoutStatus': 'APPROVED'}
+        response = client.post('/paydirekt-async/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PaydirektNotification.objects.get().checkout_id, '123-abc-approved')
+
+
+class TestPaydirektNotificationDeduplication(TestCase):
+
+    def setUp(self):
+        self.replacer = Replacer()
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_NOTIFICATION_DEDUP_CACHE_ALIAS', 'default')
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+        self.addCleanup(self.replacer.restore)
+        self.addCleanup(caches['default'].clear)
+        PaydirektCheckout.objects.create(
+            total_amount=1.0,
+            checkout_id='123-abc-approved',
+            status='OPEN',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-approved')
+        self.post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'checkoutStatus': 'APPROVED'}
+
+    def test_duplicate_notification_skipped(self):
+        client = Client()
+        response = client.post('/paydirekt/notify/', data=json.dumps(self.post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', failing_urlopen)
+        with self.assertNumQueries(0):
+            response = client.post('/paydirekt/notify/', data=json.dumps(self.post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_failed_notification_not_remembered(self):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'checkoutStatus': 'CLOSED'}
+        response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+        response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_other_status_not_skipped(self):
+        client = Client()
+        client.post('/paydirekt/notify/', data=json.dumps(self.post_data), content_type='application/hal+json')
+        requested_urls = []
+
+        def recording_urlopen(request, timeout=None):
+            requested_urls.append(request.get_full_url())
+            return mock_urlopen(request)
+
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', recording_urlopen)
+        post_data = dict(self.post_data, checkoutStatus='CLOSED')
+        client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertTrue(requested_urls)
+
+    def test_inbox_notification_remembered(self):
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_NOTIFICATION_INBOX', True)
+        client = Client()
+        client.post('/paydirekt/notify/', data=json.dumps(self.post_data), content_type='application/hal+json')
+        PaydirektNotification.objects.process_pending()
+        client.post('/paydirekt/notify/', data=json.dumps(self.post_data), content_type='application/hal+json')
+        self.assertEqual(PaydirektNotification.objects.count(), 1)
+
+    def test_async_duplicate_notification_skipped(self):
+        self.replacer.replace('django_paydirekt.wrappers.async_urlopen', mock_async_urlopen)
+        client = Client()
+        response = client.post('/paydirekt-async/notify/', data=json.dumps(self.post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+        self.replacer.replace('django_paydirekt.wrappers.async_urlopen', failing_async_urlopen)
+        response = client.post('/paydirekt-async/notify/', data=json.dumps(self.post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+
+
+class TestPaydirektUnknownIdCache(TestCase):
+
+    def setUp(self):
+        self.replacer = Replacer()
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_UNKNOWN_ID_CACHE_ALIAS', 'default')
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+        self.addCleanup(self.replacer.restore)
+        self.addCleanup(caches['default'].clear)
+
+    def test_unknown_checkout_rejected_without_query(self):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'checkoutStatus': 'APPROVED'}
+        with self.assertNumQueries(1):
+            response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+        with self.assertNumQueries(0):
+            response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+
+        # creating the checkout forgets the unknown id once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            PaydirektCheckout.objects.create(
+                total_amount=1.0,
+                checkout_id='123-abc-approved',
+                status='OPEN',
+                link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/',
+                approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-approved')
+            response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+            self.assertEqual(response.status_code, 400)
+        response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_unknown_transaction_rejected_without_query(self):
+        paydirekt_checkout = PaydirektCheckout.objects.create(
+            total_amount=1.0,
+            checkout_id='123-abc-approved',
+            status='APPROVED',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-approved')
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved',
+                     'transactionId': '123-abc-capture', 'captureStatus': 'SUCCESSFUL'}
+        response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+        with self.assertNumQueries(0):
+            response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            PaydirektCapture.objects.create(checkout=paydirekt_checkout, transaction_id='123-abc-capture', amount=1.0, status='PENDING',
+                                            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures/123-abc-capture/')
+        with self.assertNumQueries(2):
+            client.post('/paydirekt/notify/', data=json.dumps(dict(post_data, transactionId='123-abc-other')), content_type='application/hal+json')
+        self.assertFalse(caches['default'].get('django_paydirekt:unknown:transaction:123-abc-capture'))
+
+    def test_async_unknown_checkout_rejected(self):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'checkoutStatus': 'APPROVED'}
+        response = client.post('/paydirekt-async/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(caches['default'].get('django_paydirekt:unknown:checkout:123-abc-approved'))
+
+
+class TestPaydirektTrustedNotifications(TestCase):
+
+    def setUp(self):
+        self.replacer = Replacer()
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_NOTIFICATION_TRUST_STATUS', True)
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', failing_urlopen)
+        self.replacer.replace('django_paydirekt.wrappers.async_urlopen', failing_async_urlopen)
+        self.addCleanup(self.replacer.restore)
+        self.paydirekt_checkout = PaydirektCheckout.objects.create(
+            total_amount=1.0,
+            checkout_id='123-abc-approved',
+            status='OPEN',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-approved')
+
+    def _notify(self, checkout_status, url='/paydirekt/notify/'):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'checkoutStatus': checkout_status}
+        return client.post(url, data=json.dumps(post_data), content_type='application/hal+json')
+
+    def test_notified_status_applied_and_verified(self):
+        response = self._notify('APPROVED')
+        self.assertEqual(response.status_code, 200)
+        paydirekt_checkout = PaydirektCheckout.objects.get(checkout_id='123-abc-approved')
+        self.assertEqual(paydirekt_checkout.status, 'APPROVED')
+        self.assertFalse(paydirekt_checkout.status_verified)
+
+        # a redelivered status is not written again
+        self.assertFalse(PaydirektCheckout.objects.apply_notified_status(paydirekt_checkout, 'APPROVED'))
+
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+        stdout = StringIO()
+        call_command('paydirekt_verify_statuses', stdout=stdout)
+        self.assertIn('1 checkouts verified, 0 mismatches, 0 errors', stdout.getvalue())
+        paydirekt_checkout = PaydirektCheckout.objects.get(checkout_id='123-abc-approved')
+        self.assertTrue(paydirekt_checkout.status_verified)
+
+    def test_mismatching_status_replaced(self):
+        self._notify('CLOSED')
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-approved').status, 'CLOSED')
+
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+        paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        })
+        mismatched_checkouts, failed_checkouts = PaydirektCheckout.objects.verify_statuses(
+            PaydirektCheckout.objects.filter(status_verified=False), paydirekt_wrapper)
+        self.assertEqual([paydirekt_checkout.checkout_id for paydirekt_checkout in mismatched_checkouts], ['123-abc-approved'])
+        self.assertEqual(failed_checkouts, [])
+        paydirekt_checkout = PaydirektCheckout.objects.get(checkout_id='123-abc-approved')
+        self.assertEqual(paydirekt_checkout.status, 'APPROVED')
+        self.assertTrue(paydirekt_checkout.status_verified)
+
+    def test_capture_status_applied(self):
+        paydirekt_capture = PaydirektCapture.objects.create(
+            checkout=self.paydirekt_checkout, transaction_id='123-abc-capture', amount=1.0, status='PENDING',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures/123-abc-capture/')
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved',
+                     'transactionId': '123-abc-capture', 'captureStatus': 'SUCCESSFUL'}
+        response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+        paydirekt_capture.refresh_from_db()
+        self.assertEqual(paydirekt_capture.status, 'SUCCESSFUL')
+        self.assertFalse(paydirekt_capture.status_verified)
+
+    def test_async_notified_status_applied(self):
+        response = self._notify('APPROVED', url='/paydirekt-async/notify/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(PaydirektCheckout.objects.get(checkout_id='123-abc-approved').status_verified)
+
+
+class TestPaydirektDestinationRules(TestCase):
+    paket = [{'code': 'DHL_PAKET', 'name': 'DHL Paket', 'amount': 6.99}]
+    express = [{'code': 'DHL_EXPRESS', 'name': 'DHL Express', 'amount': 19.99}]
+
+    def test_rules(self):
+        destination_rules = PaydirektDestinationRules([
+            {'country_codes': ['DE'], 'zip_codes': ['10115', '1*'], 'packstation': False, 'shipping_options': self.express},
+            {'country_codes': ['DE'], 'zip_codes': ['*'], 'packstation': True, 'shipping_options': self.paket},
+            {'country_codes': ['AT'], 'zip_codes': ['60*']},
+        ])
+        self.assertEqual(destination_rules.check('DE', '10115', False), (True, True, self.express))
+        self.assertEqual(destination_rules.check('DE', '12345', False), (True, True, self.express))
+        self.assertEqual(destination_rules.check('DE', '80331', False), (True, True, self.paket))
+        # packstations are only allowed by the second rule and no billing destinations
+        self.assertEqual(destination_rules.check('DE', '12345', True), (False, True, self.paket))
+        self.assertEqual(destination_rules.check('AT', '6020', False), (True, True, []))
+        self.assertEqual(destination_rules.check('AT', '1010', False), (False, False, []))
+        self.assertEqual(destination_rules.check('FR', '75001', False), (False, False, []))
+
+    def test_cache(self):
+        destination_rules = PaydirektDestinationRules([{'country_codes': ['DE'], 'zip_codes': ['*']}], cache_size=2)
+        destination_rules.check('DE', '10115', False)
+        destination_rules.check('DE', '10115', False)
+        self.assertEqual(destination_rules.check.cache_info().hits, 1)
+
+    def test_express_checkout_notification(self):
+        PaydirektCheckout.objects.create(
+            total_amount=1.0,
+            checkout_id='123-abc-express',
+            status='OPEN',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-express/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-express')
+        client = Client()
+        post_data = {'checkoutId': '123-abc-express', 'merchantOrderReferenceNumber': '123-abc-express', 'orderAmount': 1.0,
+                     'destinations': [{'id': '1', 'countryCode': 'DE', 'zip': '10115', 'dhlPackstation': False},
+                                      {'id': '2', 'countryCode': 'FR', 'zip': '75001', 'dhlPackstation': False}]}
+        response = client.post('/paydirekt/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+        checked_destinations = json.loads(response.content.decode('utf-8'))['checkedDestinations']
+        self.assertEqual([destination['validShippingDestination'] for destination in checked_destinations], [True, False])
+        self.assertEqual(checked_destinations[0]['shippingOptions'], django_paydirekt_settings.PAYDIREKT_SHIPPING_OPTIONS)
+
+
+class TestPaydirektJSONCodec(TestCase):
+
+    def test_codecs(self):
+        json_codecs = [PaydirektJSONCodec()]
+        if orjson is not None:
+            json_codecs.append(PaydirektOrjsonCodec())
+        for json_codec in json_codecs:
+            data = json_codec.dumps({'amount': Decimal('1.50'), 'note': 'Bestellung über 1,50 €'})
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(json_codec.loads(data), {'amount': 1.5, 'note': 'Bestellung über 1,50 €'})
+
+    def test_codec_setting(self):
+        with Replacer() as replacer:
+            replacer.replace('django_paydirekt.settings.PAYDIREKT_JSON_CODEC', 'django_paydirekt.utils.PaydirektJSONCodec')
+            replacer.replace('django_paydirekt.utils._json_codec', None)
+            self.assertEqual(type(get_json_codec()), PaydirektJSONCodec)
+
+    def test_request_body(self):
+        paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        })
+        request = paydirekt_wrapper._get_api_request('/api/checkout/v1/checkouts', 'token', {'note': 'Größe'})
+        self.assertEqual(int(request.get_header('Content-length')), len(request.data))
+        self.assertEqual(json.loads(request.data), {'note': 'Größe'})
+
+
+class TestAsyncPaydirektNotifications(TestCase):
+    notify_url = '/paydirekt-async/notify/'
+
+    def setUp(self):
+        replacer = Replacer()
+        replacer.replace('django_paydirekt.wrappers.async_urlopen', mock_async_urlopen)
+        self.addCleanup(replacer.restore)
+
+    def test_get_notify(self):
+        client = Client()
+        response = client.get(self.notify_url)
+        self.assertEqual(response.status_code, 405)
+
+    def test_notify_callback_unknown_checkout(self):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-notfound1', 'merchantOrderReferenceNumber': '123-abc-notfound1', 'checkoutStatus': 'OPEN'}
+        response = client.post(self.notify_url, data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_notify_callback_invalid(self):
+        client = Client()
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved'}
+        response = client.post(self.notify_url, data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_known_checkout_known_at_paydirekt_correct_status(self):
+        client = Client()
+        self._create_test_checkout(checkout_id='123-abc-approved')
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'checkoutStatus': 'APPROVED'}
+        response = client.post(self.notify_url, data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-approved').status, 'APPROVED')
+
+    def test_known_checkout_known_at_paydirekt_incorrect_status(self):
+        client = Client()
+        self._create_test_checkout(checkout_id='123-abc-expired')
+        post_data = {'checkoutId': '123-abc-expired', 'merchantOrderReferenceNumber': '123-abc-expired', 'checkoutStatus': 'APPROVED'}
+        response = client.post(self.notify_url, data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_capture(self):
+        client = Client()
+        self._create_test_checkout(checkout_id='123-abc-approved')
+        post_data = {'checkoutId': '123-abc-approved', 'merchantOrderReferenceNumber': '123-abc-approved', 'transactionId': 'unknown', 'captureStatus': 'SUCCESSFUL'}
+        response = client.post(self.notify_url, data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual(response.status_code, 400)
+
+    def _create_test_checkout(self, checkout_id):
+        return PaydirektCheckout.objects.create(
+            total_amount=1.0,
+            checkout_id=checkout_id,
+            status='OPEN',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/'+checkout_id+'/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/'+checkout_id)
+
+
+class TestPaydirektTokenStore(TestCase):
+    token_response = {'access_token': 'abc', 'expires_in': 3599}
+
+    def setUp(self):
+        self.token_store = PaydirektTokenStore(refresh_ahead=60)
+        self.obtain_count = 0
+
+    def _obtain_token(self):
+        self.obtain_count += 1
+        return dict(self.token_response, access_token='token-{}'.format(self.obtain_count))
+
+    def test_token_reused(self):
+        self.assertEqual(self.token_store.get_token('key', self._obtain_token), 'token-1')
+        self.assertEqual(self.token_store.get_token('key', self._obtain_token), 'token-1')
+        self.assertEqual(self.obtain_count, 1)
+
+    def test_token_keyed(self):
+        self.assertEqual(self.token_store.get_token('sandbox', self._obtain_token), 'token-1')
+        self.assertEqual(self.token_store.get_token('production', self._obtain_token), 'token-2')
+        self.assertEqual(self.token_store.get_token('sandbox', self._obtain_token), 'token-1')
+
+    def test_token_refreshed_ahead_of_expiry(self):
+        self.token_store.get_token('key', self._obtain_token)
+        self.token_store._tokens['key']['refresh_at'] = time.time() - 1
+        self.assertEqual(self.token_store.get_token('key', self._obtain_token), 'token-2')
+
+    def test_token_kept_if_refresh_fails(self):
+        self.token_store.get_token('key', self._obtain_token)
+        self.token_store._tokens['key']['refresh_at'] = time.time() - 1
+        self.assertEqual(self.token_store.get_token('key', lambda: None), 'token-1')
+
+    def test_token_single_flight(self):
+        def slow_obtain_token():
+            time.sleep(0.1)
+            return self._obtain_token()
+
+        threads = [threading.Thread(target=self.token_store.get_token, args=('key', slow_obtain_token)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.obtain_count, 1)
+
+    @replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+    def test_wrapper_uses_token_store(self):
+        paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=self.token_store)
+        first_token = paydirekt_wrapper._get_access_token()
+        self.assertEqual(first_token, TEST_RESPONSES['token_obtain']['access_token'])
+        self.assertEqual(len(self.token_store._tokens), 1)
+        self.token_store._tokens[paydirekt_wrapper._get_token_store_key()]['access_token'] = 'cached'
+        self.assertEqual(paydirekt_wrapper._get_access_token(), 'cached')
+
+
+class TestPaydirektCacheTokenStore(TestCase):
+    cache_alias = 'default'
+
+    def setUp(self):
+        caches[self.cache_alias].clear()
+        self.obtain_count = 0
+
+    def _obtain_token(self):
+        self.obtain_count += 1
+        return {'access_token': 'token-{}'.format(self.obtain_count), 'expires_in': 3599}
+
+    def _get_token_stores(self, count=2):
+        return [PaydirektCacheTokenStore(cache_alias=self.cache_alias, lease_timeout=1) for i in range(count)]
+
+    def test_token_shared_between_stores(self):
+        first_store, second_store = self._get_token_stores()
+        self.assertEqual(first_store.get_token('key', self._obtain_token), 'token-1')
+        self.assertEqual(second_store.get_token('key', self._obtain_token), 'token-1')
+        self.assertEqual(self.obtain_count, 1)
+
+    def test_token_refreshed_once_while_leased(self):
+        first_store, second_store = self._get_token_stores()
+        first_store.get_token('key', self._obtain_token)
+        token = caches[self.cache_alias].get('key')
+        token['refresh_at'] = time.time() - 1
+        caches[self.cache_alias].set('key', token)
+        caches[self.cache_alias].add('key:lease', True)
+        # another process holds the lease, the current token is still valid
+        self.assertEqual(second_store.get_token('key', self._obtain_token), 'token-1')
+        self.assertEqual(self.obtain_count, 1)
+        caches[self.cache_alias].delete('key:lease')
+        self.assertEqual(second_store.get_token('key', self._obtain_token), 'token-2')
+        first_store._tokens.clear()
+        self.assertEqual(first_store.get_token('key', self._obtain_token), 'token-2')
+
+    def test_token_concurrent_stores(self):
+        def slow_obtain_token():
+            time.sleep(0.2)
+            return self._obtain_token()
+
+        threads = [threading.Thread(target=token_store.get_token, args=('key', slow_obtain_token)) for token_store in self._get_token_stores(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.obtain_count, 1)
+
+
+class TestPaydirektFileCacheTokenStore(TestPaydirektCacheTokenStore):
+    cache_alias = 'file'
+
+
+class TestPaydirektConnectionPool(TestCase):
+    tls = False
+
+    def setUp(self):
+        self.stub_server = StubServer(tls=self.tls).start()
+        ssl_context = None
+        if self.tls:
+            ssl_context = ssl.create_default_context(cafile=self.stub_server.certfile)
+        self.connection_pool = PaydirektConnectionPool(maxsize=2, ssl_context=ssl_context)
+
+    def tearDown(self):
+        self.connection_pool.clear()
+        self.stub_server.stop()
+
+    def test_connection_reused(self):
+        for i in range(5):
+            response = self.connection_pool.urlopen(Request('{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)))
+            self.assertEqual(json.loads(response.read().decode('utf-8'))['status'], 'APPROVED')
+        self.assertEqual(self.stub_server.request_count, 5)
+        self.assertEqual(self.stub_server.connection_count, 1)
+
+    def test_connections_bounded(self):
+        threads = [threading.Thread(target=self.connection_pool.urlopen, args=(Request('{}/api/merchantintegration/v1/token/obtain'.format(self.stub_server.url), data=b'{}'),)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.stub_server.request_count, 10)
+        self.assertLessEqual(self.stub_server.connection_count, 2)
+
+    def test_connection_wait_bounded_by_timeout(self):
+        self.stub_server.latency = 0.5
+        url = '{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)
+        threads = [threading.Thread(target=self.connection_pool.urlopen, args=(Request(url),)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        start = time.monotonic()
+        with self.assertRaises(socket.timeout):
+            self.connection_pool.urlopen(Request(url), timeout=0.1)
+        self.assertLess(time.monotonic() - start, 0.3)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.stub_server.request_count, 2)
+
+    def test_http_error(self):
+        with self.assertRaises(HTTPError) as context:
+            self.connection_pool.urlopen(Request('{}/api/checkout/v1/checkouts/unknown/'.format(self.stub_server.url)))
+        self.assertEqual(context.exception.code, 404)
+        self.assertEqual(context.exception.fp.read(), b'{}')
+        response = self.connection_pool.urlopen(Request('{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)))
+        self.assertEqual(response.getcode(), 200)
+        self.assertEqual(self.stub_server.connection_count, 1)
+
+    def test_reconnect_after_server_closed_connection(self):
+        self.connection_pool.urlopen(Request('{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)))
+        for host in self.connection_pool._hosts.values():
+            for connection in host['connections']:
+                connection.sock.shutdown(2)
+        response = self.connection_pool.urlopen(Request('{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)))
+        self.assertEqual(response.getcode(), 200)
+
+    def test_only_get_resent_after_dropped_connection(self):
+        url = '{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)
+        self.connection_pool.urlopen(Request(url))
+        self.stub_server.drop_count = 1
+        with self.assertRaises(http.client.RemoteDisconnected):
+            self.connection_pool.urlopen(Request('{}captures'.format(url), data=b'{"amount": 10}'))
+        self.assertEqual(self.stub_server.request_count, 2)
+        self.connection_pool.urlopen(Request(url))
+        self.stub_server.drop_count = 1
+        response = self.connection_pool.urlopen(Request(url))
+        self.assertEqual(response.getcode(), 200)
+        self.assertEqual(self.stub_server.request_count, 5)
+
+    def test_proxy(self):
+        url = '{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)
+        with Replacer() as replacer:
+            # the stub server answers the absolute-form requests of a plain http proxy
+            replacer.replace('django_paydirekt.transport.getproxies', lambda: {'http': 'user:secret@{0}'.format(self.stub_server.url[7:])})
+            response = self.connection_pool.urlopen(Request(url.replace('127.0.0.1', 'paydirekt.invalid', 1)))
+        self.assertEqual(json.loads(response.read().decode('utf-8'))['status'], 'APPROVED')
+        self.assertEqual(self.stub_server.connection_count, 1)
+
+    def test_wrapper_call_api(self):
+        paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+        paydirekt_wrapper.api_url = self.stub_server.url
+        with Replacer() as replacer:
+            replacer.replace('django_paydirekt.transport.paydirekt_connection_pool', self.connection_pool)
+            checkout_response = paydirekt_wrapper.call_api('/api/checkout/v1/checkouts/123-abc-approved/')
+            self.assertEqual(checkout_response['status'], 'APPROVED')
+            self.assertFalse(paydirekt_wrapper.call_api('/api/checkout/v1/checkouts/unknown/'))
+        self.assertEqual(self.stub_server.request_count, 3)
+        self.assertEqual(self.stub_server.connection_count, 1)
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is required to create the stub certificate')
+class TestPaydirektTLSConnectionPool(TestPaydirektConnectionPool):
+    tls = True
+
+    def test_tls_session_resumed(self):
+        url = '{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)
+        self.connection_pool.urlopen(Request(url))
+        host = list(self.connection_pool._hosts.values())[0]
+        self.assertIsNotNone(host['tls_session'])
+        for connection in host['connections']:
+            connection.close()
+        host['connections'] = []
+        self.connection_pool.urlopen(Request(url))
+        self.assertTrue(host['connections'][0].sock.session_reused)
+        self.assertEqual(self.stub_server.connection_count, 2)
+
+    def test_proxy(self):
+        stub_proxy = StubProxy().start()
+        self.addCleanup(stub_proxy.stop)
+        url = '{}/api/checkout/v1/checkouts/123-abc-approved/'.format(self.stub_server.url)
+        with Replacer() as replacer:
+            replacer.replace('django_paydirekt.transport.getproxies', lambda: {'https': stub_proxy.url.replace('//', '//user:secret@')})
+            for i in range(2):
+                response = self.connection_pool.urlopen(Request(url))
+                self.assertEqual(json.loads(response.read().decode('utf-8'))['status'], 'APPROVED')
+        self.assertEqual(stub_proxy.tunnels, [('127.0.0.1:{0}'.format(self.stub_server.server_address[1]), 'Basic dXNlcjpzZWNyZXQ=')])
+        self.assertEqual(self.stub_server.connection_count, 1)
+
+
+class TestPaydirektBulkRefresh(TestCase):
+
+    def setUp(self):
+        self.paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+
+    @replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+    def test_refresh_many_checkouts(self):
+        for checkout_id in ('123-abc-approved', '123-abc-expired', '123-abc-approved-minimal', '123-abc-notfound'):
+            PaydirektCheckout.objects.create(
+                total_amount=1.0,
+                checkout_id=checkout_id,
+                status='OPEN',
+                link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/'+checkout_id+'/',
+                approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/'+checkout_id)
+        PaydirektCheckout.objects.filter(checkout_id='123-abc-approved-minimal').update(status='APPROVED')
+
+        # one query to load the checkouts and one bulk update
+        with self.assertNumQueries(2):
+            changed_checkouts, failed_checkouts = PaydirektCheckout.objects.refresh_many(
+                PaydirektCheckout.objects.all(), self.paydirekt_wrapper, max_workers=4)
+        self.assertEqual(sorted(checkout.checkout_id for checkout in changed_checkouts), ['123-abc-approved', '123-abc-expired'])
+        self.assertEqual([checkout.checkout_id for checkout in failed_checkouts], ['123-abc-notfound'])
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-approved').status, 'APPROVED')
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-expired').status, 'EXPIRED')
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-notfound').status, 'OPEN')
+
+    @replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+    def test_refresh_many_captures(self):
+        paydirekt_checkout = PaydirektCheckout.objects.create(
+            total_amount=1.0,
+            checkout_id='123-abc-approved',
+            status='APPROVED',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-approved')
+        PaydirektCapture.objects.create(
+            checkout=paydirekt_checkout,
+            amount=1.0,
+            transaction_id='123-abc-capture',
+            status='PENDING',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures')
+        changed_captures, failed_captures = PaydirektCapture.objects.refresh_many(PaydirektCapture.objects.all(), self.paydirekt_wrapper)
+        self.assertEqual(len(changed_captures), 1)
+        self.assertEqual(failed_captures, [])
+        self.assertEqual(PaydirektCapture.objects.get(transaction_id='123-abc-capture').status, 'SUCCESSFUL')
+
+    @replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+    def test_reconcile_command(self):
+        for checkout_id in ('123-abc-approved', '123-abc-expired', '123-abc-notfound', '123-abc-recent'):
+            PaydirektCheckout.objects.create(
+                total_amount=1.0,
+                checkout_id=checkout_id,
+                status='OPEN',
+                link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/'+checkout_id+'/',
+                approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/'+checkout_id)
+        PaydirektCheckout.objects.exclude(checkout_id='123-abc-recent').update(created_at=timezone.now() - timedelta(hours=2))
+        PaydirektCheckout.objects.filter(checkout_id='123-abc-recent').update(link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-expired/')
+
+        stdout = StringIO()
+        call_command('paydirekt_reconcile', '--chunk-size=2', '--workers=2', '--rate=100', stdout=stdout)
+        self.assertIn('3 checkouts reconciled, 2 changed, 1 errors', stdout.getvalue())
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-approved').status, 'APPROVED')
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-expired').status, 'EXPIRED')
+        self.assertEqual(PaydirektCheckout.objects.get(checkout_id='123-abc-recent').status, 'OPEN')
+
+    def test_refresh_many_empty(self):
+        self.assertEqual(PaydirektRefund.objects.refresh_many(PaydirektRefund.objects.none(), self.paydirekt_wrapper), ([], []))
+
+    def test_migrations_complete(self):
+        call_command('makemigrations', 'django_paydirekt', '--check', '--dry-run', stdout=StringIO())
+
+
+class TestPaydirektCheckoutTotals(TestCase):
+
+    def setUp(self):
+        self.paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+        self.paydirekt_checkout = PaydirektCheckout.objects.create(
+            total_amount=100,
+            checkout_id='123-abc-approved',
+            status='APPROVED',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-approved',
+            captures_link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures',
+            refunds_link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/refunds')
+
+    def assertTotals(self, captured_amount, refunded_amount, capture_count):
+        paydirekt_checkout = PaydirektCheckout.objects.get(pk=self.paydirekt_checkout.pk)
+        self.assertEqual((paydirekt_checkout.captured_amount, paydirekt_checkout.refunded_amount, paydirekt_checkout.capture_count),
+                         (captured_amount, refunded_amount, capture_count))
+
+    @replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+    def test_create_capture_and_refund(self):
+        paydirekt_capture = self.paydirekt_checkout.create_capture(amount=50, paydirekt_wrapper=self.paydirekt_wrapper)
+        self.paydirekt_checkout.create_refund(amount=50, paydirekt_wrapper=self.paydirekt_wrapper)
+        self.assertTotals(50, 50, 1)
+        self.assertEqual((self.paydirekt_checkout.captured_amount, self.paydirekt_checkout.refunded_amount), (50, 50))
+
+        PaydirektCapture.objects.apply_notified_status(paydirekt_capture, 'REJECTED')
+        self.assertTotals(0, 50, 0)
+        # the capture is SUCCESSFUL at paydirekt
+        paydirekt_capture.link = 'https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures'
+        self.assertTrue(paydirekt_capture.refresh_from_paydirekt(self.paydirekt_wrapper))
+        self.assertTotals(50, 50, 1)
+
+    @replace('django_paydirekt.wrappers.urlopen', mock_urlopen)
+    def test_refresh_many(self):
+        for transaction_id in ('123-abc-capture-1', '123-abc-capture-2'):
+            PaydirektCapture.objects.create(
+                checkout=self.paydirekt_checkout,
+                amount=10,
+                transaction_id=transaction_id,
+                status='REJECTED',
+                link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures')
+        PaydirektCapture.objects.refresh_many(PaydirektCapture.objects.all(), self.paydirekt_wrapper)
+        self.assertTotals(20, 0, 2)
+
+    def test_local_validation(self):
+        urlopen_calls = []
+
+        def recording_urlopen(request, timeout=None):
+            urlopen_calls.append(request.full_url)
+            return mock_urlopen(request, timeout)
+
+        with Replacer() as r:
+            r.replace('django_paydirekt.wrappers.urlopen', recording_urlopen)
+            self.assertFalse(self.paydirekt_checkout.create_capture(amount=120, paydirekt_wrapper=self.paydirekt_wrapper))
+            self.assertFalse(self.paydirekt_checkout.create_capture(amount=0, paydirekt_wrapper=self.paydirekt_wrapper))
+            self.assertFalse(self.paydirekt_checkout.create_refund(amount=10, paydirekt_wrapper=self.paydirekt_wrapper))
+            self.assertTrue(self.paydirekt_checkout.create_capture(amount=50, paydirekt_wrapper=self.paydirekt_wrapper))
+            self.assertFalse(self.paydirekt_checkout.create_refund(amount=60, paydirekt_wrapper=self.paydirekt_wrapper))
+            self.assertFalse(async_to_sync(self.paydirekt_checkout.acreate_capture)(amount=60, paydirekt_wrapper=self.paydirekt_wrapper))
+            self.paydirekt_checkout.status = 'CLOSED'
+            self.assertFalse(self.paydirekt_checkout.create_capture(amount=10, paydirekt_wrapper=self.paydirekt_wrapper))
+            self.assertEqual(len(urlopen_calls), 2)
+
+            # paydirekt decides without local validation
+            self.assertFalse(self.paydirekt_checkout.create_capture(amount=10, paydirekt_wrapper=self.paydirekt_wrapper, validate=False))
+            self.assertEqual(len(urlopen_calls), 3)
+            r.replace('django_paydirekt.settings.PAYDIREKT_LOCAL_VALIDATION', False)
+            self.assertFalse(self.paydirekt_checkout.create_refund(amount=60, paydirekt_wrapper=self.paydirekt_wrapper))
+            self.assertEqual(len(urlopen_calls), 4)
+            r.replace('django_paydirekt.settings.PAYDIREKT_LOCAL_VALIDATION', True)
+
+            # captures above the total amount are up to paydirekt for overcapture checkouts and checkouts of unknown overcapture
+            self.paydirekt_checkout.status = 'APPROVED'
+            for overcapture in (True, None):
+                self.paydirekt_checkout.overcapture = overcapture
+                self.assertIsNone(self.paydirekt_checkout._get_capture_error(120))
+            self.paydirekt_checkout.overcapture = False
+            self.assertTrue(self.paydirekt_checkout._get_capture_error(120))
+
+            # e.g. a trusted APPROVED status, the links are only set when the status is verified
+            self.paydirekt_checkout.captures_link = ''
+            urlopen_count = len(urlopen_calls)
+            self.assertFalse(self.paydirekt_checkout.create_capture(amount=10, paydirekt_wrapper=self.paydirekt_wrapper, validate=False))
+            results = PaydirektCapture.objects.create_many([(self.paydirekt_checkout, 10, False, None)], self.paydirekt_wrapper)
+            self.assertEqual(results[0].error, 'checkout has no captures link')
+            self.assertEqual(len(urlopen_calls), urlopen_count)
+
+    def test_backfill_command(self):
+        for transaction_id, status in (('123-abc-capture-1', 'SUCCESSFUL'), ('123-abc-capture-2', 'REJECTED')):
+            PaydirektCapture.objects.create(checkout=self.paydirekt_checkout, amount=30, transaction_id=transaction_id, status=status,
+                                            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures')
+        PaydirektRefund.objects.create(checkout=self.paydirekt_checkout, amount=10, transaction_id='123-abc-refund', status='PENDING',
+                                       link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/refunds')
+        PaydirektCheckout.objects.create(total_amount=10, checkout_id='123-abc-expired', status='EXPIRED',
+                                         link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-expired/',
+                                         approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-expired')
+
+        stdout = StringIO()
+        call_command('paydirekt_backfill_totals', '--chunk-size=1', stdout=stdout)
+        self.assertIn('2 checkouts backfilled, 1 changed', stdout.getvalue())
+        self.assertTotals(30, 10, 1)
+
+
+class TransactionsPaydirektWrapper(PaydirektWrapper):
+    unavailable_from = None
+
+    def call_api(self, url=None, access_token=None, data=None, deadline=None):
+        if data['from'] == self.unavailable_from:
+            return False
+        time.sleep(0.01)
+        return {'transactions': [{'from': data['from'], 'to': data['to'], 'fields': data.get('fields'),
+                                  'paymentInformationId': 'payment-{}'.format(data['from'][:13]), 'transactionType': 'CAPTURE',
+                                  'merchantReferenceNumber': '123', 'amount': 10.5, 'currency': 'EUR', 'timestamp': data['from']}]}
+
+
+class AsyncTransactionsPaydirektWrapper(AsyncPaydirektWrapper):
+
+    async def call_api(self, url=None, access_token=None, data=None, deadline=None):
+        await asyncio.sleep(0.01)
+        return {'transactions': [{'from': data['from'], 'to': data['to']}]}
+
+
+class TestPaydirektTransactions(TestCase):
+    auth = {
+        'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+        'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+    }
+
+    def test_iter_transactions(self):
+        paydirekt_wrapper = TransactionsPaydirektWrapper(auth=self.auth)
+        transactions = paydirekt_wrapper.iter_transactions(datetime(2019, 1, 1), datetime(2019, 1, 3, 12), window=timedelta(days=1),
+                                                           max_workers=2, fields=['amount'])
+        self.assertEqual([(transaction['from'], transaction['to'], transaction['fields']) for transaction in transactions], [
+            ('2019-01-01T00:00:00', '2019-01-02T00:00:00', ['amount']),
+            ('2019-01-02T00:00:00', '2019-01-03T00:00:00', ['amount']),
+            ('2019-01-03T00:00:00', '2019-01-03T12:00:00', ['amount']),
+        ])
+
+    def test_iter_transactions_unavailable(self):
+        paydirekt_wrapper = TransactionsPaydirektWrapper(auth=self.auth)
+        paydirekt_wrapper.unavailable_from = '2019-01-02T00:00:00'
+        transactions = paydirekt_wrapper.iter_transactions(datetime(2019, 1, 1), datetime(2019, 1, 3))
+        self.assertEqual(next(transactions)['from'], '2019-01-01T00:00:00')
+        with self.assertRaises(PaydirektTransactionsError):
+            next(transactions)
+
+    def test_iter_transactions_empty_window(self):
+        paydirekt_wrapper = TransactionsPaydirektWrapper(auth=self.auth)
+        with self.assertRaises(ValueError):
+            next(paydirekt_wrapper.iter_transactions(datetime(2019, 1, 1), datetime(2019, 1, 3), window=timedelta(0)))
+        with self.assertRaises(CommandError):
+            call_command('paydirekt_sync_transactions', '--window=0')
+
+    def test_sync_transactions(self):
+        paydirekt_wrapper = TransactionsPaydirektWrapper(auth=self.auth)
+        now = timezone.now().replace(minute=30, second=0, microsecond=0)
+        transaction_count = PaydirektTransaction.objects.sync(paydirekt_wrapper, from_datetime=now - timedelta(hours=5),
+                                                              to_datetime=now, window=timedelta(hours=1))
+        self.assertEqual(transaction_count, 5)
+        self.assertEqual(PaydirektTransaction.objects.count(), 5)
+        self.assertEqual(PaydirektTransactionSync.objects.get(key='default').synced_until, now)
+        paydirekt_transaction = PaydirektTransaction.objects.order_by('timestamp').first()
+        self.assertEqual(paydirekt_transaction.timestamp, now - timedelta(hours=5))
+        self.assertEqual(paydirekt_transaction.amount, Decimal('10.50'))
+        self.assertEqual(paydirekt_transaction.merchant_reference_number, '123')
+
+        # only the delta since the high-water mark and the overlap are fetched
+        transaction_count = PaydirektTransaction.objects.sync(paydirekt_wrapper, to_datetime=now + timedelta(hours=2),
+                                                              window=timedelta(hours=1), overlap=timedelta(hours=1))
+        self.assertEqual(transaction_count, 3)
+        self.assertEqual(PaydirektTransaction.objects.count(), 7)
+        self.assertEqual(PaydirektTransactionSync.objects.get(key='default').synced_until, now + timedelta(hours=2))
+
+    def test_sync_transactions_unavailable(self):
+        paydirekt_wrapper = TransactionsPaydirektWrapper(auth=self.auth)
+        now = timezone.now()
+        paydirekt_wrapper.unavailable_from = (now - timedelta(hours=1)).isoformat()
+        with self.assertRaises(PaydirektTransactionsError):
+            PaydirektTransaction.objects.sync(paydirekt_wrapper, from_datetime=now - timedelta(hours=2), to_datetime=now,
+                                              window=timedelta(hours=1))
+        self.assertIsNone(PaydirektTransactionSync.objects.get(key='default').synced_until)
+
+    async def test_async_iter_transactions(self):
+        paydirekt_wrapper = AsyncTransactionsPaydirektWrapper(auth=self.auth)
+        transactions = []
+        async for transaction in paydirekt_wrapper.iter_transactions(datetime(2019, 1, 1), datetime(2019, 1, 11), max_workers=4):
+            transactions.append(transaction)
+        self.assertEqual([transaction['from'][:10] for transaction in transactions], ['2019-01-{:02d}'.format(day) for day in range(1, 11)])
+
+
+class TestAsyncPaydirektWrapper(TestCase):
+
+    def setUp(self):
+        self.paydirekt_wrapper = AsyncPaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+
+    async def test_init(self):
+        with Replacer() as replacer:
+            replacer.replace('django_paydirekt.wrappers.async_urlopen', mock_async_urlopen)
+            paydirekt_checkout = await self.paydirekt_wrapper.init(
+                total_amount=100,
+                reference_number='1',
+                payment_type='ORDER',
+                shopping_cart_type='ANONYMOUS_DONATION')
+        self.assertEqual(paydirekt_checkout.checkout_id, '123-abc-created')
+        self.assertEqual(paydirekt_checkout.status, 'OPEN')
+        self.assertTrue(await sync_to_async(PaydirektCheckout.objects.filter(checkout_id='123-abc-created').exists)())
+
+    async def test_checkout_operations(self):
+        replacer = Replacer()
+        replacer.replace('django_paydirekt.wrappers.async_urlopen', mock_async_urlopen)
+        self.addCleanup(replacer.restore)
+        paydirekt_checkout = await sync_to_async(PaydirektCheckout.objects.create)(
+            total_amount=100,
+            checkout_id='123-abc-approved',
+            status='OPEN',
+            link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/',
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-approved',
+            captures_link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/captures',
+            refunds_link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/refunds',
+            close_link='https://api.sandbox.paydirekt.de/api/checkout/v1/checkouts/123-abc-approved/close')
+        self.assertTrue(await paydirekt_checkout.arefresh_from_paydirekt(self.paydirekt_wrapper, expected_status='APPROVED'))
+        self.assertEqual(paydirekt_checkout.status, 'APPROVED')
+        paydirekt_capture = await paydirekt_checkout.acreate_capture(amount=50, paydirekt_wrapper=self.paydirekt_wrapper)
+        self.assertEqual(paydirekt_capture.status, 'SUCCESSFUL')
+        paydirekt_refund = await paydirekt_checkout.acreate_refund(amount=50, paydirekt_wrapper=self.paydirekt_wrapper)
+        self.assertEqual(paydirekt_refund.status, 'PENDING')
+        self.assertEqual((paydirekt_checkout.captured_amount, paydirekt_checkout.refunded_amount, paydirekt_checkout.capture_count), (50, 50, 1))
+        self.assertFalse(await paydirekt_checkout.acreate_capture(amount=60, paydirekt_wrapper=self.paydirekt_wrapper))
+        self.assertTrue(await paydirekt_checkout.aclose(self.paydirekt_wrapper))
+        await sync_to_async(paydirekt_checkout.refresh_from_db)()
+        self.assertEqual(paydirekt_checkout.status, 'CLOSED')
+
+    async def test_token_single_flight(self):
+        obtain_count = []
+
+        async def obtain_token():
+            obtain_count.append(1)
+            await asyncio.sleep(0.1)
+            return {'access_token': 'abc', 'expires_in': 3599}
+
+        token_store = PaydirektTokenStore()
+        tokens = await asyncio.gather(*[token_store.aget_token('key', obtain_token) for i in range(10)])
+        self.assertEqual(tokens, ['abc'] * 10)
+        self.assertEqual(len(obtain_count), 1)
+
+    async def test_connection_pool(self):
+        stub_server = StubServer().start()
+        connection_pool = AsyncPaydirektConnectionPool(maxsize=2)
+        try:
+            url = '{}/api/checkout/v1/checkouts/123-abc-approved/'.format(stub_server.url)
+            responses = await asyncio.gather(*[connection_pool.urlopen(Request(url)) for i in range(6)])
+            for response in responses:
+                self.assertEqual(json.loads(response.read().decode('utf-8'))['status'], 'APPROVED')
+            response = await connection_pool.urlopen(Request('{}/api/merchantintegration/v1/token/obtain'.format(stub_server.url), data=b'{}'))
+            self.assertIn('access_token', json.loads(response.read().decode('utf-8')))
+            with self.assertRaises(HTTPError):
+                await connection_pool.urlopen(Request('{}/api/checkout/v1/checkouts/unknown/'.format(stub_server.url)))
+            self.assertEqual(stub_server.request_count, 8)
+            self.assertLessEqual(stub_server.connection_count, 2)
+        finally:
+            connection_pool.clear()
+            stub_server.stop()
+
+    async def test_proxy(self):
+        stub_server = StubServer().start()
+        try:
+            url = '{}/api/checkout/v1/checkouts/123-abc-approved/'.format(stub_server.url)
+            with Replacer() as replacer:
+                replacer.replace('django_paydirekt.transport.getproxies', lambda: {'http': stub_server.url})
+                replacer.replace('django_paydirekt.transport.paydirekt_connection_pool', PaydirektConnectionPool())
+                response = await async_transport_urlopen(Request(url.replace('127.0.0.1', 'paydirekt.invalid', 1)))
+            self.assertEqual(json.loads(response.read().decode('utf-8'))['status'], 'APPROVED')
+        finally:
+            stub_server.stop()
+
+    async def test_connection_pool_only_get_resent(self):
+        stub_server = StubServer().start()
+        connection_pool = AsyncPaydirektConnectionPool(maxsize=1)
+        try:
+            url = '{}/api/checkout/v1/checkouts/123-abc-approved/'.format(stub_server.url)
+            await connection_pool.urlopen(Request(url))
+            stub_server.drop_count = 1
+            with self.assertRaises(http.client.RemoteDisconnected):
+                await connection_pool.urlopen(Request('{}captures'.format(url), data=b'{"amount": 10}'))
+            self.assertEqual(stub_server.request_count, 2)
+            await connection_pool.urlopen(Request(url))
+            stub_server.drop_count = 1
+            response = await connection_pool.urlopen(Request(url))
+            self.assertEqual(response.getcode(), 200)
+            self.assertEqual(stub_server.request_count, 5)
+        finally:
+            connection_pool.clear()
+            stub_server.stop()
+
+
+class TestPaydirektStubServer(TestCase):
+
+    def setUp(self):
+        self.stub_server = StubServer().start()
+        self.addCleanup(self.stub_server.stop)
+        self.paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+        self.paydirekt_wrapper.api_url = self.stub_server.url
+
+    def test_checkout_lifecycle(self):
+        paydirekt_checkout = self.paydirekt_wrapper.init(total_amount=10.0, reference_number='1', payment_type='ORDER',
+                                                         shopping_cart_type='ANONYMOUS_DONATION')
+        self.assertEqual(paydirekt_checkout.status, 'OPEN')
+        self.assertTrue(paydirekt_checkout.refresh_from_paydirekt(self.paydirekt_wrapper))
+        self.assertEqual(paydirekt_checkout.status, 'APPROVED')
+        self.assertEqual(paydirekt_checkout.create_capture(amount=5.0, paydirekt_wrapper=self.paydirekt_wrapper).status, 'SUCCESSFUL')
+        self.assertEqual(paydirekt_checkout.create_refund(amount=5.0, paydirekt_wrapper=self.paydirekt_wrapper).status, 'PENDING')
+        self.assertTrue(paydirekt_checkout.close(self.paydirekt_wrapper))
+        transactions = self.paydirekt_wrapper.transactions(from_datetime=datetime(2019, 1, 1), to_datetime=datetime(2019, 1, 2))
+        self.assertEqual(len(transactions), 10)
+
+    def test_error_injection(self):
+        self.paydirekt_wrapper.retries = 0
+        self.stub_server.error_rate = 1
+        paydirekt_checkout = self.paydirekt_wrapper.init(total_amount=10.0, reference_number='1', payment_type='ORDER',
+                                                         shopping_cart_type='ANONYMOUS_DONATION')
+        self.assertFalse(paydirekt_checkout)
+
+
+class TestPaydirektBulkOperations(TestCase):
+
+    def setUp(self):
+        self.stub_server = StubServer().start()
+        self.addCleanup(self.stub_server.stop)
+        self.paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+        self.paydirekt_wrapper.api_url = self.stub_server.url
+        self.paydirekt_checkouts = []
+        for reference_number in ('1', '2'):
+            paydirekt_checkout = self.paydirekt_wrapper.init(total_amount=10.0, reference_number=reference_number, payment_type='ORDER',
+                                                             shopping_cart_type='ANONYMOUS_DONATION')
+            paydirekt_checkout.refresh_from_paydirekt(self.paydirekt_wrapper)
+            self.paydirekt_checkouts.append(paydirekt_checkout)
+        # unknown at paydirekt
+        self.paydirekt_checkouts.append(PaydirektCheckout.objects.create(
+            total_amount=10, checkout_id='123-abc-unknown', status='APPROVED',
+            link='{0}/api/checkout/v1/checkouts/123-abc-unknown'.format(self.stub_server.url),
+            approve_link='https://sandbox.paydirekt.de/checkout/#/checkout/123-abc-unknown',
+            captures_link='{0}/api/checkout/v1/checkouts/123-abc-unknown/captures'.format(self.stub_server.url)))
+
+    def test_create_captures(self):
+        first_checkout, second_checkout, unknown_checkout = self.paydirekt_checkouts
+        # one insert, one totals update per checkout
+        with self.assertNumQueries(3):
+            results = PaydirektCapture.objects.create_many([
+                (first_checkout, 4, False, 'shipment-1'),
+                (first_checkout, 6, True, 'shipment-2'),
+                (second_checkout, 8, False, 'shipment-3'),
+                (second_checkout, 8, False, 'shipment-4'),
+                (unknown_checkout, 5, False, 'shipment-5'),
+            ], self.paydirekt_wrapper, max_workers=3)
+        self.assertEqual([bool(result) for result in results], [True, True, True, False, False])
+        self.assertEqual(results[3].error, 'amount 8 is above the remaining 2.0')
+        self.assertEqual(results[4].error, 'capture failed at paydirekt')
+        self.assertEqual(results[1].paydirekt_object.final, True)
+        self.assertEqual(PaydirektCapture.objects.filter(status='SUCCESSFUL').count(), 3)
+        self.assertEqual((first_checkout.captured_amount, first_checkout.capture_count), (10, 2))
+        first_checkout.refresh_from_db()
+        second_checkout.refresh_from_db()
+        self.assertEqual((first_checkout.captured_amount, first_checkout.capture_count), (10, 2))
+        self.assertEqual((second_checkout.captured_amount, second_checkout.capture_count), (8, 1))
+        # 4 captures with the cached token after token, init and refresh of the setup
+        self.assertEqual(self.stub_server.request_count, 5 + 4)
+
+
+    def test_create_refunds(self):
+        first_checkout, second_checkout, unknown_checkout = self.paydirekt_checkouts
+        PaydirektCapture.objects.create_many([(first_checkout, 10, True, 'shipment-1')], self.paydirekt_wrapper)
+        with self.assertNumQueries(2):
+            results = PaydirektRefund.objects.create_many([
+                (first_checkout, 4, 'Recall', 'recall-1'),
+                (first_checkout, 7, 'Recall', 'recall-2'),
+                (second_checkout, 1, 'Recall', 'recall-3'),
+                (unknown_checkout, 1, 'Recall', 'recall-4'),
+            ], self.paydirekt_wrapper)
+        self.assertEqual([result.error for result in results], [
+            None, 'amount 7 is above the refundable 6', 'amount 1 is above the refundable 0', 'checkout has no refunds link'])
+        self.assertEqual(results[0].paydirekt_object.status, 'PENDING')
+        self.assertEqual(PaydirektRefund.objects.get().amount, 4)
+        first_checkout.refresh_from_db()
+        self.assertEqual((first_checkout.captured_amount, first_checkout.refunded_amount), (10, 4))
+
+    def test_close(self):
+        first_checkout, second_checkout, unknown_checkout = self.paydirekt_checkouts
+        unknown_checkout.close_link = '{0}/close'.format(unknown_checkout.link)
+        second_checkout.close_link = ''
+        with self.assertNumQueries(1):
+            results = PaydirektCheckout.objects.close_many(self.paydirekt_checkouts, self.paydirekt_wrapper)
+        self.assertEqual([result.error for result in results], [None, 'checkout has no close link', 'close failed at paydirekt'])
+        self.assertEqual(results[0].paydirekt_object, first_checkout)
+        self.assertEqual(dict(PaydirektCheckout.objects.values_list('checkout_id', 'status')), {
+            first_checkout.checkout_id: 'CLOSED',
+            second_checkout.checkout_id: 'APPROVED',
+            unknown_checkout.checkout_id: 'APPROVED',
+        })
+
+    def test_init_many(self):
+        checkouts = [
+            {'total_amount': 10.0, 'reference_number': 'invoice-1', 'payment_type': 'ORDER', 'shopping_cart_type': 'ANONYMOUS_DONATION'},
+            {'total_amount': 10.0, 'reference_number': 'invoice-2', 'payment_type': 'INVOICE', 'shopping_cart_type': 'ANONYMOUS_DONATION'},
+            {'total_amount': 20.0, 'reference_number': 'invoice-3', 'payment_type': 'DIRECT_SALE', 'shopping_cart_type': 'ANONYMOUS_DONATION'},
+            {'total_amount': 20.0, 'payment_type': 'ORDER'},
+        ]
+        with self.assertNumQueries(1):
+            results = self.paydirekt_wrapper.init_many(checkouts, max_workers=2)
+        self.assertEqual([result.error for result in results][:3], [None, 'invalid checkout data', None])
+        self.assertTrue(results[3].error.startswith('invalid checkout arguments: '))
+        self.assertEqual([result.item for result in results], checkouts)
+        self.assertEqual(results[2].paydirekt_object.status, 'OPEN')
+        self.assertIs(results[2].paydirekt_object.overcapture, False)
+        self.assertEqual(PaydirektCheckout.objects.filter(checkout_id__in=[results[0].paydirekt_object.checkout_id,
+                                                                           results[2].paydirekt_object.checkout_id]).count(), 2)
+
+        self.paydirekt_wrapper.retries = 0
+        self.stub_server.error_rate = 1
+        results = self.paydirekt_wrapper.init_many(checkouts[:1])
+        self.assertEqual(results[0].error, 'checkout failed at paydirekt')
+
+    def test_async_init_many(self):
+        paydirekt_wrapper = AsyncPaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+        paydirekt_wrapper.api_url = self.stub_server.url
+        start = time.perf_counter()
+        results = async_to_sync(paydirekt_wrapper.init_many)([
+            {'total_amount': 10.0, 'reference_number': str(reference_number), 'payment_type': 'ORDER',
+             'shopping_cart_type': 'ANONYMOUS_DONATION'} for reference_number in range(5)], max_workers=2,
+            rate_limiter=PaydirektRateLimiter(50))
+        # 4 intervals of the rate limiter between the 5 checkouts
+        self.assertGreaterEqual(time.perf_counter() - start, 0.08)
+        self.assertTrue(all(results))
+        self.assertEqual(PaydirektCheckout.objects.count(), len(self.paydirekt_checkouts) + 5)
+
+
+class TestPaydirektRetries(TestCase):
+
+    def setUp(self):
+        self.stub_server = StubServer(error_rate=1).start()
+        self.addCleanup(self.stub_server.stop)
+        self.paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+        self.paydirekt_wrapper.api_url = self.stub_server.url
+        self.paydirekt_wrapper.retry_backoff = 0.001
+        self.replacer = Replacer()
+        self.addCleanup(self.replacer.restore)
+        self.replacer.replace('django_paydirekt.utils._circuit_breakers', {})
+
+    def _init_checkout(self):
+        return self.paydirekt_wrapper.init(total_amount=10.0, reference_number='1', payment_type='ORDER',
+                                           shopping_cart_type='ANONYMOUS_DONATION')
+
+    def test_unavailable_retried(self):
+        # the token obtain and the checkout creation
+        self.assertFalse(self._init_checkout())
+        self.assertEqual(self.stub_server.request_count, 6)
+
+    def test_idempotent_request_recovers(self):
+        self.stub_server.random.random = iter([0, 1, 1, 1]).__next__
+        self.assertEqual(self._init_checkout().status, 'OPEN')
+        self.assertEqual(self.stub_server.request_count, 3)
+
+    def test_token_request_signed_per_attempt(self):
+        request_ids = []
+
+        def recording_urlopen(request, timeout=None):
+            request_ids.append(request.get_header('X-request-id'))
+            return transport_urlopen(request, timeout=timeout)
+
+        self.replacer.replace('django_paydirekt.wrappers.urlopen', recording_urlopen)
+        self.stub_server.random.random = iter([0, 0, 1]).__next__
+        self.assertTrue(self.paydirekt_wrapper._get_access_token())
+        self.assertEqual(len(request_ids), 3)
+        self.assertEqual(len(set(request_ids)), 3)
+
+    def test_async_idempotent_request_retried(self):
+        paydirekt_wrapper = AsyncPaydirektWrapper(auth=self.paydirekt_wrapper.auth, token_store=PaydirektTokenStore())
+        paydirekt_wrapper.api_url = self.stub_server.url
+        paydirekt_wrapper.retry_backoff = 0.001
+        self.assertFalse(async_to_sync(paydirekt_wrapper.transactions)(from_datetime=datetime(2019, 1, 1), to_datetime=datetime(2019, 1, 2)))
+        self.assertEqual(self.stub_server.request_count, 6)
+
+    def test_unsafe_request_not_retried_on_server_error(self):
+        self.stub_server.error_rate = 0
+        paydirekt_checkout = self._init_checkout()
+        self.stub_server.error_rate = 1
+        self.stub_server.error_status = 500
+        request_count = self.stub_server.request_count
+        self.assertFalse(paydirekt_checkout.refresh_from_paydirekt(self.paydirekt_wrapper))
+        self.assertEqual(self.stub_server.request_count, request_count + 3)
+        self.assertFalse(self.paydirekt_wrapper.init(total_amount=10.0, reference_number='2', payment_type='ORDER',
+                                                     shopping_cart_type='ANONYMOUS_DONATION'))
+        self.assertEqual(self.stub_server.request_count, request_count + 4)
+
+    def test_retry_after(self):
+        self.stub_server.retry_after = 0.1
+        start = time.perf_counter()
+        self.assertFalse(self._init_checkout())
+        self.assertGreaterEqual(time.perf_counter() - start, 0.4)
+        self.assertEqual(self.stub_server.request_count, 6)
+
+    def test_retry_after_above_maximum(self):
+        self.stub_server.retry_after = 60
+        self.assertFalse(self._init_checkout())
+        self.assertEqual(self.stub_server.request_count, 2)
+
+    def test_get_retry_after(self):
+        self.assertEqual(get_retry_after({'Retry-After': '2'}), 2)
+        self.assertEqual(get_retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), 0)
+        self.assertIsNone(get_retry_after({'Retry-After': 'soon'}))
+        self.assertIsNone(get_retry_after({}))
+
+    def test_circuit_breaker_opens(self):
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_CIRCUIT_BREAKER_THRESHOLD', 3)
+        # the failed token obtain attempts open the circuit before the checkout creation
+        with self.assertRaises(PaydirektCircuitOpenError):
+            self._init_checkout()
+        self.assertEqual(self.stub_server.request_count, 3)
+
+    def test_circuit_breaker_half_open(self):
+        circuit_breaker = PaydirektCircuitBreaker(threshold=2, timeout=0.05)
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow())
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(circuit_breaker.allow())
+        self.assertFalse(circuit_breaker.allow())
+        circuit_breaker.record_success()
+        self.assertTrue(circuit_breaker.allow())
+        self.assertTrue(circuit_breaker.allow())
+
+    def test_circuit_breaker_trial_ended(self):
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_CIRCUIT_BREAKER_THRESHOLD', 1)
+        self.replacer.replace('django_paydirekt.settings.PAYDIREKT_CIRCUIT_BREAKER_TIMEOUT', 0.05)
+        circuit_breaker = get_circuit_breaker(self.paydirekt_wrapper.api_url)
+        circuit_breaker.record_failure()
+        time.sleep(0.06)
+        with self.assertRaises(PaydirektDeadlineExceeded):
+            self.paydirekt_wrapper.call_api('/api/checkout/v1/checkouts/123-abc-approved/', access_token='token',
+                                            deadline=time.monotonic() - 1)
+        self.assertEqual(circuit_breaker.allow(), PaydirektCircuitBreaker.TRIAL)
+        circuit_breaker.end_trial()
+
+        paydirekt_wrapper = AsyncPaydirektWrapper(auth=self.paydirekt_wrapper.auth, token_store=PaydirektTokenStore())
+        paydirekt_wrapper.api_url = self.stub_server.url
+        self.stub_server.latency = 0.5
+
+        async def cancelled_call_api():
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(paydirekt_wrapper.call_api('/api/checkout/v1/checkouts/123-abc-approved/', access_token='token'), 0.05)
+
+        async_to_sync(cancelled_call_api)()
+        self.assertEqual(circuit_breaker.allow(), PaydirektCircuitBreaker.TRIAL)
+
+
+class TestPaydirektTimeouts(TestCase):
+
+    def setUp(self):
+        self.stub_server = StubServer().start()
+        self.addCleanup(self.stub_server.stop)
+        self.paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+        self.paydirekt_wrapper.api_url = self.stub_server.url
+        self.paydirekt_checkout = self.paydirekt_wrapper.init(total_amount=10.0, reference_number='1', payment_type='ORDER',
+                                                              shopping_cart_type='ANONYMOUS_DONATION')
+        self.stub_server.latency = 0.5
+
+    def test_operation_timeout(self):
+        self.paydirekt_wrapper.retries = 0
+        self.paydirekt_wrapper.timeouts = dict(self.paydirekt_wrapper.timeouts, refresh=0.05)
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            self.paydirekt_checkout.refresh_from_paydirekt(self.paydirekt_wrapper)
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+    def test_deadline_bounds_timeout_and_retries(self):
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            self.paydirekt_checkout.refresh_from_paydirekt(self.paydirekt_wrapper, deadline=time.monotonic() + 0.1)
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(self.stub_server.request_count, 3)
+
+    def test_deadline_exceeded(self):
+        self.paydirekt_checkout.captures_link = '{0}/captures'.format(self.paydirekt_checkout.link)
+        with self.assertRaises(PaydirektDeadlineExceeded):
+            self.paydirekt_checkout.create_capture(amount=5.0, paydirekt_wrapper=self.paydirekt_wrapper, deadline=time.monotonic())
+        self.assertEqual(self.stub_server.request_count, 2)
+
+    def test_deadline_bounds_retry_after(self):
+        self.stub_server.latency = 0
+        self.stub_server.error_rate = 1
+        self.stub_server.retry_after = 1
+        start = time.perf_counter()
+        self.assertFalse(self.paydirekt_wrapper.transactions(from_datetime=datetime(2019, 1, 1), to_datetime=datetime(2019, 1, 2),
+                                                             deadline=time.monotonic() + 0.5))
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(self.stub_server.request_count, 3)
+
+    def test_async_deadline(self):
+        paydirekt_wrapper = AsyncPaydirektWrapper(auth=self.paydirekt_wrapper.auth, token_store=PaydirektTokenStore())
+        paydirekt_wrapper.api_url = self.stub_server.url
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            async_to_sync(self.paydirekt_checkout.arefresh_from_paydirekt)(paydirekt_wrapper, deadline=time.monotonic() + 0.1)
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+
+class TestPaydirektInstrumentation(TestCase):
+
+    def setUp(self):
+        self.api_calls = []
+        self.notifications = []
+
+        def record_api_call(sender, **kwargs):
+            self.api_calls.append(kwargs)
+
+        def record_notification(sender, **kwargs):
+            self.notifications.append(kwargs)
+
+        paydirekt_api_called.connect(record_api_call, weak=False, dispatch_uid='test_api_called')
+        paydirekt_notification_handled.connect(record_notification, weak=False, dispatch_uid='test_notification_handled')
+        self.addCleanup(paydirekt_api_called.disconnect, dispatch_uid='test_api_called')
+        self.addCleanup(paydirekt_notification_handled.disconnect, dispatch_uid='test_notification_handled')
+        self.stub_server = StubServer().start()
+        self.addCleanup(self.stub_server.stop)
+        self.paydirekt_wrapper = PaydirektWrapper(auth={
+            'API_SECRET': django_paydirekt_settings.PAYDIREKT_API_SECRET,
+            'API_KEY': django_paydirekt_settings.PAYDIREKT_API_KEY,
+        }, token_store=PaydirektTokenStore())
+        self.paydirekt_wrapper.api_url = self.stub_server.url
+
+    def test_api_calls(self):
+        paydirekt_checkout = self.paydirekt_wrapper.init(total_amount=10.0, reference_number='1', payment_type='ORDER',
+                                                         shopping_cart_type='ANONYMOUS_DONATION')
+        paydirekt_checkout.refresh_from_paydirekt(self.paydirekt_wrapper)
+        self.paydirekt_wrapper.call_api('/api/checkout/v1/checkouts/unknown/')
+        self.assertEqual([(api_call['endpoint'], api_call['method'], api_call['status'], api_call['token_cache']) for api_call in self.api_calls], [
+            ('token_obtain', 'POST', 200, None),
+            ('checkout_create', 'POST', 200, 'miss'),
+            ('checkout', 'GET', 200, 'hit'),
+            ('checkout', 'GET', 404, 'hit'),
+        ])
+        self.assertGreater(self.api_calls[1]['request_size'], 0)
+        self.assertGreater(self.api_calls[1]['response_size'], 0)
+        self.assertGreater(self.api_calls[1]['duration'], 0)
+
+    def test_async_api_calls(self):
+        paydirekt_wrapper = AsyncPaydirektWrapper(auth=self.paydirekt_wrapper.auth, token_store=PaydirektTokenStore())
+        paydirekt_wrapper.api_url = self.stub_server.url
+        async_to_sync(paydirekt_wrapper.call_api)('/api/checkout/v1/checkouts/123-abc-approved/')
+        self.assertEqual([(api_call['endpoint'], api_call['status'], api_call['token_cache']) for api_call in self.api_calls], [
+            ('token_obtain', 200, None),
+            ('checkout', 200, 'miss'),
+        ])
+
+    def test_notification_branches(self):
+        client = Client()
+        client.post('/paydirekt/notify/', data=json.dumps({'checkoutId': '123-abc-approved'}), content_type='application/hal+json')
+        post_data = {'checkoutId': '123-abc-unknown', 'merchantOrderReferenceNumber': '123-abc-unknown', 'checkoutStatus': 'APPROVED'}
+        client.post('/paydirekt-async/notify/', data=json.dumps(post_data), content_type='application/hal+json')
+        self.assertEqual([(notification['branch'], notification['status']) for notification in self.notifications], [
+            ('invalid', 400),
+            ('checkout', 400),
+        ])
+
+
 class TestPaydirektCheckouts(TestCase):
     paydirekt_wrapper = None
 